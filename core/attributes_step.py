@@ -1,7 +1,353 @@
+from dataclasses import dataclass, field
+import heapq
+from typing import Dict, List, Tuple
+
 import toolbox.helper as h
 from core.db_step import DbStep
+from core.import_step import get_osm2pgsql_output, subdivided_table
 from settings import DbSettings, GlobalSettings, InputType
-from toolbox.dbhelper import PostgresConnection
+from toolbox.dbhelper import PostgresConnection, PostgresConnectionPool, transform_sql
+from toolbox.fingerprint import TableFingerprints, hash_values, invalidate_fingerprint, is_unchanged, store_fingerprint, \
+    template_fingerprint
+from toolbox.scheduler import Task, run_tasks
+
+
+@dataclass
+class AttributeUnit:
+    """One independently computable part of the attributes step: an SQL template which reads the 'inputs' tables and
+    writes the 'outputs' tables. If 'requires' is given, the unit is only executed if at least one of the listed
+    template parameters is set (e.g. an optional input table). Tileable units can be computed per spatial tile (see
+    'tile_size' in the attributes settings): their template is rendered with 'tile_ids' (the tiles of a batch) and
+    'tile_batch' (the batch number, e.g. for intermediate tables), and inserts into its outputs if 'tile_insert' is set -
+    the outputs are created beforehand by rendering the template for an empty batch. By default, the
+    template is the unit's name within the step's template directory - 'template', 'template_subdir' and additional
+    template 'params' allow for units based on shared templates."""
+    name: str
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    requires: List[str] = field(default_factory=list)
+    tileable: bool = False
+    template: str = None
+    template_subdir: str = None
+    params: Dict = field(default_factory=dict)
+
+
+GIP_ATTRIBUTE_UNITS: List[AttributeUnit] = [
+    AttributeUnit("access", ["network_edge"], ["attr_access"]),
+    AttributeUnit("bridge_tunnel", ["network_edge", "gip_link2referenceobject", "gip_referenceobject"], ["attr_bridge_tunnel"]),
+    AttributeUnit("stairs", ["network_edge"], ["attr_stairs"]),
+    AttributeUnit("bicycle_infrastructure", ["network_edge"], ["attr_bicycle_infrastructure"]),
+    AttributeUnit("pedestrian_infrastructure", ["network_edge", "attr_access"], ["attr_pedestrian_infrastructure"]),
+    AttributeUnit("designated_route", ["gip_link2referenceobject", "gip_referenceobject"], ["attr_designated_route"]),
+    AttributeUnit("road_category", ["network_edge", "attr_access"], ["attr_road_category"]),
+    AttributeUnit("max_speed", ["network_edge"], ["attr_max_speed"]),
+    AttributeUnit("pavement", ["network_edge"], ["attr_pavement"]),
+    AttributeUnit("width", ["network_edge"], ["attr_width"]),
+    AttributeUnit("gradient", ["network_edge", "network_node", "attr_bridge_tunnel"], ["attr_gradient"]),
+    AttributeUnit("number_lanes", ["network_edge"], ["attr_number_lanes"]),
+    AttributeUnit("facilities", ["network_edge", "facility"], ["attr_facilities"], ["table_facility"]),
+    AttributeUnit("crossings", ["network_edge", "crossing"], ["attr_crossings"], ["table_crossing"]),
+    AttributeUnit("buffer_overlay", ["network_edge", "building", "greenness", "water"],
+                  ["attr_buildings", "attr_greenness", "attr_water"], ["table_building", "table_greenness", "table_water"],
+                  tileable=True, template="attributes_buffer_overlay", template_subdir="sql/templates/"),
+    AttributeUnit("noise", ["network_edge", "noise", "noise_raster"], ["attr_noise"], ["table_noise", "table_noise_raster"],
+                  tileable=True, template="attributes_noise", template_subdir="sql/templates/"),
+]
+
+OSM_ATTRIBUTE_UNITS: List[AttributeUnit] = [
+    AttributeUnit("access_car", ["network_edge"], ["attr_access_car"]),
+    AttributeUnit("access_bicycle", ["network_edge"], ["attr_access_bicycle"]),
+    AttributeUnit("access_pedestrian", ["network_edge"], ["attr_access_pedestrian"]),
+    AttributeUnit("bridge_tunnel", ["network_edge"], ["attr_bridge_tunnel"]),
+    AttributeUnit("stairs", ["network_edge"], ["attr_stairs"]),
+    AttributeUnit("bicycle_infrastructure", ["network_edge"], ["attr_bicycle_infrastructure"]),
+    AttributeUnit("pedestrian_infrastructure", ["network_edge", "attr_access_pedestrian"], ["attr_pedestrian_infrastructure"]),
+    AttributeUnit("designated_route_prepare", ["osm_line"], ["attr_designated_route_route"]),
+    AttributeUnit("designated_route", ["network_edge", "attr_designated_route_route", "osm_route_member"], ["attr_designated_route"],
+                  tileable=True),
+    AttributeUnit("road_category", ["network_edge"], ["attr_road_category"]),
+    AttributeUnit("max_speed", ["network_edge"], ["attr_max_speed"]),
+    AttributeUnit("pavement", ["network_edge"], ["attr_pavement"]),
+    AttributeUnit("width", ["network_edge"], ["attr_width"]),
+    AttributeUnit("elevation", ["network_node", "dem"], ["attr_elevation"], ["table_dem"]),
+    AttributeUnit("gradient", ["network_edge", "attr_bridge_tunnel", "attr_elevation"], ["attr_gradient"], ["table_dem"]),
+    AttributeUnit("number_lanes", ["network_edge"], ["attr_number_lanes"]),
+    AttributeUnit("facilities", ["network_edge", "facility"], ["attr_facilities"], ["table_facility"]),
+    AttributeUnit("crossings", ["network_edge", "crossing"], ["attr_crossings"], ["table_crossing"]),
+    AttributeUnit("buffer_overlay", ["network_edge", "building", "greenness", "water"],
+                  ["attr_buildings", "attr_greenness", "attr_water"], ["table_building", "table_greenness", "table_water"],
+                  tileable=True, template="attributes_buffer_overlay", template_subdir="sql/templates/"),
+    AttributeUnit("noise", ["network_edge", "noise", "noise_raster"], ["attr_noise"], ["table_noise", "table_noise_raster"],
+                  tileable=True, template="attributes_noise", template_subdir="sql/templates/"),
+]
+
+ATTRIBUTES_OUTPUT_TABLES: List[str] = ['network_edge_attributes', 'network_edge_export', 'network_node_attributes']
+
+# buffer-based indicators (computed by the unit "buffer_overlay"): input table parameter and default buffer distance (m)
+BUFFER_INDICATORS: Dict[str, tuple] = {
+    'buildings': ('table_building', 20),
+    'greenness': ('table_greenness', 30),
+    'water': ('table_water', 30),
+}
+# indicators counting features within a fixed distance (m) of the edge (see the templates "facilities" and "crossings")
+NEIGHBOURHOOD_INDICATORS: Dict[str, float] = {
+    'facilities': 30,
+    'crossings': 10,
+}
+# coverage indicators (share of the edge buffer covered by polygons) - may be approximated on a raster
+COVERAGE_INDICATORS: List[str] = ['buildings', 'greenness']
+COVERAGE_MODES: List[str] = ['exact', 'raster']
+
+# default distance (m) between the samples along an edge for the noise indicator based on a noise raster
+NOISE_SAMPLE_SPACING = 10
+
+# the tiles of tileable units are grouped into at most TILE_BATCHES_PER_WORKER batches (tasks) per worker
+TILE_BATCHES_PER_WORKER = 4
+
+# raster tiles of the approximate coverage mode have a size of RASTER_TILE_PIXELS x RASTER_TILE_PIXELS pixels
+RASTER_TILE_PIXELS = 256
+
+
+def get_workers(settings: dict) -> int:
+    if h.has_keys(settings, ['workers']):
+        return max(1, int(settings['workers']))
+    return GlobalSettings.max_workers
+
+
+def get_tile_size(settings: dict) -> float:
+    if h.has_keys(settings, ['tile_size']) and settings['tile_size']:
+        tile_size = h.str_to_numeric(str(settings['tile_size']), throw_error=True)
+        if tile_size <= 0:
+            raise Exception(f"Invalid attributes setting 'tile_size': {settings['tile_size']} (must be > 0)")
+        return tile_size
+    return None
+
+
+def group_tiles(tiles: List[Tuple[int, int]], batches: int) -> List[List[int]]:
+    """Groups tiles, given as (tile_id, edge_count), into at most the given number of batches with similar edge counts
+    (largest tiles first, each to the batch with the fewest edges so far)."""
+    heap = [(0, i, []) for i in range(max(1, min(batches, len(tiles))))]
+    for tile_id, edge_count in sorted(tiles, key=lambda t: -t[1]):
+        count, i, tile_ids = heapq.heappop(heap)
+        tile_ids.append(tile_id)
+        heapq.heappush(heap, (count + edge_count, i, tile_ids))
+    return [sorted(tile_ids) for _, _, tile_ids in sorted(heap, key=lambda b: b[1]) if tile_ids]
+
+
+def use_overlay_layer(db: PostgresConnection, layer: str, schema: str) -> str:
+    """Returns the subdivided copy of a layer if it exists (see import setting 'subdivide'), otherwise the layer itself
+    (or None if it does not exist)."""
+    subdivided = db.use_if_exists(subdivided_table(layer), schema)
+    return subdivided or db.use_if_exists(layer, schema)
+
+
+def get_coverage_mode(settings: dict) -> str:
+    if h.has_keys(settings, ['coverage_mode']):
+        mode = str(settings['coverage_mode']).lower()
+        if mode not in COVERAGE_MODES:
+            raise Exception(f"Invalid attributes setting 'coverage_mode': {settings['coverage_mode']} (must be one of: {', '.join(COVERAGE_MODES)})")
+        return mode
+    return 'exact'
+
+
+def get_coverage_resolution(settings: dict) -> float:
+    if h.has_keys(settings, ['coverage_resolution']):
+        resolution = h.str_to_numeric(str(settings['coverage_resolution']), throw_error=True)
+        if resolution <= 0:
+            raise Exception(f"Invalid attributes setting 'coverage_resolution': {settings['coverage_resolution']} (must be > 0)")
+        return resolution
+    return 1
+
+
+def get_noise_sample_spacing(settings: dict) -> float:
+    if h.has_keys(settings, ['noise_sample_spacing']):
+        spacing = h.str_to_numeric(str(settings['noise_sample_spacing']), throw_error=True)
+        if spacing <= 0:
+            raise Exception(f"Invalid attributes setting 'noise_sample_spacing': {settings['noise_sample_spacing']} (must be > 0)")
+        return spacing
+    return NOISE_SAMPLE_SPACING
+
+
+def get_buffer_distances(settings: dict) -> Dict[str, float]:
+    distances = {indicator: distance for indicator, (_, distance) in BUFFER_INDICATORS.items()}
+    if h.has_keys(settings, ['buffer_distances']):
+        for indicator, distance in (settings['buffer_distances'] or {}).items():
+            if indicator not in BUFFER_INDICATORS:
+                raise Exception(f"Invalid attributes setting 'buffer_distances': unknown indicator '{indicator}' (must be one of: {', '.join(BUFFER_INDICATORS)})")
+            distance = h.str_to_numeric(str(distance), throw_error=True)
+            if distance <= 0:
+                raise Exception(f"Invalid attributes setting 'buffer_distances': {indicator}: {distance} (must be > 0)")
+            distances[indicator] = distance
+    return distances
+
+
+def buffer_overlay_units(units: List[AttributeUnit], params: dict, settings: dict) -> List[AttributeUnit]:
+    """Configures the unit "buffer_overlay" for the available input layers and the buffer distances of the settings.
+    With 'coverage_mode: raster', the coverage indicators are computed by separate units instead: the polygons are
+    rasterized once and the coverage is computed as zonal sum per edge buffer."""
+    distances = get_buffer_distances(settings)
+    raster = get_coverage_mode(settings) == 'raster'
+    result = []
+    for unit in units:
+        if unit.name != "buffer_overlay":
+            result.append(unit)
+            continue
+        available = [i for i, (table_param, _) in BUFFER_INDICATORS.items() if params.get(table_param) is not None]
+        if raster:
+            resolution = get_coverage_resolution(settings)
+            for indicator in [i for i in available if i in COVERAGE_INDICATORS]:
+                table_param = BUFFER_INDICATORS[indicator][0]
+                result.append(AttributeUnit(indicator, ["network_edge", table_param[len("table_"):]], [f"attr_{indicator}"],
+                                            template="attributes_coverage_raster", template_subdir="sql/templates/",
+                                            params={'table_coverage': params[table_param], 'buffer_distance': distances[indicator],
+                                                    'table_result': f"attr_{indicator}", 'column_result': indicator,
+                                                    'raster_resolution': resolution, 'raster_tile_pixels': RASTER_TILE_PIXELS,
+                                                    'target_srid': GlobalSettings.get_target_srid()}))
+            available = [i for i in available if i not in COVERAGE_INDICATORS]
+        if not available:
+            continue
+        result.append(AttributeUnit(unit.name, ["network_edge"] + [BUFFER_INDICATORS[i][0][len("table_"):] for i in available],
+                                    [f"attr_{i}" for i in available], unit.requires, unit.tileable, unit.template,
+                                    unit.template_subdir,
+                                    params={'overlay_layers': available,
+                                            'overlay_tables': {i: params[BUFFER_INDICATORS[i][0]] for i in available},
+                                            'buffer_distances': {i: distances[i] for i in available},
+                                            'buffer_max': max(distances[i] for i in available)}))
+    return result
+
+
+def compute_unit_fingerprints(db: PostgresConnection, db_settings: DbSettings, units: List[AttributeUnit], template_subdir: str,
+                              params: dict) -> Dict[str, str]:
+    """Computes a fingerprint per unit from its rendered SQL and the fingerprints of its inputs: for inputs produced by
+    other units, the producer's fingerprint is used - all other input tables are fingerprinted by "table_fingerprint"."""
+    producers = {output: unit for unit in units for output in unit.outputs}
+    tables = TableFingerprints(db, [db_settings.entities.network_schema, db_settings.entities.data_schema],
+                               GlobalSettings.cache_content_hash)
+    fingerprints: Dict[str, str] = {}
+
+    def fingerprint(unit: AttributeUnit) -> str:
+        if unit.name not in fingerprints:
+            inputs = [fingerprint(producers[i]) if i in producers else tables.get(i) for i in unit.inputs]
+            fingerprints[unit.name] = hash_values(template_fingerprint(unit.template or unit.name, dict(params, **unit.params),
+                                                                       unit.template_subdir or template_subdir), inputs)
+        return fingerprints[unit.name]
+
+    for unit in units:
+        fingerprint(unit)
+    return fingerprints
+
+
+def run_attribute_units(db_settings: DbSettings, units: List[AttributeUnit], template_subdir: str, params: dict, workers: int,
+                        tile_size: float = None, fingerprints: Dict[str, str] = None):
+    """Executes the given attribute units - independent units run concurrently, each on its own database connection.
+    If a tile_size is given, tileable units are split into tasks per batch of tiles which insert into the unit's outputs.
+    If fingerprints are given, units whose fingerprint matches the one stored by a previous run are skipped."""
+    schema = db_settings.entities.network_schema
+    pool = PostgresConnectionPool(db_settings, workers, schema)
+
+    def cache_key(unit: AttributeUnit) -> str:
+        return f"{template_subdir}{unit.name}"
+
+    def make_unit_runner(unit: AttributeUnit, unit_params: dict, completes: AttributeUnit = None):
+        return make_runner(unit.template or unit.name, dict(unit_params, **unit.params), unit.template_subdir or template_subdir,
+                           completes)
+
+    def make_runner(template: str, template_params: dict, subdir: str = template_subdir, completes: AttributeUnit = None):
+        def run():
+            with pool.connection() as db:
+                db.execute_template_sql_from_file(template, template_params, template_subdir=subdir)
+                if fingerprints and completes is not None:
+                    store_fingerprint(db, schema, cache_key(completes), fingerprints[completes.name])
+        return run
+
+    def make_analyze_runner(unit: AttributeUnit):
+        def run():
+            with pool.connection() as db:
+                for output in unit.outputs:
+                    db.ex(f"ANALYZE {output};")
+                db.commit()
+                if fingerprints:
+                    store_fingerprint(db, schema, cache_key(unit), fingerprints[unit.name])
+        return run
+
+    try:
+        if fingerprints:
+            with pool.connection() as db:
+                unchanged = [u.name for u in units if is_unchanged(db, schema, cache_key(u), fingerprints[u.name], u.outputs)]
+                units = [u for u in units if u.name not in unchanged]
+                # results of units that will be re-computed are invalid until the unit completed successfully
+                for unit in units:
+                    invalidate_fingerprint(db, schema, cache_key(unit))
+            if unchanged:
+                h.info(f"inputs unchanged - re-using results of attribute units: {', '.join(unchanged)}")
+
+        batches: List[List[int]] = []
+        if tile_size and any(u.tileable for u in units):
+            h.logBeginTask(f"assign network edges to tiles of {tile_size} m")
+            with pool.connection() as db:
+                db.execute_template_sql_from_file("attributes_tiles", dict(params, tile_size=tile_size))
+                batches = group_tiles(db.query_all("SELECT tile_id, edge_count FROM attr_tile"),
+                                      workers * TILE_BATCHES_PER_WORKER)
+            h.logEndTask()
+            h.info(f"tiled processing of overlay indicators using {sum(len(b) for b in batches)} tiles in {len(batches)} batches")
+
+        tasks: List[Task] = []
+        for unit in units:
+            if not (batches and unit.tileable):
+                tasks.append(Task(unit.name, make_unit_runner(unit, params, completes=unit), unit.inputs, unit.outputs))
+                continue
+            # the output tables are created (empty) first, then each batch of tiles inserts its results - every edge
+            # belongs to exactly one tile, so no de-duplication is needed
+            created = [f"{o}_created" for o in unit.outputs]
+            tasks.append(Task(f"{unit.name}_create", make_unit_runner(unit, dict(params, tile_ids=[], tile_batch=0)),
+                              unit.inputs, created))
+            batch_names: List[str] = []
+            for i, tile_ids in enumerate(batches, start=1):
+                batch_names.append(f"{unit.name}_batch_{i}")
+                tasks.append(Task(batch_names[-1], make_unit_runner(unit, dict(params, tile_ids=tile_ids, tile_batch=i,
+                                                                                tile_insert=True)),
+                                  unit.inputs + created, [batch_names[-1]]))
+            tasks.append(Task(f"{unit.name}_analyze", make_analyze_runner(unit), batch_names, unit.outputs))
+        run_tasks(tasks, workers)
+    finally:
+        pool.close()
+
+
+def compute_attributes(db_settings: DbSettings, db: PostgresConnection, units: List[AttributeUnit], template_subdir: str,
+                       params: dict, settings: dict):
+    """Computes all attribute units whose requirements are met and assembles the attribute tables."""
+    schema = db_settings.entities.network_schema
+    active_units = [u for u in units if not u.requires or any(params.get(r) is not None for r in u.requires)]
+    skipped = [u.name for u in units if u not in active_units]
+    if skipped:
+        h.log(f"skipping attribute units due to missing input: {', '.join(skipped)}")
+    units = active_units
+    if get_coverage_mode(settings) == 'raster':
+        h.info(f"coverage indicators ({', '.join(COVERAGE_INDICATORS)}): raster-based approximation")
+    units = buffer_overlay_units(units, params, settings)
+    params = dict(params, keep_intermediate=GlobalSettings.cache_enabled)
+
+    fingerprints: Dict[str, str] = None
+    step_key = f"{template_subdir}assemble"
+    if GlobalSettings.cache_enabled:
+        h.logBeginTask("compute input fingerprints")
+        fingerprints = compute_unit_fingerprints(db, db_settings, units, template_subdir, params)
+        step_fingerprint = hash_values(template_fingerprint("assemble", params, template_subdir),
+                                       [fingerprints[u.name] for u in units])
+        h.logEndTask()
+        if is_unchanged(db, schema, step_key, step_fingerprint, ATTRIBUTES_OUTPUT_TABLES):
+            h.majorInfo("inputs unchanged since the last run - skipping attributes step")
+            return
+
+    if db.handle_conflicting_output_tables(ATTRIBUTES_OUTPUT_TABLES):
+        if fingerprints:
+            invalidate_fingerprint(db, schema, step_key)
+        run_attribute_units(db_settings, units, template_subdir, params, get_workers(settings), get_tile_size(settings),
+                            fingerprints)
+        db.execute_template_sql_from_file("assemble", params, template_subdir=template_subdir)
+        db.commit()
+        if fingerprints:
+            store_fingerprint(db, schema, step_key, step_fingerprint)
 
 
 class GipAttributesStep(DbStep):
@@ -10,7 +356,7 @@ class GipAttributesStep(DbStep):
 
     def run_step(self, settings: dict):
         h.info('attributes step')
-        h.log(f"using import settings: {str(settings)}")
+        h.log(f"using attributes settings: {str(settings)}")
 
         schema = self.db_settings.entities.network_schema
 
@@ -29,23 +375,23 @@ class GipAttributesStep(DbStep):
 
         # execute "gip_attributes"
         h.logBeginTask('execute "gip_attributes')
-        if db.handle_conflicting_output_tables(['network_edge_attributes', 'network_edge_export', 'network_node_attributes']):
-            params = {  # TODO: @CW: check hard-coded vs. dynamic table names -> settings; also preferably use common data schema - e.g. to avoid providing combined schema + table identifiers
-                'schema_network': schema,
-                'schema_data': self.db_settings.entities.data_schema,
-                'table_dem': db.use_if_exists('dem', self.db_settings.entities.data_schema),
-                'table_noise': db.use_if_exists('noise', self.db_settings.entities.data_schema),
-                'column_noise': 'noise',  # TODO: get from settings file
-                'table_building': db.use_if_exists('building', self.db_settings.entities.data_schema),
-                'table_crossing': db.use_if_exists('crossing', self.db_settings.entities.data_schema),
-                'table_facility': db.use_if_exists('facility', self.db_settings.entities.data_schema),
-                'table_greenness': db.use_if_exists('greenness', self.db_settings.entities.data_schema),
-                'table_water': db.use_if_exists('water', self.db_settings.entities.data_schema)
-            }
-            if params["table_dem"] is not None:
-                h.majorInfo("WARNING: You provided a DEM file. However, for GIP attribute calculation only the elevation data contained in the GIP dataset is used. Your provided DEM is ignored.")
-            db.execute_template_sql_from_file("gip_attributes", params)
-            db.commit()
+        params = {  # TODO: @CW: check hard-coded vs. dynamic table names -> settings; also preferably use common data schema - e.g. to avoid providing combined schema + table identifiers
+            'schema_network': schema,
+            'schema_data': self.db_settings.entities.data_schema,
+            'table_dem': db.use_if_exists('dem', self.db_settings.entities.data_schema),
+            'table_noise': use_overlay_layer(db, 'noise', self.db_settings.entities.data_schema),
+            'column_noise': 'noise',  # TODO: get from settings file
+            'table_noise_raster': db.use_if_exists('noise_raster', self.db_settings.entities.data_schema),
+            'noise_sample_spacing': get_noise_sample_spacing(settings),
+            'table_building': db.use_if_exists('building', self.db_settings.entities.data_schema),
+            'table_crossing': db.use_if_exists('crossing', self.db_settings.entities.data_schema),
+            'table_facility': db.use_if_exists('facility', self.db_settings.entities.data_schema),
+            'table_greenness': use_overlay_layer(db, 'greenness', self.db_settings.entities.data_schema),
+            'table_water': use_overlay_layer(db, 'water', self.db_settings.entities.data_schema)
+        }
+        if params["table_dem"] is not None:
+            h.majorInfo("WARNING: You provided a DEM file. However, for GIP attribute calculation only the elevation data contained in the GIP dataset is used. Your provided DEM is ignored.")
+        compute_attributes(self.db_settings, db, GIP_ATTRIBUTE_UNITS, "sql/templates/gip_attributes/", params, settings)
         h.logEndTask()
 
         # close database connection
@@ -59,7 +405,7 @@ class OsmAttributesStep(DbStep):
 
     def run_step(self, settings: dict):
         h.info('attributes step')
-        h.log(f"using import settings: {str(settings)}")
+        h.log(f"using attributes settings: {str(settings)}")
 
         schema = self.db_settings.entities.network_schema
 
@@ -78,23 +424,30 @@ class OsmAttributesStep(DbStep):
 
         # execute "osm_attributes"
         h.logBeginTask('execute "osm_attributes"')
-        if db.handle_conflicting_output_tables(['network_edge_attributes', 'network_edge_export', 'network_node_attributes']):
-            params = {
-                # TODO: harmonize schema + load table names from dbEntitySettings (which are populated / overwritten by read values from settings file)
-                'schema_network': schema,
-                'schema_data': self.db_settings.entities.data_schema,
-                'table_dem': db.use_if_exists('dem', self.db_settings.entities.data_schema),
-                'table_noise': db.use_if_exists('noise', self.db_settings.entities.data_schema),
-                'column_noise': 'noise',  # TODO: get from settings file
-                'table_building': db.use_if_exists('building', self.db_settings.entities.data_schema),
-                'table_crossing': db.use_if_exists('crossing', self.db_settings.entities.data_schema),
-                'table_facility': db.use_if_exists('facility', self.db_settings.entities.data_schema),
-                'table_greenness': db.use_if_exists('greenness', self.db_settings.entities.data_schema),
-                'table_water': db.use_if_exists('water', self.db_settings.entities.data_schema),
-                'target_srid': GlobalSettings.get_target_srid()
-            }
-            db.execute_template_sql_from_file("osm_attributes", params)
-            db.commit()
+        params = {
+            # TODO: harmonize schema + load table names from dbEntitySettings (which are populated / overwritten by read values from settings file)
+            'schema_network': schema,
+            'schema_data': self.db_settings.entities.data_schema,
+            'table_dem': db.use_if_exists('dem', self.db_settings.entities.data_schema),
+            'table_noise': use_overlay_layer(db, 'noise', self.db_settings.entities.data_schema),
+            'column_noise': 'noise',  # TODO: get from settings file
+            'table_noise_raster': db.use_if_exists('noise_raster', self.db_settings.entities.data_schema),
+            'noise_sample_spacing': get_noise_sample_spacing(settings),
+            'table_building': db.use_if_exists('building', self.db_settings.entities.data_schema),
+            'table_crossing': db.use_if_exists('crossing', self.db_settings.entities.data_schema),
+            'table_facility': db.use_if_exists('facility', self.db_settings.entities.data_schema),
+            'table_greenness': use_overlay_layer(db, 'greenness', self.db_settings.entities.data_schema),
+            'table_water': use_overlay_layer(db, 'water', self.db_settings.entities.data_schema),
+            # member ways of bicycle route relations (indicator "designated_route": matching by way id)
+            'table_route_member': db.use_if_exists('osm_route_member', self.db_settings.entities.data_schema),
+            'target_srid': GlobalSettings.get_target_srid(),
+            # OSM geometries in the target SRID (only reprojected if osm2pgsql did not project them on import)
+            'osm_geom': transform_sql('way', db.get_srid('osm_line', 'way', self.db_settings.entities.data_schema),
+                                      GlobalSettings.get_target_srid()),
+            # tags are read from typed columns with the flex output, from the hstore column 'tags' otherwise
+            'osm2pgsql_output': get_osm2pgsql_output(db, schema, 'network_edge')
+        }
+        compute_attributes(self.db_settings, db, OSM_ATTRIBUTE_UNITS, "sql/templates/osm_attributes/", params, settings)
         h.logEndTask()
 
         # close database connection
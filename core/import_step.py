@@ -1,124 +1,521 @@
+import csv
+import io
+import itertools
 import os
 import re
+import struct
 import subprocess
 from urllib.error import HTTPError
-import urllib.request
 import zipfile
-from osgeo import ogr
-from typing import List
+from contextlib import contextmanager
+from osgeo import ogr, osr
+from typing import Iterator, List, Tuple
 
 import toolbox.helper as h
+import toolbox.overpass as overpass
 from core.db_step import DbStep
 from settings import DbSettings, GlobalSettings, InputType
-from toolbox.dbhelper import PostgresConnection
-
-
-def create_csv(file_txt: str) -> None:
-    """Takes in a path to an ogd gip txt file and converts it to a csv file."""
-    with open(file_txt, 'r', encoding='iso-8859-1') as f:
-        for line in f:
-            if line.startswith('tbl;'):
-                file_csv = open(os.path.splitext(file_txt)[0] + '.csv', 'w', encoding='utf-8')
-            elif line.startswith('atr;'):
-                file_csv.write(line[4:])
-            elif line.startswith('rec;'):
-                file_csv.write(line[4:].replace('""', '').replace('" "', ''))
-
-    file_csv.close()
-
-
-def create_sql(file_txt: str) -> None:
-    """Takes in a path to an ogd gip txt file and creates a sql file from it."""
-    with open(file_txt, 'r', encoding='iso-8859-1') as f:
-        for line in f:
-            if line.startswith('tbl;'):
-                file_sql = open(os.path.splitext(file_txt)[0] + '.sql', 'w', encoding='utf-8')
-                tbl = line[4:].strip().lower()
-            elif line.startswith('atr;'):
-                atr = line[4:].strip().lower().split(';')
-            elif line.startswith('frm;'):
-                frm = line[4:].strip().lower().split(';')
-            elif line.startswith('rec;'):
+from toolbox.dbhelper import PostgresConnection, PostgresConnectionPool, transform_sql
+from toolbox.fingerprint import record_import_run, table_versions
+from toolbox.scheduler import Task, run_tasks
+
+
+# buffer size for streaming records of GIP files into the database (COPY FROM STDIN)
+GIP_COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+# number of link coordinates transformed to the target SRID at once when building GIP link geometries
+GIP_GEOMETRY_BATCH_SIZE = 250000
+
+# reference system of the coordinates in the GIP IDF export (nodes and link coordinates: WGS 84) - may be overridden by
+# the import setting 'gip_srid'
+GIP_SOURCE_SRID = 4326
+
+
+def _gip_column_type(frm_: str) -> str:
+    """Converts a GIP column format (e.g. 'string(10)', 'decimal(5,2)') into a PostgreSQL data type."""
+    if frm_ == 'string':
+        return 'varchar'
+    if m := re.search(r"^(string)[(]([0-9]*)[)]", frm_):
+        length = m.group(2)
+        return f"varchar({length})"
+    elif m := re.search(r"^(decimal)[(]([0-9]*)[,]([0-9]*)[)]", frm_):
+        precision = m.group(2)
+        scale = m.group(3)
+        return f"numeric({precision},{scale})"
+    elif m := re.search(r"^(decimal)[(]([0-9]*)[)]", frm_):
+        precision = m.group(2)
+        if int(precision) <= 4:
+            return "smallint"
+        elif int(precision) <= 10:
+            return "integer"
+        elif int(precision) <= 18:
+            return "bigint"
+        else:
+            return f"numeric({precision})"
+    return frm_
+
+
+def read_gip_header(lines: Iterator[str]) -> Tuple[str, List[str], List[str], str]:
+    """Reads the header of an ogd gip txt file (lines 'tbl;', 'atr;', 'frm;') from the given lines. Returns table name,
+    column names and column formats, as well as the first record line (the iterator is positioned after it)."""
+    tbl, atr, frm = None, None, None
+    for line in lines:
+        if line.startswith('tbl;'):
+            tbl = line[4:].strip().lower()
+        elif line.startswith('atr;'):
+            atr = line[4:].strip().lower().split(';')
+        elif line.startswith('frm;'):
+            frm = line[4:].strip().lower().split(';')
+        elif line.startswith('rec;'):
+            return tbl, atr, frm, line
+    return tbl, atr, frm, None
+
+
+def create_gip_table_sql(schema: str, table: str, atr: List[str], frm: List[str]) -> str:
+    """Creates the DDL for a GIP table based on the column names and formats given in the file header."""
+    atr = ['offset_' if atr_ == 'offset' else atr_ for atr_ in atr]
+    columns = [f"{atr_} {_gip_column_type(frm_)}" for atr_, frm_ in zip(atr, frm)]
+    return f"CREATE TABLE {schema}.{table} ({', '.join(columns)});"
+
+
+class GipRecordStream:
+    """File-like object providing the records ('rec;' lines) of an ogd gip txt file as CSV for COPY FROM STDIN."""
+
+    def __init__(self, lines: Iterator[str], first_record: str = None):
+        self._lines = lines
+        self._pending = first_record
+
+    @staticmethod
+    def _record(line: str) -> str:
+        return line[4:].replace('""', '').replace('" "', '') if line.startswith('rec;') else ''
+
+    def read(self, size: int = -1) -> str:
+        chunks = []
+        length = 0
+        if self._pending is not None:
+            chunks.append(self._record(self._pending))
+            length += len(chunks[-1])
+            self._pending = None
+        for line in self._lines:
+            record = self._record(line)
+            chunks.append(record)
+            length += len(record)
+            if 0 < size <= length:
                 break
+        return ''.join(chunks)
 
-    for i, atr_ in enumerate(atr):
-        if atr_ == 'offset':
-            atr[i] = 'offset_'
-
-    for i, frm_ in enumerate(frm):
-        if frm_ == 'string':
-            frm[i] = 'varchar'
-        if m := re.search(r"^(string)[(]([0-9]*)[)]", frm_):
-            length = m.group(2)
-            frm[i] = f"varchar({length})"
-        elif m := re.search(r"^(decimal)[(]([0-9]*)[,]([0-9]*)[)]", frm_):
-            precision = m.group(2)
-            scale = m.group(3)
-            frm[i] = f"numeric({precision},{scale})"
-        elif m := re.search(r"^(decimal)[(]([0-9]*)[)]", frm_):
-            precision = m.group(2)
-            if int(precision) <= 4:
-                frm[i] = "smallint"
-            elif int(precision) <= 10:
-                frm[i] = "integer"
-            elif int(precision) <= 18:
-                frm[i] = "bigint"
-            else:
-                frm[i] = f"numeric({precision})"
 
-    columns = [f"{atr_} {frm_}" for atr_, frm_ in zip(atr, frm)]
-    sql = f"CREATE TABLE gip_{tbl} ({', '.join(columns)});"
+def import_gip_table(db: PostgresConnection, zf: zipfile.ZipFile, member: str, schema: str, table: str) -> None:
+    """Streams an ogd gip txt file from the given zip file into a new database table: the table is created based on the
+    file header, records are decoded on the fly and copied into the table - no intermediate files are written."""
+    with zf.open(member, 'r') as raw:
+        lines = io.TextIOWrapper(raw, encoding='iso-8859-1')
+        tbl, atr, frm, first_record = read_gip_header(lines)
+        if atr is None or frm is None:
+            raise Exception(f"Invalid GIP file '{member}': header ('atr;' and 'frm;' lines) not found.")
+        h.log(f"Importing '{member}' (table '{tbl}') into database: '{schema}.{table}'")
+        db.drop_table(table, schema=schema)
+        db.ex(create_gip_table_sql(schema, table, atr, frm))
+        db.cur.copy_expert(f"COPY {schema}.{table} FROM STDIN WITH (FORMAT csv, DELIMITER ';', NULL '')",
+                           GipRecordStream(lines, first_record), size=GIP_COPY_BUFFER_SIZE)
+        db.commit()
+
+
+class LineStream:
+    """File-like object providing the lines yielded by the given iterator for COPY FROM STDIN."""
+
+    def __init__(self, lines: Iterator[str]):
+        self._lines = lines
+
+    def read(self, size: int = -1) -> str:
+        chunks = []
+        length = 0
+        for line in self._lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 < size <= length:
+                break
+        return ''.join(chunks)
+
+
+def _ewkb_linestring(points: List[Tuple[float, float]], srid: int) -> str:
+    """Encodes the given points as LineString in (hex) EWKB - little endian, including the SRID."""
+    return (struct.pack('<BIII', 1, 0x20000002, srid, len(points)) +
+            struct.pack(f'<{2 * len(points)}d', *[c for point in points for c in point])).hex()
+
 
-    file_sql.write(sql)
-    file_sql.close()
+def read_gip_link_coordinates(lines: Iterator[str], first_record: str, atr: List[str]) -> Iterator[Tuple[int, List[Tuple[float, float]]]]:
+    """Yields link_id and the ordered intermediate coordinates (x, y) per link from the records of 'LinkCoordinate.txt'.
+    The file is expected to be ordered by link_id."""
+    i_link, i_count, i_x, i_y = (atr.index(column) for column in ['link_id', 'count', 'x', 'y'])
+    records = csv.reader((line[4:] for line in itertools.chain([first_record], lines) if line.startswith('rec;')),
+                         delimiter=';')
+    previous = None
+    for link_id, group in itertools.groupby(records, key=lambda record: int(record[i_link])):
+        if previous is not None and link_id <= previous:
+            raise Exception(f"Invalid GIP file 'LinkCoordinate.txt': records are not ordered by link_id (link {link_id} "
+                            f"after link {previous}).")
+        previous = link_id
+        coordinates = sorted((int(record[i_count]), float(record[i_x]), float(record[i_y])) for record in group)
+        yield link_id, [(x, y) for _, x, y in coordinates]
 
 
-def import_csv(connection_string: str, path: str, schema: str, table: str) -> None:
-    """Takes in a path to a csv file and imports it to a database table."""
-    h.log(f"Importing CSV '{path}' into database: '{schema}.{table}'")
-    # INFO: for psql in Windows, connection_string MUST be the LAST parameter - otherwise, further arguments are ignored
-    subprocess.run(['psql', '-c', f"\\copy {schema}.{table} from '{path}' WITH CSV DELIMITER ';' NULL '' HEADER ENCODING 'utf-8'", connection_string],
-        check=True)
+def import_gip_link_geometries(db: PostgresConnection, zf: zipfile.ZipFile, member: str, schema: str, table: str,
+                               target_srid: int, source_srid: int = GIP_SOURCE_SRID,
+                               batch_size: int = GIP_GEOMETRY_BATCH_SIZE) -> None:
+    """Builds the LineString of every GIP link (from node, intermediate coordinates, to node) while streaming
+    'LinkCoordinate.txt' from the given zip file. The links with their end points are read in link_id order on a second
+    connection and merged with the coordinates (the file is ordered by link_id), so neither is held in memory.
+    Coordinates are transformed from 'source_srid' to the target SRID in batches and copied into a new table
+    (link_id, geom) as EWKB. Requires the tables 'gip_link' (with primary key) and 'gip_node' to be loaded."""
+    h.log(f"Building link geometries from '{member}' into database: '{schema}.{table}'")
+    source = osr.SpatialReference()
+    source.ImportFromEPSG(source_srid)
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(target_srid)
+    for srs in [source, target]:
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transformation = osr.CoordinateTransformation(source, target)
 
+    def links(end_points: Iterator[tuple],
+              coordinates: Iterator[Tuple[int, List[Tuple[float, float]]]]) -> Iterator[Tuple[int, List[Tuple[float, float]]]]:
+        # all points per link in order (merge join by link_id) - links without intermediate coordinates consist of
+        # their end points only, coordinates of unknown links are skipped
+        coordinate = next(coordinates, None)
+        for link_id, from_x, from_y, to_x, to_y in end_points:
+            while coordinate is not None and coordinate[0] < link_id:
+                coordinate = next(coordinates, None)
+            points = []
+            if coordinate is not None and coordinate[0] == link_id:
+                points = coordinate[1]
+                coordinate = next(coordinates, None)
+            yield link_id, ([(from_x, from_y)] if from_x is not None else []) + points + \
+                ([(to_x, to_y)] if to_x is not None else [])
 
-def import_geopackage(connection_string: str, path: str, schema: str, table: str, fid: str = None, target_srid: int = None, layers: List[str] = None,  attributes: List[str] = None, geometry_types: List[str] = None) -> None:  # TODO: @CW: add error handling
-    """Takes in a path to a geopackage file and imports it to a database table."""
+    def rows(coordinates: Iterator[Tuple[int, List[Tuple[float, float]]]]) -> Iterator[str]:
+        batch, points = [], []
+        for link_id, link_points in itertools.chain(coordinates, [(None, None)]):
+            if link_id is not None and len(link_points) >= 2:
+                batch.append((link_id, len(link_points)))
+                points.extend(link_points)
+            if points and (link_id is None or len(points) >= batch_size):
+                transformed = [(x, y) for x, y, *_ in transformation.TransformPoints(points)]
+                offset = 0
+                for batch_link_id, n in batch:
+                    yield f"{batch_link_id}\t{_ewkb_linestring(transformed[offset:offset + n], target_srid)}\n"
+                    offset += n
+                batch, points = [], []
+
+    with zf.open(member, 'r') as raw:
+        lines = io.TextIOWrapper(raw, encoding='iso-8859-1')
+        tbl, atr, frm, first_record = read_gip_header(lines)
+        if atr is None or first_record is None:
+            raise Exception(f"Invalid GIP file '{member}': header ('atr;' line) or records not found.")
+        db.drop_table(table, schema=schema)
+        db.ex(f"CREATE TABLE {schema}.{table} (link_id bigint, geom geometry(LineString, {target_srid}));")
+        # end points are fetched through a server-side cursor - the connection 'db' is busy with COPY meanwhile
+        reader = PostgresConnection(db.dbname, db.user, db.pw, db.host, db.port)
+        reader.connect()
+        try:
+            end_points = reader.con.cursor(name="gip_link_end_points")
+            end_points.itersize = batch_size
+            end_points.execute(f"""SELECT a.link_id, b.x::float8, b.y::float8, c.x::float8, c.y::float8
+                FROM {schema}.gip_link a
+                    LEFT JOIN {schema}.gip_node b ON a.from_node = b.node_id
+                    LEFT JOIN {schema}.gip_node c ON a.to_node = c.node_id
+                ORDER BY a.link_id""")
+            db.cur.copy_expert(f"COPY {schema}.{table} (link_id, geom) FROM STDIN",
+                               LineStream(rows(links(end_points, read_gip_link_coordinates(lines, first_record, atr)))),
+                               size=GIP_COPY_BUFFER_SIZE)
+            db.commit()
+        finally:
+            reader.close()
+
+
+def _geopackage_staging_table(table: str, index: int) -> str:
+    return f"{table}_load_{index}"
+
+
+def load_geopackage_layer(connection_string: str, path: str, schema: str, table: str, layer: str, attributes: List[str] = None,
+                          skip_failures: bool = False) -> None:
+    """Bulk-loads a layer into a staging table (COPY in a single transaction, no spatial index). Geometries are kept in
+    the source SRID and are not constrained to a geometry type - so that no feature fails on load. With 'skip_failures',
+    features are inserted one by one and those which fail to load are skipped (slow - for retrying a failed layer)."""
+    select = f"-select \"{','.join(attributes)}\"" if attributes else ""
+    mode = "--config PG_USE_COPY NO -skipfailures" if skip_failures else "--config PG_USE_COPY YES -gt unlimited"
+
+    result = subprocess.run(f"ogr2ogr -f PostgreSQL \"PG:{connection_string}\" {mode} -overwrite "
+                            f"-preserve_fid -lco FID=ogr_fid -lco GEOMETRY_NAME=geom -lco SPATIAL_INDEX=NONE -nlt GEOMETRY "
+                            f"-nln {schema}.{table} {select} \"{path}\" \"{layer}\"",
+        shell=True, check=True)
+    h.debugLog(f"ogr2ogr returned code: {result.returncode}")
+
+
+def read_layer_fids(path: str, layer: str) -> List[int]:
+    """FIDs of all features of a layer (attributes and geometries are not read)."""
     data_source = ogr.Open(path)
+    source_layer = data_source.GetLayerByName(layer)
+    definition = source_layer.GetLayerDefn()
+    source_layer.SetIgnoredFields([definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())] +
+                                  ["OGR_GEOMETRY", "OGR_STYLE"])
+    fids = [feature.GetFID() for feature in source_layer]
+    data_source = None
+    return fids
 
-    attributes = [] if attributes is None else attributes
-    attributes = ','.join(attribute for attribute in attributes)
 
-    geometry_types = [] if geometry_types is None else geometry_types
-    geometry_types = ', '.join(f"'{geometry_type}'" for geometry_type in geometry_types)
+def import_geopackage(db: PostgresConnection, path: str, schema: str, table: str, fid: str = None, target_srid: int = None, layers: List[str] = None,  attributes: List[str] = None, geometry_types: List[str] = None, workers: int = None) -> None:
+    """Takes in a path to a geopackage file and imports it to a database table. Layers are bulk-loaded concurrently
+    into staging tables and then combined into the target table (reprojected to 'target_srid' if given, filtered by
+    'geometry_types', Z and M values dropped). Source FIDs are kept as primary key 'fid' - if several layers are
+    imported, together with the layer name (column 'source_layer'). Features that cannot be imported (failed to load, empty
+    geometry, unknown SRID, other geometry type) are written to the table '<table>_reject'. The spatial index is created
+    after loading."""
+    fid = fid or "fid"
+    if layers is None:
+        data_source = ogr.Open(path)
+        layers = [layer.GetName() for layer in data_source]
+        data_source = None
+    if not layers:
+        raise Exception(f"No layers to import from '{path}'.")
+    staging = [_geopackage_staging_table(table, i) for i in range(len(layers))]
+    # layers which failed to load in bulk and were loaded skipping failing features
+    retried = set()
 
-    layers = [layer.GetName() for layer in data_source] if layers is None else layers
-    layers_geometry_types = set(data_source.GetLayerByName(layer).GetGeomType() for layer in layers)
+    def load(index: int):
+        def run():
+            try:
+                load_geopackage_layer(db.connection_string_old, path, schema, staging[index], layers[index], attributes)
+            except subprocess.CalledProcessError as e:
+                h.log(f"loading layer '{layers[index]}' failed ({e}) - retrying, skipping features which fail to load")
+                retried.add(index)
+                load_geopackage_layer(db.connection_string_old, path, schema, staging[index], layers[index], attributes,
+                                      skip_failures=True)
+        return run
 
-    fid = f"-lco FID={fid}" if fid else "-lco FID=fid"
-    transform = f"-t_srs EPSG:{target_srid}" if target_srid else ""
-    geometry_type = "-nlt GEOMETRY" if len(layers_geometry_types) > 1 else ""
+    h.log(f"bulk-loading {len(layers)} layer(s) of '{path}'")
+    run_tasks([Task(f"load_{layer}", load(i), [], [staging[i]]) for i, layer in enumerate(layers)],
+              workers or GlobalSettings.max_workers)
 
-    for layer in layers:
-        h.log(f"import layer \"{layer}\"")
-        geometry_column = data_source.GetLayerByName(layer).GetGeometryColumn()
+    # attributes: columns present in all layers (in order of the first layer)
+    columns = None
+    for staging_table in staging:
+        layer_columns = [row[0] for row in db.query_all("""SELECT column_name FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s AND column_name NOT IN ('ogr_fid', 'geom')
+            ORDER BY ordinal_position""", (schema, staging_table))]
+        columns = layer_columns if columns is None else [c for c in columns if c in layer_columns]
+    column_list = "".join(f'"{column}", ' for column in columns if column not in (fid, 'source_layer'))
 
-        select = f"-select \"{attributes}\"" if attributes else ""
-        where = f"-where \"ST_GeometryType({geometry_column}) IN ({geometry_types})\"" if geometry_types else ""
-        
-        result = subprocess.run(f"ogr2ogr -f PostgreSQL \"PG:{connection_string}\" {fid} -skipfailures -lco GEOMETRY_NAME=geom -nln {schema}.{table} {transform} {geometry_type} {select} {where} \"{path}\" \"{layer}\"", 
-            shell=True, check=True)
-        h.debugLog(f"ogr2ogr returned code: {result.returncode}")
-        #h.debugLog(f"ogr2ogr stdout: {result.args}")
+    geometry_types = [geometry_type.upper() for geometry_type in geometry_types or []]
+    type_filter = "TRUE" if not geometry_types else \
+        "upper(GeometryType(ST_Force2D(geom))) IN (" + ", ".join(f"'{geometry_type}'" for geometry_type in geometry_types) + ")"
+    # typed, SRID-constrained 2D geometry column (as created by ogr2ogr): a single imported geometry type or "Geometry"
+    geometry_type = geometry_types[0] if len(geometry_types) == 1 else "Geometry"
+    geom = f"ST_Transform(ST_Force2D(geom), {int(target_srid)})::geometry({geometry_type}, {int(target_srid)})" if target_srid \
+        else "ST_Force2D(geom)"
+    # reason for rejecting a feature (NULL if it is imported)
+    reject_reason = f"""CASE WHEN geom IS NULL OR ST_IsEmpty(geom) THEN 'empty geometry'
+            WHEN ST_SRID(geom) = 0 THEN 'unknown spatial reference system'
+            WHEN NOT ({type_filter}) THEN 'geometry type ' || GeometryType(geom) || ' not imported'
+        END"""
+    layer_names = [layer.replace("'", "''") for layer in layers]
+    # source FID per layer - and the layer name if several layers are imported
+    sources = [f"ogr_fid AS {fid}" if len(layers) == 1 else f"'{layer}'::varchar AS source_layer, ogr_fid AS {fid}"
+               for layer in layer_names]
+
+    h.log(f"combining layers into '{schema}.{table}'")
+    db.drop_table(f"{table}_reject", schema=schema)
+    db.ex(f"CREATE TABLE {schema}.{table}_reject AS (" + " UNION ALL ".join(
+        f"SELECT '{layer}'::varchar AS layer, ogr_fid AS fid, {reject_reason} AS reason, geom FROM {schema}.{staging_table}"
+        for layer, staging_table in zip(layer_names, staging)) + ");")
+    db.ex(f"DELETE FROM {schema}.{table}_reject WHERE reason IS NULL;")
+    for index in sorted(retried):
+        db.ex(f"""INSERT INTO {schema}.{table}_reject (layer, fid, reason)
+            SELECT %s, f, 'failed to load' FROM unnest(%s::bigint[]) f
+            WHERE NOT EXISTS(SELECT FROM {schema}.{staging[index]} s WHERE s.ogr_fid = f);""",
+              (layers[index], read_layer_fids(path, layers[index])))
+    db.ex(f"CREATE TABLE {schema}.{table} AS (" + " UNION ALL ".join(
+        f"SELECT {source}, {column_list}{geom} AS geom FROM {schema}.{staging_table} WHERE ({reject_reason}) IS NULL"
+        for source, staging_table in zip(sources, staging)) + ");")
+    if not target_srid:
+        # without reprojection, the column is constrained to the source SRID (if unique)
+        srids = db.query_all(f"SELECT DISTINCT ST_SRID(geom) FROM {schema}.{table}")
+        if len(srids) == 1:
+            db.ex(f"ALTER TABLE {schema}.{table} ALTER COLUMN geom TYPE geometry({geometry_type}, {int(srids[0][0])});")
+    db.ex(f"ALTER TABLE {schema}.{table} ADD PRIMARY KEY ({fid if len(layers) == 1 else f'source_layer, {fid}'});")
+    db.ex(f"CREATE INDEX {table}_geom_idx ON {schema}.{table} USING gist (geom);")
+    for staging_table in staging:
+        db.drop_table(staging_table, schema=schema)
+
+    rejected = db.query_one(f"SELECT count(*) FROM {schema}.{table}_reject")[0]
+    if rejected:
+        h.info(f"{rejected} feature(s) of '{path}' not imported - see table '{schema}.{table}_reject'")
+    else:
+        db.drop_table(f"{table}_reject", schema=schema)
+    db.commit()
+
+
+# layers which may contain huge polygons (e.g. forest multipolygons, noise bands): a copy "<layer>_subdivided" with a
+# bounded number of vertices per piece can be stored for faster overlays. Only the listed geometry types are subdivided -
+# other geometries are copied unchanged (e.g. water lines, whose length per edge is evaluated; water multipolygons,
+# which are not considered by the indicator "water")
+SUBDIVIDE_LAYERS = {
+    'greenness': ['ST_Polygon', 'ST_MultiPolygon'],
+    'noise': ['ST_Polygon', 'ST_MultiPolygon'],
+    'water': ['ST_Polygon'],
+}
+
+# default maximum number of vertices per piece of subdivided layers
+SUBDIVIDE_MAX_VERTICES = 256
+
+
+def get_subdivide_max_vertices(settings: dict) -> int:
+    """Reads the import setting 'subdivide': 'true' (default number of vertices) or the maximum number of vertices per
+    piece. Returns None if layers should not be subdivided."""
+    if not h.has_keys(settings or {}, ['subdivide']) or settings['subdivide'] is False:
+        return None
+    if settings['subdivide'] is True:
+        return SUBDIVIDE_MAX_VERTICES
+    max_vertices = int(settings['subdivide'])
+    if max_vertices < 8:
+        raise Exception(f"Invalid import setting 'subdivide': {settings['subdivide']} (must be 'true' or a number of vertices >= 8)")
+    return max_vertices
+
+
+def subdivided_table(table: str) -> str:
+    return f"{table}_subdivided"
+
+
+def refresh_subdivided_copy(db: PostgresConnection, schema: str, table: str, max_vertices: int = None) -> None:
+    """Re-creates the subdivided copy of a layer (see SUBDIVIDE_LAYERS) after the layer was (re-)imported - or only
+    removes an outdated copy if 'max_vertices' is not set. Polygons are split using ST_Subdivide, so that GiST bounding
+    boxes are tight and overlays only process the vertices of the pieces. Invalid polygons are copied unchanged. As the
+    pieces exactly cover the original polygons, overlay results (unions, intersection lengths) remain the same."""
+    copy = subdivided_table(table)
+    db.drop_table(copy, schema=schema)
+    if not max_vertices or not db.exists(table, schema):
+        db.commit()
+        return
+    h.logBeginTask(f'create subdivided copy of "{table}" (max. {max_vertices} vertices per piece)')
+    columns = [row[0] for row in db.query_all("""SELECT column_name FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s AND column_name <> 'geom' ORDER BY ordinal_position""", (schema, table))]
+    column_list = "".join(f'"{column}", ' for column in columns)
+    types = ", ".join(f"'{geometry_type}'" for geometry_type in SUBDIVIDE_LAYERS[table])
+    db.ex(f"""CREATE TABLE {schema}.{copy} AS (
+        SELECT {column_list}ST_Subdivide(geom, {int(max_vertices)}) AS geom
+        FROM {schema}.{table}
+        WHERE ST_GeometryType(geom) IN ({types}) AND ST_IsValid(geom)
+
+        UNION ALL
 
+        SELECT {column_list}geom
+        FROM {schema}.{table}
+        WHERE NOT (ST_GeometryType(geom) IN ({types}) AND ST_IsValid(geom))
+    );""")
+    db.ex(f"CREATE INDEX {copy}_geom_idx ON {schema}.{copy} USING gist (geom);")
+    db.commit()
+    pieces, features = db.query_one(f"SELECT (SELECT count(*) FROM {schema}.{copy}), (SELECT count(*) FROM {schema}.{table})")
+    h.log(f"subdivided {features} features of '{table}' into {pieces} pieces")
+    h.logEndTask()
 
-def import_osm(connection_string: str, path: str, path_style: str, schema: str, prefix: str = None) -> None:
-    """Takes in a path to an osm pbf file and imports it to database tables."""
+
+def import_osm(connection_string: str, path: str, path_style: str, schema: str, prefix: str = None, srid: int = None, append: bool = False) -> None:
+    """Takes in a path to an osm pbf file and imports it to database tables. Geometries are stored in the given SRID
+    (projected by osm2pgsql during import) or in WGS 84 if no SRID is given. With 'append', the given file is an OSM
+    change file which is applied to existing tables (requires the slim tables of the initial import)."""
     prefix = f"--prefix {prefix}" if prefix else ""
+    projection = f"--proj={int(srid)}" if srid else "--latlong"
+    mode = "--append" if append else "--create"
 
-    subprocess.run(f"osm2pgsql --database={connection_string} --middle-schema={schema} --output-pgsql-schema={schema} {prefix} --latlong --slim --hstore --style=\"{path_style}\" \"{path}\"", 
+    subprocess.run(f"osm2pgsql --database={connection_string} --middle-schema={schema} --output-pgsql-schema={schema} {prefix} {projection} {mode} --slim --hstore --style=\"{path_style}\" \"{path}\"", 
         shell=True, check=True)
 
 
+def import_osm_flex(connection_string: str, path: str, path_style: str, schema: str, prefix: str = 'osm', srid: int = None) -> None:
+    """Takes in a path to an osm pbf file and imports it using the osm2pgsql flex output and the given Lua style (e.g.
+    'resources/netascore.lua'). Schema, table prefix and SRID are passed to the style as environment variables."""
+    env = dict(os.environ, NETASCORE_SCHEMA=schema, NETASCORE_PREFIX=prefix, NETASCORE_SRID=str(int(srid) if srid else 4326))
+
+    subprocess.run(f"osm2pgsql --database={connection_string} --middle-schema={schema} --output=flex --slim --style=\"{path_style}\" \"{path}\"",
+        shell=True, check=True, env=env)
+
+
+def get_osm2pgsql_output(db: PostgresConnection, schema: str, table: str = 'osm_line') -> str:
+    """osm2pgsql output ('pgsql' or 'flex', see import setting 'osm2pgsql_output') the given table was created from: the
+    flex style writes typed tag columns instead of the hstore column 'tags' (see sql/templates/macros/osm.sql.j2)."""
+    return 'pgsql' if db.column_exists('tags', schema, table) else 'flex'
+
+
+# tag filter expressions (osmium tags-filter) for pre-filtering OSM input: keys used by the network template
+# ("osm_network"), the derived datasets (building, crossing, facility, greenness, water) and bicycle routes (indicator
+# "designated_route") - nodes referenced by matching ways and members of matching relations are kept as well. The test
+# "tests/test_osm_prefilter.py" fails if the templates or "netascore.lua" select objects by keys not covered here.
+OSM_PREFILTER_EXPRESSIONS = [
+    'w/highway',
+    'n/highway=crossing',
+    'nwr/amenity',
+    'nwr/tourism',
+    'wr/building',
+    'wr/landuse',
+    'wr/leisure',
+    'wr/natural',
+    'wr/waterway',
+    'r/route=bicycle',
+]
+
+
+def get_prefilter_expressions(settings: dict) -> List[str]:
+    """Tag filter expressions for pre-filtering OSM input (see import setting 'prefilter'), including railways and
+    aerialways if they are part of the network."""
+    expressions = list(OSM_PREFILTER_EXPRESSIONS)
+    if h.has_keys(settings, ['include_rail']) and settings['include_rail']:
+        expressions.append('w/railway')
+    if h.has_keys(settings, ['include_aerialway']) and settings['include_aerialway']:
+        expressions.append('w/aerialway')
+    return expressions
+
+
+def filter_osm(path: str, target_path: str, expressions: List[str]) -> None:
+    """Writes all objects of the given OSM file matching any of the given tag filter expressions (including referenced
+    objects) to 'target_path' using osmium-tool - the input file is streamed once."""
+    filters = " ".join(f"\"{expression}\"" for expression in expressions)
+    subprocess.run(f"osmium tags-filter --overwrite -o \"{target_path}\" \"{path}\" {filters}", shell=True, check=True)
+
+
+def create_route_membership(db: PostgresConnection, schema: str, rels_table: str) -> None:
+    """Stores the member ways of bicycle route relations in the table "osm_route_member" (relation_id, way_id), read
+    from the osm2pgsql middle table of relations - network edges can then be matched to routes by their way id
+    (indicator "designated_route") instead of by geometry."""
+    db.drop_table("osm_route_member", schema=schema)
+    if not db.exists(rels_table, schema):
+        db.commit()
+        return
+    if db.column_exists("parts", schema, rels_table):
+        # legacy middle format: member ids in "parts" (nodes, then ways up to "rel_off", then relations), tags as array
+        members = f"""SELECT id AS relation_id, unnest(parts[way_off + 1:rel_off]) AS way_id
+            FROM {schema}.{rels_table}
+            WHERE hstore(tags) -> 'type' = 'route' AND hstore(tags) -> 'route' = 'bicycle'"""
+    else:
+        # middle format of osm2pgsql >= 1.9: members and tags as jsonb
+        members = f"""SELECT id AS relation_id, (m ->> 'ref')::bigint AS way_id
+            FROM {schema}.{rels_table}, jsonb_array_elements(members) m
+            WHERE tags ->> 'type' = 'route' AND tags ->> 'route' = 'bicycle' AND m ->> 'type' = 'W'"""
+    db.ex(f"CREATE TABLE {schema}.osm_route_member AS ({members});")
+    db.ex(f"CREATE INDEX osm_route_member_relation_id_idx ON {schema}.osm_route_member (relation_id);")
+    db.commit()
+    count = db.query_one(f"SELECT count(*) FROM {schema}.osm_route_member")[0]
+    h.log(f"stored {count} member ways of bicycle route relations")
+
+
+# context datasets written by the flex style 'netascore.lua' (table 'osm_<name>') and their geometry type
+OSM_FLEX_DATASETS = {
+    'building': 'Polygon',
+    'crossing': 'Geometry',
+    'facility': 'Geometry',
+    'greenness': 'Polygon',
+    'water': 'Geometry',
+}
+
+
 class GipImporter(DbStep):
     def __init__(self, db_settings: DbSettings):
         super().__init__(db_settings)
@@ -133,7 +530,6 @@ class GipImporter(DbStep):
         files_A = [
             {'filename': 'BikeHike.txt', 'table': 'gip_bikehike', 'columns': ['use_id']},
             {'filename': 'Link.txt', 'table': 'gip_link', 'columns': ['link_id']},
-            {'filename': 'LinkCoordinate.txt', 'table': 'gip_linkcoordinate', 'columns': ['link_id', 'count']},
             {'filename': 'LinkUse.txt', 'table': 'gip_linkuse', 'columns': ['use_id']},
             {'filename': 'Link2ReferenceObject.txt', 'table': 'gip_link2referenceobject', 'columns': ['idseq']},
             {'filename': 'Node.txt', 'table': 'gip_node', 'columns': ['node_id']},
@@ -146,31 +542,47 @@ class GipImporter(DbStep):
         db.connect()
         db.init_extensions_and_schema(schema)
 
-        # extract zip files
-        h.logBeginTask('extract zip files')
-        with zipfile.ZipFile(os.path.join(directory, settings['filename_A']), 'r') as zf:
-            for file in files_A:
-                if not os.path.isfile(os.path.join(directory, os.path.splitext(settings['filename_A'])[0], file['filename'])):
-                    zf.extract(file['filename'], os.path.join(directory, os.path.splitext(settings['filename_A'])[0]))
-        h.logEndTask()
+        # create tables from files_A: stream records directly from the zip file into the database - tables are loaded
+        # concurrently (largest files first), each on its own connection; primary keys are added after loading a table.
+        # link geometries are built from 'LinkCoordinate.txt' once links and nodes are available (table 'gip_linkgeom')
+        path = os.path.join(directory, settings['filename_A'])
+        workers = max(1, int(settings['workers'])) if h.has_keys(settings, ['workers']) else GlobalSettings.max_workers
+        source_srid = int(settings['gip_srid']) if h.has_keys(settings, ['gip_srid']) else GIP_SOURCE_SRID
+        with zipfile.ZipFile(path, 'r') as zf:
+            files_A.sort(key=lambda file: zf.getinfo(file['filename']).file_size, reverse=True)
+        pool = PostgresConnectionPool(self.db_settings, workers)
 
-        # create tables from files_A
-        for file in files_A:
-            h.logBeginTask(f"create table \"{file['table']}\"")
-            if not os.path.isfile(os.path.join(directory, os.path.splitext(settings['filename_A'])[0], f"{os.path.splitext(file['filename'])[0]}.csv")):
-                create_csv(os.path.join(directory, os.path.splitext(settings['filename_A'])[0], file['filename']))
-            if not os.path.isfile(os.path.join(directory, os.path.splitext(settings['filename_A'])[0], f"{os.path.splitext(file['filename'])[0]}.sql")):
-                create_sql(os.path.join(directory, os.path.splitext(settings['filename_A'])[0], file['filename']))
-
-            db.drop_table(file['table'], schema=schema)
-            db.execute_sql_from_file(f"{os.path.splitext(file['filename'])[0]}", os.path.join(directory, os.path.splitext(settings['filename_A'])[0]))
-            db.commit()
+        def load_table(file: dict):
+            def run():
+                with pool.connection() as con, zipfile.ZipFile(path, 'r') as zf:
+                    import_gip_table(con, zf, file['filename'], schema, file['table'])
+            return run
 
-            import_csv(db.connection_string, os.path.join(directory, os.path.splitext(settings['filename_A'])[0], f"{os.path.splitext(file['filename'])[0]}.csv"), schema, table=file['table'])
+        def add_primary_key(file: dict):
+            def run():
+                with pool.connection() as con:
+                    con.add_primary_key(file['table'], file['columns'], schema=schema)
+                    con.commit()
+            return run
 
-            db.add_primary_key(file['table'], file['columns'], schema=schema)
-            db.commit()
-            h.logEndTask()
+        def load_link_geometries():
+            with pool.connection() as con, zipfile.ZipFile(path, 'r') as zf:
+                import_gip_link_geometries(con, zf, 'LinkCoordinate.txt', schema, 'gip_linkgeom',
+                                           GlobalSettings.get_target_srid(), source_srid)
+
+        tasks: List[Task] = []
+        for file in files_A:
+            tasks.append(Task(f"load_{file['table']}", load_table(file), [], [file['table']]))
+            tasks.append(Task(f"pkey_{file['table']}", add_primary_key(file), [file['table']], [f"{file['table']}_pkey"]))
+        tasks.append(Task("load_gip_linkgeom", load_link_geometries, ['gip_link_pkey', 'gip_node_pkey'], ['gip_linkgeom']))
+        tasks.append(Task("pkey_gip_linkgeom", add_primary_key({'table': 'gip_linkgeom', 'columns': ['link_id']}),
+                          ['gip_linkgeom'], ['gip_linkgeom_pkey']))
+        h.logBeginTask(f"create tables from '{settings['filename_A']}'")
+        try:
+            run_tasks(tasks, workers)
+        finally:
+            pool.close()
+        h.logEndTask()
 
         # close database connection
         h.log('closing database connection')
@@ -335,10 +747,6 @@ class OsmImporter(DbStep):
         self._load_osm_from_bbox(str(bbox)[1:-1], settings)
 
     def _load_osm_from_bbox(self, bbox: str, settings: dict):
-        q_template: str = """
-            [timeout:900][maxsize:1073741824];
-            nwr(__bbox__);
-            out;"""
         net_file = f"{GlobalSettings.osm_download_prefix}_{GlobalSettings.case_id}.xml"
         if os.path.isfile(os.path.join(GlobalSettings.data_directory, net_file)):
             if not h.has_keys(settings, ['on_existing']):
@@ -350,91 +758,53 @@ class OsmImporter(DbStep):
                 raise Exception("Target file for OSM download already exists. Aborting. Please resolve the conflict manually or specify a different value for 'on_existing' in the import settings. [skip/abort/delete]")     
             else:
                 h.info("Target file for OSM download already exists. Deleting existing file and proceeding with download. You can change this behavior by adding a value for 'on_existing' to the import settings. [skip/abort/delete]")
-        q_str = q_template.replace("__bbox__", bbox)
-        h.debugLog(f"prepared OSM overpass API query: \n'{q_str}")
 
+        # download the bbox in tiles (concurrently, across all API endpoints) - tiles are cached, so that re-runs and
+        # interrupted downloads only fetch missing tiles
         h.logBeginTask("Starting OSM data download...")
-        curEndpointIndex = 0
-        success = False
-        while curEndpointIndex < len(GlobalSettings.overpass_api_endpoints) and not success:
-            success = False
-            try:
-                file_name, headers = urllib.request.urlretrieve(
-                    GlobalSettings.overpass_api_endpoints[curEndpointIndex] + "?data=" + urllib.parse.quote_plus(q_str), 
-                    os.path.join(GlobalSettings.data_directory, net_file))
-            except HTTPError as e:
-                h.log(f"HTTPError while trying to download OSM data from '{GlobalSettings.overpass_api_endpoints[curEndpointIndex]}': Error code {e.code}\n{e.args}\n{e.info()} --> trying again with next available API endpoint...")
-                curEndpointIndex+=1
-            except KeyboardInterrupt:
-                h.majorInfo(f"OSM download from '{GlobalSettings.overpass_api_endpoints[curEndpointIndex]}' interrupted by user. Terminating.")
-                exit()
-            except BaseException as e:
-                h.log(f"An unexpected ERROR occured during OSM data download from '{GlobalSettings.overpass_api_endpoints[curEndpointIndex]}': {e.args}")
-                curEndpointIndex+=1
-            else:
-                success = True
-                h.log(f"Response headers from API call to {GlobalSettings.overpass_api_endpoints[curEndpointIndex]}: {headers}", h.LOG_LEVEL_4_DEBUG)
-                h.log(f"OSM Download from {GlobalSettings.overpass_api_endpoints[curEndpointIndex]} succeeded.")
-        if not success:
-            raise Exception("OSM data download was not successful. Terminating.")
+        cache_dir = os.path.join(GlobalSettings.data_directory, settings['download_cache_dir'] if h.has_keys(settings, ['download_cache_dir']) else 'overpass_cache')
+        tile_files = overpass.download_bbox(
+            bbox, cache_dir, GlobalSettings.overpass_api_endpoints,
+            tile_size=float(settings['download_tile_size']) if h.has_keys(settings, ['download_tile_size']) else 0.1,
+            date=settings['download_date'] if h.has_keys(settings, ['download_date']) else None,
+            slots=int(settings['download_slots']) if h.has_keys(settings, ['download_slots']) else 2,
+            interval=float(settings['download_interval']) if h.has_keys(settings, ['download_interval']) else 1.0)
         h.logEndTask()
 
-    def run_step(self, settings: dict):
-        h.info('importing osm')
-        h.log(f"using settings: {str(settings)}")
-        use_overpass_api: bool = False
-
-        schema = self.db_settings.entities.data_schema
-        directory = GlobalSettings.data_directory
-
-        # open database connection
-        h.info('open database connection')
-        db = PostgresConnection.from_settings_object(self.db_settings)
-        db.init_extensions_and_schema(schema)
-
-        # if needed, download OSM data
-        if not h.has_keys(settings, ['filename']):
-            h.info("no OSM file provided. Checking for Overpass API settings instead...")
-            if not h.has_any_key(settings, ['place_name', 'bbox']):
-                raise Exception("neither 'aoi_name' nor 'bbox' parameter specified for OSM download. Terminating.")
-            use_overpass_api = True
-            # start OSM import through overpass API
-            # import from bounding box
-            if h.has_keys(settings, ['bbox']):
-                self._load_osm_from_bbox(settings['bbox'], settings)
-            # import from place name
-            elif h.has_keys(settings, ['place_name']):
-                self._load_osm_from_placename(db, schema, directory, settings)
-
-        # import osm file
-        h.logBeginTask('import osm file')
-        db.drop_table("osm_point", schema=schema)
-        db.drop_table("osm_line", schema=schema)
-        db.drop_table("osm_polygon", schema=schema)
-        db.drop_table("osm_nodes", schema=schema)
-        db.drop_table("osm_rels", schema=schema)
-        db.drop_table("osm_roads", schema=schema)
-        db.drop_table("osm_ways", schema=schema)
-        db.commit()
-
-        filename = f"{GlobalSettings.osm_download_prefix}_{GlobalSettings.case_id}.xml"
-        if not use_overpass_api:
-            filename = settings['filename']
-        import_osm(db.connection_string, os.path.join(directory, filename), os.path.join('resources', 'default.style'), schema, prefix='osm')  # 12 m 35 s
+        h.logBeginTask(f"merging {len(tile_files)} tiles into '{net_file}'...")
+        overpass.merge_osm_files(tile_files, os.path.join(GlobalSettings.data_directory, net_file))
+        h.logEndTask()
 
-        db.drop_table("osm_nodes", schema=schema)
-        db.drop_table("osm_rels", schema=schema)
-        db.drop_table("osm_roads", schema=schema)
-        db.drop_table("osm_ways", schema=schema)
+    def _create_dataset_from_flex_table(self, db: PostgresConnection, schema: str, dataset: str, geometry_type: str, srid: int, target_srid: int):
+        """Creates a context dataset (e.g. 'building') from the table 'osm_<dataset>' written by the flex style: the table
+        is renamed if it is already in the target SRID (no copy), otherwise it is reprojected."""
+        source = f"osm_{dataset}"
+        if not db.handle_conflicting_output_tables([dataset], schema):
+            db.drop_table(source, schema=schema)
+            db.commit()
+            return
+        db.drop_table(dataset, schema=schema)
+        if srid == target_srid:
+            db.ex(f"ALTER TABLE {schema}.{source} DROP COLUMN osm_type, DROP COLUMN osm_ref;")
+            db.ex(f"ALTER TABLE {schema}.{source} RENAME TO {dataset};")
+        else:
+            db.ex(f"""CREATE TABLE {schema}.{dataset} AS (
+                SELECT ST_Transform(geom, {int(target_srid)})::geometry({geometry_type}, {int(target_srid)}) AS geom
+                FROM {schema}.{source}
+            );""")
+            db.ex(f"CREATE INDEX {dataset}_geom_idx ON {schema}.{dataset} USING gist (geom);")
+            db.drop_table(source, schema=schema)
         db.commit()
-        h.logEndTask()
 
+    def _create_osm_datasets(self, db: PostgresConnection, schema: str, way: str):
+        """Creates the datasets "building", "crossing", "facility", "greenness" and "water" from the imported OSM tables
+        (pgsql output). 'way' is the SQL expression of the OSM geometries in the target SRID."""
         # create dataset "building"
         h.logBeginTask('create dataset "building"')
         if db.handle_conflicting_output_tables(['building'], schema):
-            db.execute('''
+            db.execute(f'''
                 CREATE TABLE building AS ( -- 16 s
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(Polygon, %(target_srid)s) AS geom
+                    SELECT {way}::geometry(Polygon, %(target_srid)s) AS geom
                     FROM osm_polygon
                     WHERE building IS NOT NULL
                 );
@@ -447,11 +817,11 @@ class OsmImporter(DbStep):
         # create dataset "crossing"
         h.logBeginTask('create dataset "crossing"')
         if db.handle_conflicting_output_tables(['crossing'], schema):
-            db.execute('''
+            db.execute(f'''
                 CREATE TABLE crossing AS ( -- 4 s
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(Point, %(target_srid)s) AS geom FROM osm_point WHERE highway IN ('crossing') UNION ALL
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(LineString, %(target_srid)s) AS geom FROM osm_line WHERE highway IN ('crossing') UNION ALL
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(Polygon, %(target_srid)s) AS geom FROM osm_polygon WHERE highway IN ('crossing')
+                    SELECT {way}::geometry(Point, %(target_srid)s) AS geom FROM osm_point WHERE highway IN ('crossing') UNION ALL
+                    SELECT {way}::geometry(LineString, %(target_srid)s) AS geom FROM osm_line WHERE highway IN ('crossing') UNION ALL
+                    SELECT {way}::geometry(Polygon, %(target_srid)s) AS geom FROM osm_polygon WHERE highway IN ('crossing')
                 );
     
                 CREATE INDEX crossing_geom_idx ON crossing USING gist (geom); -- 1 s
@@ -462,9 +832,9 @@ class OsmImporter(DbStep):
         # create dataset "facility"
         h.logBeginTask('create dataset "facility"')
         if db.handle_conflicting_output_tables(['facility'], schema):
-            db.execute('''
+            db.execute(f'''
                 CREATE TABLE facility AS ( -- 3 s
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(Point, %(target_srid)s) AS geom
+                    SELECT {way}::geometry(Point, %(target_srid)s) AS geom
                     FROM osm_point
                     WHERE amenity IN ('arts_centre', 'artwork', 'attraction', 'bar', 'biergarten', 'cafe', 'castle', 'cinema', 'community_centre', 'library', 'museum',
                                       'music_venue', 'park', 'pub', 'public_bookcase', 'restaurant', 'swimming_pool', 'theatre', 'toy_library', 'viewpoint', 'public_bath') -- entertainment
@@ -480,7 +850,7 @@ class OsmImporter(DbStep):
     
                     UNION ALL
     
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(Polygon, %(target_srid)s) AS geom
+                    SELECT {way}::geometry(Polygon, %(target_srid)s) AS geom
                     FROM osm_polygon
                     WHERE amenity IN ('arts_centre', 'artwork', 'attraction', 'bar', 'biergarten', 'cafe', 'castle', 'cinema', 'community_centre', 'library', 'museum',
                                       'music_venue', 'park', 'pub', 'public_bookcase', 'restaurant', 'swimming_pool', 'theatre', 'toy_library', 'viewpoint', 'public_bath') -- entertainment
@@ -503,9 +873,9 @@ class OsmImporter(DbStep):
         # create dataset "greenness"
         h.logBeginTask('create dataset "greenness"')
         if db.handle_conflicting_output_tables(['greenness'], schema):
-            db.execute('''
+            db.execute(f'''
                 CREATE TABLE greenness AS ( -- 14 s
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(Polygon, %(target_srid)s) AS geom
+                    SELECT {way}::geometry(Polygon, %(target_srid)s) AS geom
                     FROM osm_polygon
                     WHERE landuse IN ('forest', 'grass', 'meadow', 'village_green', 'recreation_ground', 'vineyard', 'flowerbed', 'farmland', 'heath', 'nature_reseve', 'park', 'greenfield')
                        OR leisure IN ('garden', 'golf_course', 'park')
@@ -520,10 +890,10 @@ class OsmImporter(DbStep):
         # create dataset "water"
         h.logBeginTask('create dataset "water"')
         if db.handle_conflicting_output_tables(['water'], schema):
-            db.execute('''
+            db.execute(f'''
                 CREATE TABLE water AS ( -- 10 s
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(LineString, %(target_srid)s) AS geom FROM osm_line WHERE (waterway IS NOT NULL OR "natural" = 'water') AND tunnel IS NULL UNION ALL
-                    SELECT ST_Transform(way, %(target_srid)s)::geometry(Polygon, %(target_srid)s) AS geom FROM osm_polygon WHERE (waterway IS NOT NULL OR "natural" = 'water') AND tunnel IS NULL
+                    SELECT {way}::geometry(LineString, %(target_srid)s) AS geom FROM osm_line WHERE (waterway IS NOT NULL OR "natural" = 'water') AND tunnel IS NULL UNION ALL
+                    SELECT {way}::geometry(Polygon, %(target_srid)s) AS geom FROM osm_polygon WHERE (waterway IS NOT NULL OR "natural" = 'water') AND tunnel IS NULL
                 );
     
                 CREATE INDEX water_geom_idx ON water USING gist (geom); -- 1 s
@@ -531,11 +901,151 @@ class OsmImporter(DbStep):
             db.commit()
         h.logEndTask()
 
+    def apply_changes(self, change_file: str, settings: dict = None):
+        """Applies an OSM change file to the OSM tables of an updatable import (see import setting 'updatable') and
+        re-creates the datasets derived from them (and their subdivided copies, see import setting 'subdivide')."""
+        schema = self.db_settings.entities.data_schema
+        db = PostgresConnection.from_settings_object(self.db_settings)
+        db.connect()
+        db.schema = schema
+        if not db.exists("osm_ways", schema):
+            raise Exception("OSM slim tables not found. OSM updates require an import with the setting 'updatable: true'.")
+
+        h.logBeginTask(f"apply OSM changes from '{change_file}'")
+        osm_srid = db.get_srid("osm_line", "way", schema)
+        import_osm(db.connection_string, os.path.join(GlobalSettings.data_directory, change_file), os.path.join('resources', 'default.style'),
+                   schema, prefix='osm', srid=osm_srid if osm_srid != 4326 else None, append=True)
+        h.logEndTask()
+
+        create_route_membership(db, schema, "osm_rels")
+        for dataset in OSM_FLEX_DATASETS:
+            db.drop_table(dataset, schema=schema)
+        db.commit()
+        self._create_osm_datasets(db, schema, transform_sql("way", osm_srid, GlobalSettings.get_target_srid()))
+        for layer in ['greenness', 'water']:
+            refresh_subdivided_copy(db, schema, layer, get_subdivide_max_vertices(settings))
+        db.close()
+
+    def run_step(self, settings: dict):
+        h.info('importing osm')
+        h.log(f"using settings: {str(settings)}")
+        use_overpass_api: bool = False
+
+        schema = self.db_settings.entities.data_schema
+        directory = GlobalSettings.data_directory
+
+        # open database connection
+        h.info('open database connection')
+        db = PostgresConnection.from_settings_object(self.db_settings)
+        db.init_extensions_and_schema(schema)
+
+        # if needed, download OSM data
+        if not h.has_keys(settings, ['filename']):
+            h.info("no OSM file provided. Checking for Overpass API settings instead...")
+            if not h.has_any_key(settings, ['place_name', 'bbox']):
+                raise Exception("neither 'aoi_name' nor 'bbox' parameter specified for OSM download. Terminating.")
+            use_overpass_api = True
+            # start OSM import through overpass API
+            # import from bounding box
+            if h.has_keys(settings, ['bbox']):
+                self._load_osm_from_bbox(settings['bbox'], settings)
+            # import from place name
+            elif h.has_keys(settings, ['place_name']):
+                self._load_osm_from_placename(db, schema, directory, settings)
+
+        # import osm file
+        h.logBeginTask('import osm file')
+        db.drop_table("osm_point", schema=schema)
+        db.drop_table("osm_line", schema=schema)
+        db.drop_table("osm_polygon", schema=schema)
+        db.drop_table("osm_nodes", schema=schema)
+        db.drop_table("osm_rels", schema=schema)
+        db.drop_table("osm_roads", schema=schema)
+        db.drop_table("osm_ways", schema=schema)
+        db.commit()
+
+        filename = f"{GlobalSettings.osm_download_prefix}_{GlobalSettings.case_id}.xml"
+        if not use_overpass_api:
+            filename = settings['filename']
+        # optionally, only keep objects relevant for NetAScore before importing them with osm2pgsql
+        if h.has_keys(settings, ['prefilter']) and settings['prefilter']:
+            expressions = get_prefilter_expressions(settings)
+            filtered = f"{GlobalSettings.osm_download_prefix}_{GlobalSettings.case_id}_filtered.osm.pbf"
+            h.log(f"pre-filtering '{filename}' into '{filtered}'")
+            filter_osm(os.path.join(directory, filename), os.path.join(directory, filtered), expressions)
+            filename = filtered
+
+        # by default, osm2pgsql projects geometries to the target SRID during import - derived datasets and the network
+        # then use them as they are instead of reprojecting them one by one
+        target_srid = GlobalSettings.get_target_srid()
+        project_on_import = settings['project_on_import'] if h.has_keys(settings, ['project_on_import']) else True
+        # with the flex output, context datasets are filtered into separate tables during import (see 'netascore.lua')
+        use_flex = h.has_keys(settings, ['osm2pgsql_output']) and settings['osm2pgsql_output'] == 'flex'
+        updatable = h.has_keys(settings, ['updatable']) and settings['updatable']
+        if use_flex and updatable:
+            raise Exception("Import setting 'updatable' is only supported for the pgsql output ('osm2pgsql_output: pgsql').")
+        for dataset in OSM_FLEX_DATASETS:
+            db.drop_table(f"osm_{dataset}", schema=schema)
+        db.commit()
+        if use_flex:
+            import_osm_flex(db.connection_string, os.path.join(directory, filename), os.path.join('resources', 'netascore.lua'), schema, prefix='osm',
+                            srid=target_srid if project_on_import else None)
+            create_route_membership(db, schema, "planet_osm_rels")
+            # middle tables of the flex output (not prefixed)
+            for middle_table in ["planet_osm_nodes", "planet_osm_rels", "planet_osm_ways"]:
+                db.drop_table(middle_table, schema=schema)
+        else:
+            import_osm(db.connection_string, os.path.join(directory, filename), os.path.join('resources', 'default.style'), schema, prefix='osm',
+                       srid=target_srid if project_on_import else None)  # 12 m 35 s
+            create_route_membership(db, schema, "osm_rels")
+
+        # slim tables are only kept if the import should be updatable with OSM change files (see 'updatable')
+        if not updatable:
+            for table in ["osm_nodes", "osm_rels", "osm_roads", "osm_ways"]:
+                db.drop_table(table, schema=schema)
+        db.commit()
+        osm_srid = db.get_srid("osm_line", "way", schema)
+        h.logEndTask()
+
+        # geometry expression for the imported OSM data in the target SRID (reprojected only if not projected on import)
+        way = transform_sql("way", osm_srid, target_srid)
+
+        if use_flex:
+            for dataset, geometry_type in OSM_FLEX_DATASETS.items():
+                h.logBeginTask(f'create dataset "{dataset}"')
+                self._create_dataset_from_flex_table(db, schema, dataset, geometry_type, osm_srid, target_srid)
+                h.logEndTask()
+        else:
+            self._create_osm_datasets(db, schema, way)
+
+        # optionally, store subdivided copies of layers with large polygons for faster overlays
+        for layer in ['greenness', 'water']:
+            refresh_subdivided_copy(db, schema, layer, get_subdivide_max_vertices(settings))
+
         # close database connection
         h.log('close database connection')
         db.close()
 
 
+@contextmanager
+def import_run(db_settings: DbSettings):
+    """Records a new import run id for all tables of the data schema which are (re-)created within this context - part
+    of the table fingerprints if the fingerprint cache is enabled (see toolbox/fingerprint.py)."""
+    if not GlobalSettings.cache_enabled:
+        yield
+        return
+    schema = db_settings.entities.data_schema
+    db = PostgresConnection.from_settings_object(db_settings)
+    db.connect()
+    try:
+        before = table_versions(db, schema)
+        db.commit()
+        yield
+        record_import_run(db, schema, before)
+    finally:
+        db.close()
+
+
 def create_importer(db_settings: DbSettings, import_type: str):
     if import_type.lower() == InputType.GIP.value.lower():
         return GipImporter(db_settings)
@@ -0,0 +1,364 @@
+import io
+import re
+from dataclasses import dataclass
+from time import perf_counter as clock
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import toolbox.helper as h
+from core.index_step import INDEX_INDICATOR_COLUMNS, ModeProfile, _get_direction_columns, load_profiles
+from settings import DbSettings
+from toolbox.dbhelper import PostgresConnection
+from toolbox.fingerprint import hash_values
+
+# access columns of "network_edge_attributes" per mode (see profile settings "filter_access_<mode>")
+ACCESS_COLUMNS: Dict[str, List[str]] = {
+    "car": ["access_car_ft", "access_car_tf"],
+    "bike": ["access_bicycle_ft", "access_bicycle_tf"],
+    "walk": ["access_pedestrian_ft", "access_pedestrian_tf"],
+}
+
+_CATEGORICAL_TYPES = ["character varying", "character", "text"]
+
+# comparison operators of class-based indicator mappings (see "_build_sql_indicator_mapping_internal_")
+_CLASS_OPERATORS: Dict[str, Callable[[np.ndarray, float], np.ndarray]] = {
+    "": np.equal,
+    "e": np.equal,
+    "g": np.greater,
+    "ge": np.greater_equal,
+    "l": np.less,
+    "le": np.less_equal,
+    "ne": np.not_equal,
+}
+
+
+@dataclass
+class AttributeColumn:
+    """Column of the in-memory attribute matrix: either numeric values (NaN for NULL, booleans as 0/1) or
+    dictionary-encoded categorical values (codes into 'categories', -1 for NULL)."""
+    values: np.ndarray
+    categories: Optional[np.ndarray] = None
+
+    @property
+    def is_categorical(self) -> bool:
+        return self.categories is not None
+
+    def is_null(self) -> np.ndarray:
+        return self.values < 0 if self.is_categorical else np.isnan(self.values)
+
+    def where_category(self, category_mask: np.ndarray) -> np.ndarray:
+        # evaluates a condition given per category for all rows (NULL never matches)
+        return np.append(category_mask, False)[self.values]
+
+
+@dataclass
+class IndexResult:
+    """Index values of one profile per edge and direction (NaN for NULL)."""
+    profile_name: str
+    index_ft: np.ndarray
+    index_tf: np.ndarray
+    robustness_ft: np.ndarray
+    robustness_tf: np.ndarray
+
+    def summary(self) -> Dict[str, float]:
+        values = np.concatenate([self.index_ft, self.index_tf])
+        values = values[~np.isnan(values)]
+        robustness = np.concatenate([self.robustness_ft, self.robustness_tf])
+        robustness = robustness[~np.isnan(robustness)]
+        if len(values) == 0:
+            return {"count": 0}
+        q = np.quantile(values, [0.1, 0.25, 0.5, 0.75, 0.9])
+        return {
+            "count": int(len(values)),
+            "mean": float(values.mean()),
+            "std": float(values.std()),
+            "min": float(values.min()),
+            "p10": float(q[0]), "p25": float(q[1]), "median": float(q[2]), "p75": float(q[3]), "p90": float(q[4]),
+            "max": float(values.max()),
+            "robustness_mean": float(robustness.mean()) if len(robustness) else float("nan"),
+        }
+
+
+class AttributeMatrix:
+    """Columnar in-memory copy of "network_edge_attributes" for fast (re-)evaluation of mode profiles without
+    database round trips. Categorical columns are dictionary-encoded. Evaluated indicator mappings are cached, so
+    re-evaluating a profile with modified weights only re-computes the weighted sums."""
+
+    def __init__(self, edge_ids: np.ndarray, columns: Dict[str, AttributeColumn]):
+        self.edge_ids = edge_ids
+        self.columns = columns
+        self._mapping_cache: Dict[str, np.ndarray] = {}
+
+    @property
+    def size(self) -> int:
+        return len(self.edge_ids)
+
+    @staticmethod
+    def load(db: PostgresConnection, schema: str, table: str = "network_edge_attributes") -> 'AttributeMatrix':
+        h.logBeginTask(f'loading table "{schema}.{table}" into memory')
+        wanted = set([c for _, ft, tf in INDEX_INDICATOR_COLUMNS for c in [ft, tf]] + [c for cs in ACCESS_COLUMNS.values() for c in cs])
+        rows = db.query_all("""SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position""", (schema, table))
+        types = {name: data_type for name, data_type in rows if name in wanted}
+        if len(rows) == 0:
+            raise Exception(f'Table "{schema}.{table}" does not exist. Please run the attributes step first.')
+        missing = wanted - set(types)
+        if missing:
+            h.log(f"columns not available (treated as NULL): {', '.join(sorted(missing))}")
+        # transfer data using COPY (much faster than fetching rows)
+        buffer = io.StringIO()
+        db.cur.copy_expert(f"""COPY (SELECT edge_id, {', '.join(types)} FROM {schema}.{table} ORDER BY edge_id)
+            TO STDOUT WITH (FORMAT csv, HEADER true)""", buffer)
+        db.commit()
+        buffer.seek(0)
+        dtypes = {name: ("category" if t in _CATEGORICAL_TYPES else "float64") for name, t in types.items() if t != "boolean"}
+        df = pd.read_csv(buffer, dtype=dtypes, true_values=["t"], false_values=["f"], keep_default_na=False, na_values=[""])
+
+        columns: Dict[str, AttributeColumn] = {}
+        for name in wanted:
+            if name not in types:
+                columns[name] = AttributeColumn(np.full(len(df), np.nan))
+            elif types[name] in _CATEGORICAL_TYPES:
+                cat = df[name].cat
+                columns[name] = AttributeColumn(cat.codes.to_numpy(dtype=np.int32), cat.categories.to_numpy(dtype=str))
+            else:
+                columns[name] = AttributeColumn(pd.to_numeric(df[name].astype("float64"), errors="coerce").to_numpy())
+        matrix = AttributeMatrix(df["edge_id"].to_numpy(), columns)
+        h.info(f"loaded {matrix.size} edges")
+        h.logEndTask()
+        return matrix
+
+    def indicators(self, direction: str) -> Dict[str, AttributeColumn]:
+        return {name: self.columns[column] for name, column in _get_direction_columns(direction)}
+
+    def access(self, profile: ModeProfile) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        for mode, enabled in [("car", profile.access_car), ("bike", profile.access_bike), ("walk", profile.access_walk)]:
+            if enabled:
+                for column in ACCESS_COLUMNS[mode]:
+                    mask |= self.columns[column].values == 1
+        return mask
+
+    def evaluate_mapping(self, indicator_yml: dict, direction: str, force_default_value: bool = False, def_value=None) -> np.ndarray:
+        key = hash_values(direction, repr(indicator_yml), force_default_value, def_value)
+        if key not in self._mapping_cache:
+            self._mapping_cache[key] = _evaluate_mapping(indicator_yml, self.indicators(direction), self.size,
+                                                         force_default_value=force_default_value, def_value=def_value)
+        return self._mapping_cache[key]
+
+
+def _round(values: np.ndarray, digits: int = 4) -> np.ndarray:
+    # round half away from zero (as PostgreSQL's round for numeric values) - the tolerance compensates for floating point
+    # errors of values that are exactly halfway between two rounded values in (exact) numeric arithmetic
+    factor = 10 ** digits
+    return np.sign(values) * np.floor(np.abs(values) * factor + 0.5 + 1e-7) / factor
+
+
+def _condition(column: AttributeColumn, key, k: str, full_name: str) -> np.ndarray:
+    # row mask for a single key of an indicator mapping - mirrors the SQL generated by "_build_sql_indicator_mapping_internal_"
+    if key is None:
+        return column.is_null()
+    kstr = str(key)
+    if kstr.startswith("{") and kstr.endswith("}"):
+        slist = kstr[1:-1].split(',')
+        if sum([1 for val in slist if not h.str_is_numeric_only(val)]) > 0:
+            values = [h.get_safe_string(v.strip()) for v in slist]
+            if column.is_categorical:
+                return column.where_category(np.isin(column.categories, values))
+            return np.zeros(len(column.values), dtype=bool)
+        values = [h.str_to_numeric(v.strip()) for v in slist]
+        if column.is_categorical:
+            return column.where_category(np.isin(column.categories, [str(v) for v in values]))
+        return np.isin(column.values, values)
+    if k == "mapping":
+        if column.is_categorical:
+            value = str(key).lower() if type(key) == bool else h.get_safe_string(key)
+            return column.where_category(column.categories == value)
+        if h.is_numeric(key) or type(key) == bool:
+            return column.values == float(key)
+        return np.zeros(len(column.values), dtype=bool)
+    # classes
+    cv = h.str_to_numeric(kstr)
+    if cv is None:
+        raise Exception(f"For class-based indicator value assignments, a numeric class value must be specified. Indicator '{full_name}', key '{key}'.")
+    op = _CLASS_OPERATORS.get(re.sub("[^a-zA-Z]", "", kstr), np.equal)
+    if column.is_categorical:
+        return np.zeros(len(column.values), dtype=bool)
+    with np.errstate(invalid="ignore"):
+        return op(column.values, cv)
+
+
+def _evaluate_mapping(indicator_yml: dict, columns: Dict[str, AttributeColumn], size: int, name_hierarchy: str = "",
+                      force_default_value: bool = False, def_value=None) -> np.ndarray:
+    # vectorized evaluation of an indicator mapping (first matching key wins, NaN for NULL) - same semantics as the
+    # SQL CASE expression generated by "_build_sql_indicator_mapping_internal_"
+    indicator_name = h.get_safe_name(indicator_yml.get('indicator'))
+    full_name = name_hierarchy + indicator_name
+    if indicator_name not in columns:
+        raise Exception(f"Unknown indicator '{full_name}'. Please update your mode profile file accordingly.")
+    column = columns[indicator_name]
+    keys = [k for k in indicator_yml.keys() if k not in ['indicator', 'output', 'description']]
+    if len(keys) != 1:
+        raise Exception(f"Exactly one indicator mapping key is needed for indicator '{full_name}'. Please update your mode profile file accordingly.")
+    k = keys[0]
+    if k not in ["mapping", "classes"]:
+        raise Exception(f"You provided an unknown indicator mapping '{k}' for indicator '{full_name}'. Please update your mode profile file accordingly.")
+    contents = indicator_yml.get(k)
+
+    result = np.full(size, np.nan)
+    assigned = np.zeros(size, dtype=bool)
+    add_default_value = force_default_value
+    default_value = def_value
+
+    def value_of(v):
+        if type(v) == dict:
+            return _evaluate_mapping(v, columns, size, f"{full_name}.", force_default_value, def_value)
+        if v is None:
+            return np.nan
+        if not h.is_numeric(v):
+            raise Exception(f"Only numeric value assignments are allowed for indicator mappings. Please update indicator '{full_name}'.")
+        return float(v)
+
+    for key in contents:
+        v = value_of(contents[key])
+        if key is not None and str(key) == "_default_":
+            add_default_value = True
+            default_value = v
+            continue
+        mask = _condition(column, key, k, full_name) & ~assigned
+        result[mask] = v[mask] if isinstance(v, np.ndarray) else v
+        assigned |= mask
+    if add_default_value and default_value is not None:
+        rest = ~assigned
+        result[rest] = default_value[rest] if isinstance(default_value, np.ndarray) else default_value
+    return result
+
+
+def evaluate_direction(matrix: AttributeMatrix, profile: dict, direction: str, weights: dict = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Evaluates a mode profile for one direction - returns index and index robustness per edge (same semantics as the
+    SQL index engines, computed in floating point)."""
+    weights = profile['weights'] if weights is None else weights
+    columns = matrix.indicators(direction)
+    n = matrix.size
+    names = [name for name, _, _ in INDEX_INDICATOR_COLUMNS]
+
+    # weights per edge (NaN: not weighted), index overrides
+    w: Dict[str, np.ndarray] = {}
+    for name in names:
+        weight = weights.get(name)
+        if weight is not None and not h.is_numeric(weight):
+            raise Exception(f"Only numeric values are allowed as indicator weights. Please update the weight of indicator '{name}'.")
+        w[name] = np.full(n, np.nan if weight is None else float(weight))
+    index_override = np.full(n, np.nan)
+    overridden = np.zeros(n, dtype=bool)
+    for override in profile['overrides']:
+        out = override.get('output') or {}
+        values = matrix.evaluate_mapping(override, direction, force_default_value=True, def_value=-1)
+        with np.errstate(invalid="ignore"):
+            applies = (values >= 0) & ~overridden
+        if out.get('type') == "index":
+            index_override[applies] = values[applies]
+            overridden |= applies
+        elif out.get('type') == "weight":
+            targets = out.get('for', [])
+            for target in [targets] if type(targets) == str else targets:
+                target = h.get_safe_name(target)
+                if target not in w:
+                    raise Exception(f"Unknown override target '{target}_weight'.")
+                w[target][applies] = values[applies]
+        else:
+            raise Exception(f"Unknown output type '{out.get('type')}' provided in overrides definition for '{override.get('indicator')}'.")
+
+    included = {name: ~columns[name].is_null() & ~np.isnan(w[name]) for name in names}
+    weights_total = np.sum([np.nan_to_num(w[name]) for name in names], axis=0)
+    weights_sum = np.sum([np.where(included[name], w[name], 0) for name in names], axis=0)
+
+    index = np.zeros(n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for indicator in profile['indicator_mapping']:
+            name = h.get_safe_name(indicator.get('indicator'))
+            mapped = matrix.evaluate_mapping(indicator, direction)
+            index += np.where(included[name], mapped * (w[name] / weights_sum), 0)
+        index = np.where(weights_sum > 0, _round(index), np.nan)
+        robustness = _round(weights_sum / weights_total)
+    index[overridden] = index_override[overridden]
+    robustness[overridden] = np.nan
+    return index, robustness
+
+
+def evaluate_profile(matrix: AttributeMatrix, profile: ModeProfile, weights: dict = None) -> IndexResult:
+    """Evaluates a mode profile (optionally with modified weights) for both directions of all edges."""
+    index_ft, robustness_ft = evaluate_direction(matrix, profile.profile, "ft", weights)
+    index_tf, robustness_tf = evaluate_direction(matrix, profile.profile, "tf", weights)
+    no_access = ~matrix.access(profile)
+    for values in [index_ft, index_tf, robustness_ft, robustness_tf]:
+        values[no_access] = np.nan
+    return IndexResult(profile.profile_name, index_ft, index_tf, robustness_ft, robustness_tf)
+
+
+def write_index(db: PostgresConnection, schema: str, matrix: AttributeMatrix, result: IndexResult):
+    """Writes the index columns of the given result to "network_edge_index" (replacing existing columns of the profile)."""
+    h.logBeginTask(f'writing index columns for profile "{result.profile_name}"')
+    db.ex("DROP TABLE IF EXISTS index_inmemory; CREATE TABLE index_inmemory (edge_id bigint, index_ft numeric, index_tf numeric, "
+          "index_robustness_ft numeric, index_robustness_tf numeric);")
+    buffer = io.StringIO()
+    pd.DataFrame({
+        "edge_id": matrix.edge_ids,
+        "index_ft": result.index_ft, "index_tf": result.index_tf,
+        "index_robustness_ft": result.robustness_ft, "index_robustness_tf": result.robustness_tf,
+    }).to_csv(buffer, index=False, header=False, na_rep="", float_format="%.4f")
+    buffer.seek(0)
+    db.cur.copy_expert("COPY index_inmemory FROM STDIN WITH (FORMAT csv)", buffer)
+    db.commit()
+    db.execute_template_sql_from_file("index_write", {'schema_network': schema, 'profile_name': result.profile_name})
+    h.logEndTask()
+
+
+def _print_summary(result: IndexResult, elapsed: float):
+    s = result.summary()
+    if s["count"] == 0:
+        h.majorInfo(f'profile "{result.profile_name}": no index values (evaluated in {h.secondsToStr(elapsed, detailed=True)})')
+        return
+    h.majorInfo(f'profile "{result.profile_name}" (evaluated in {h.secondsToStr(elapsed, detailed=True)}): '
+                f'n={s["count"]}, mean={s["mean"]:.4f}, std={s["std"]:.4f}, min={s["min"]:.4f}, p10={s["p10"]:.4f}, '
+                f'p25={s["p25"]:.4f}, median={s["median"]:.4f}, p75={s["p75"]:.4f}, p90={s["p90"]:.4f}, max={s["max"]:.4f}, '
+                f'robustness_mean={s["robustness_mean"]:.4f}')
+
+
+def run_whatif(db_settings: DbSettings, base_path: str, profile_definitions: List[dict], write: bool = False, interactive: bool = False):
+    """What-if mode: loads "network_edge_attributes" once and evaluates the given mode profiles in memory. Index values
+    are only written to the database if requested. In interactive mode, mode profile files are re-read and re-evaluated
+    on request, so weights can be tweaked without re-running any pipeline step. Returns True if index values were written."""
+    schema = db_settings.entities.network_schema
+    h.info('open database connection')
+    db = PostgresConnection.from_settings_object(db_settings)
+    db.schema = schema
+    matrix = AttributeMatrix.load(db, schema)
+
+    results: List[IndexResult] = []
+    while True:
+        results = []
+        for profile in load_profiles(base_path, profile_definitions):
+            start = clock()
+            result = evaluate_profile(matrix, profile)
+            _print_summary(result, clock() - start)
+            results.append(result)
+        if not interactive:
+            break
+        command = input("[Enter] re-evaluate (re-read profile files), [w] write index to database, [q] quit: ").strip().lower()
+        if command == "q":
+            break
+        if command == "w":
+            write = True
+            break
+    if write:
+        for result in results:
+            write_index(db, schema, matrix, result)
+        h.logBeginTask('create tables "export_edge" and "export_node"')
+        db.execute_template_sql_from_file("export", {'schema_network': schema})
+        h.logEndTask()
+    h.log('close database connection')
+    db.close()
+    return write
@@ -1,11 +1,14 @@
+import copy
 import os
 import re
 import yaml
 
 import toolbox.helper as h
-from settings import DbSettings
+from settings import DbSettings, GlobalSettings
 from toolbox.dbhelper import PostgresConnection
-from typing import List
+from toolbox.fingerprint import TableFingerprints, hash_values, invalidate_fingerprint, is_unchanged, store_fingerprint, \
+    template_fingerprint
+from typing import Dict, List, Tuple, Union
 
 
 class ProfileDefinition:
@@ -40,7 +43,8 @@ class ModeProfile:
 def load_profiles(base_path: str, profile_definitions: dict):
     return [ModeProfile(base_path, definition) for definition in profile_definitions]
 
-def _build_sql_overrides(overrides_yml: dict) -> str:
+def _compile_override(overrides_yml: dict, column_prefix: str = "") -> Tuple[str, List[str]]:
+    # returns the SQL value expression of an override (-1 if not applicable) and its assignment targets ("index" or "<indicator>_weight")
     # load yml: extract output details and prepare target variable names
     indicator_name = h.get_safe_name(overrides_yml.get('indicator'))
     h.require_keys(overrides_yml, ["output"], f"No 'output' key provided in overrides definition for '{indicator_name}'.")
@@ -60,30 +64,37 @@ def _build_sql_overrides(overrides_yml: dict) -> str:
                     assignment_targets.append(f"{h.get_safe_name(t)}_weight")
     else:
         raise Exception(f"Unknown output type '{out_type}' provided in overrides definition for '{indicator_name}'.")
+    # delete output details and description from yml (for function compatibility)
+    del overrides_yml['output']
+    overrides_yml.pop('description', None)
+    # compile value mappings
+    value_assignments = _build_sql_indicator_mapping_internal_(overrides_yml, "", force_default_value = True, def_value = -1,
+                                                               column_prefix = column_prefix)
+    return value_assignments, assignment_targets
+
+def _build_sql_overrides(overrides_yml: dict) -> str:
+    value_assignments, assignment_targets = _compile_override(overrides_yml)
     # compile value assignment SQL
     assignment_sql = ""
     for a_target in assignment_targets:
         assignment_sql += f"{a_target} := temp; \n"
-    # delete output details and description from yml (for function compatibility)
-    del overrides_yml['output']
-    del overrides_yml['description']
-    # compile value mappings
-    value_assignments = _build_sql_indicator_mapping_internal_(overrides_yml, "", force_default_value = True, def_value = -1)
     # compile full indicator SQL around indicator mapping code
     sql: str = f"""
         temp :=
             {value_assignments};
         IF NOT temp < 0 THEN
             {assignment_sql}
-            {"return; " if out_type == "index" else ""}
+            {"return; " if assignment_targets == ["index"] else ""}
         END IF;
         """
     # compile result into template
     return sql
 
-def _build_sql_indicator_mapping_internal_(indicator_yml: dict, name_hierarchy: str = "", force_default_value: bool = False, def_value = None) -> str:
+def _build_sql_indicator_mapping_internal_(indicator_yml: dict, name_hierarchy: str = "", force_default_value: bool = False, def_value = None,
+                                           column_prefix: str = "") -> str:
     indicator_name = h.get_safe_name(indicator_yml.get('indicator'))
     full_name = name_hierarchy + indicator_name
+    column = column_prefix + indicator_name
     h.debugLog(f"parsing YAML for ind. '{full_name}' \tRaw input: {indicator_yml}")
     value_assignments = "CASE \n"
     add_default_value: bool = force_default_value
@@ -105,7 +116,7 @@ def _build_sql_indicator_mapping_internal_(indicator_yml: dict, name_hierarchy:
         h.debugLog(f"got mapping: {key}: {v} (type: {type(key)}:{type(v)})")
         if type(v) == dict:
             # parse dict recursively -> add result to value_assignments (nested CASE...END)
-            v = _build_sql_indicator_mapping_internal_(v, f"{full_name}.", force_default_value, def_value)
+            v = _build_sql_indicator_mapping_internal_(v, f"{full_name}.", force_default_value, def_value, column_prefix)
         elif v is None:
             v = "NULL"
         elif not h.is_numeric(v):
@@ -113,7 +124,7 @@ def _build_sql_indicator_mapping_internal_(indicator_yml: dict, name_hierarchy:
         # handle special cases and (in last step) default cases for key types/values
         # special case of NULL value key
         if key is None:
-            value_assignments += f"WHEN {indicator_name} IS NULL THEN {v}\n"
+            value_assignments += f"WHEN {column} IS NULL THEN {v}\n"
         # handle special case of default value (added last)
         elif str(key) == "_default_":
             add_default_value = True
@@ -127,16 +138,19 @@ def _build_sql_indicator_mapping_internal_(indicator_yml: dict, name_hierarchy:
             cnt = sum([1 for val in slist if not h.str_is_numeric_only(val)])
             if cnt > 0:
                 # String
-                value_assignments += f"""WHEN {indicator_name} IN ('{"', '".join([h.get_safe_string(v.strip()) for v in slist])}') THEN {v}\n"""
+                value_assignments += f"""WHEN {column} IN ('{"', '".join([h.get_safe_string(v.strip()) for v in slist])}') THEN {v}\n"""
             else:
                 # numeric
-                value_assignments += f"WHEN {indicator_name} IN ({', '.join([str(h.str_to_numeric(v.strip())) for v in slist])}) THEN {v}\n"
+                value_assignments += f"WHEN {column} IN ({', '.join([str(h.str_to_numeric(v.strip())) for v in slist])}) THEN {v}\n"
         # specific handling depending on type (mapping / classes)
         elif k == "mapping":
-            if h.is_numeric(key) or type(key) == bool:
-                value_assignments += f"WHEN {indicator_name} = {key} THEN {v}\n"
+            if type(key) == bool:
+                # compared as text: boolean (e.g. "water") and categorical (e.g. "parking") columns
+                value_assignments += f"WHEN {column}::text = '{str(key).lower()}' THEN {v}\n"
+            elif h.is_numeric(key):
+                value_assignments += f"WHEN {column} = {key} THEN {v}\n"
             else:
-                value_assignments += f"WHEN {indicator_name} = '{h.get_safe_string(key)}' THEN {v}\n"
+                value_assignments += f"WHEN {column} = '{h.get_safe_string(key)}' THEN {v}\n"
         elif k == "classes":
             # split key into op. and class value
             kstr = str(key)
@@ -158,7 +172,7 @@ def _build_sql_indicator_mapping_internal_(indicator_yml: dict, name_hierarchy:
             elif opstr == "ne":
                 op = "<>"
             # append current assignment
-            value_assignments += f"WHEN {indicator_name} {op} {cv} THEN {v}\n"        
+            value_assignments += f"WHEN {column} {op} {cv} THEN {v}\n"        
         else:
             raise Exception(f"Unexpected configuration received for indicator '{indicator_name}', key '{key}'.")
     
@@ -183,6 +197,174 @@ def _build_sql_indicator_mapping(indicator_yml: dict) -> str:
         END IF;"""
     return sql
 
+# indicators used for index computation with their "network_edge_attributes" columns per direction (ft, tf) - in the
+# order of the "calculate_index" function arguments
+INDEX_INDICATOR_COLUMNS: List[Tuple[str, str, str]] = [
+    ("bicycle_infrastructure", "bicycle_infrastructure_ft", "bicycle_infrastructure_tf"),
+    ("pedestrian_infrastructure", "pedestrian_infrastructure_ft", "pedestrian_infrastructure_tf"),
+    ("designated_route", "designated_route_ft", "designated_route_tf"),
+    ("road_category", "road_category", "road_category"),
+    ("max_speed", "max_speed_ft", "max_speed_tf"),
+    ("max_speed_greatest", "max_speed_greatest", "max_speed_greatest"),
+    ("parking", "parking_ft", "parking_tf"),
+    ("pavement", "pavement", "pavement"),
+    ("width", "width", "width"),
+    ("gradient", "gradient_ft", "gradient_tf"),
+    ("number_lanes", "number_lanes_ft", "number_lanes_tf"),
+    ("facilities", "facilities", "facilities"),
+    ("crossings", "crossings", "crossings"),
+    ("buildings", "buildings", "buildings"),
+    ("greenness", "greenness", "greenness"),
+    ("water", "water", "water"),
+    ("noise", "noise", "noise"),
+]
+
+INDEX_ENGINES = ["sql", "function"]
+
+# "compute_explanation" value for materializing explanations as fixed-width arrays instead of JSON
+EXPLANATION_COMPACT = "compact"
+
+def _get_direction_columns(direction: str) -> List[Tuple[str, str]]:
+    # direction None refers to direction-independent columns named by indicator (distinct attribute tuples, see "memoize")
+    if direction is None:
+        return [(name, name) for name, _, _ in INDEX_INDICATOR_COLUMNS]
+    if direction not in ["ft", "tf"]:
+        raise Exception(f"Unknown direction '{direction}'.")
+    return [(name, ft if direction == "ft" else tf) for name, ft, tf in INDEX_INDICATOR_COLUMNS]
+
+def _build_sql_weight(weights: dict, indicator: str) -> str:
+    weight = weights.get(indicator)
+    if weight is None:
+        return "NULL::numeric"
+    if not h.is_numeric(weight):
+        raise Exception(f"Only numeric values are allowed as indicator weights. Please update the weight of indicator '{indicator}'.")
+    return f"{weight}::numeric"
+
+def _get_index_function_name(profile_name: str) -> str:
+    return f"calculate_index_{h.get_safe_name(profile_name)}"
+
+def _build_index_function_params(p: 'ModeProfile', compute_explanation: bool) -> dict:
+    # template parameters of the profile-specific index function "calculate_index_<profile>" (see "calculate_index")
+    profile_name = p.profile_name
+    # parse profile definition: generate SQL for indicator value assignments
+    h.info(f'parsing indicator value mapping for profile "{profile_name}"...')
+    indicator_mapping_sql = ""
+    for indicator in copy.deepcopy(p.profile['indicator_mapping']):
+        indicator_mapping_sql += _build_sql_indicator_mapping(indicator)
+    h.debugLog(f"compiled indicator mapping SQL: \n\n{indicator_mapping_sql}")
+    # parse profile definition: generate SQL for overrides (indicator weights or index)
+    h.info(f'parsing value overrides for profile "{profile_name}"...')
+    overrides_sql = ""
+    for override in copy.deepcopy(p.profile['overrides']):
+        overrides_sql += _build_sql_overrides(override)
+    h.debugLog(f"compiled overrides SQL: \n\n{overrides_sql}")
+    return {
+        'function_name': _get_index_function_name(profile_name),
+        'compute_explanation': compute_explanation,
+        'indicator_mappings': indicator_mapping_sql,
+        'overrides': overrides_sql
+    }
+
+def _build_sql_index_function_call(function_name: str, weights: dict, direction: str) -> str:
+    # call of the profile-specific PL/pgSQL function "calculate_index_<profile>" for one direction (row-by-row evaluation)
+    args = ",\n            ".join([f"b.{column}, {_build_sql_weight(weights, name)}" for name, column in _get_direction_columns(direction)])
+    return f"""{function_name}(
+            {args}
+        )"""
+
+def _build_sql_index_inline(profile: dict, weights: dict, direction: str, compute_explanation: Union[bool, str]) -> str:
+    # compiles the mode profile to a plain SQL subquery (set-based evaluation) returning the same columns as the index
+    # function: index, index_robustness, index_explanation
+    profile = copy.deepcopy(profile)
+    columns = _get_direction_columns(direction)
+    names = [name for name, _ in columns]
+
+    # overrides: an index override ends evaluation (first applicable one wins), for weight overrides the last applicable one wins
+    index_overrides: List[str] = []
+    weight_overrides: Dict[str, List[str]] = {name: [] for name in names}
+    for override in profile['overrides']:
+        value, targets = _compile_override(override, "v.")
+        for target in targets:
+            if target == "index":
+                index_overrides.append(value)
+            elif target[:-len("_weight")] in weight_overrides:
+                weight_overrides[target[:-len("_weight")]].append(value)
+            else:
+                raise Exception(f"Unknown override target '{target}'.")
+
+    def first_applicable(values: List[str], default: str) -> str:
+        if not values:
+            return default
+        cases = "".join([f"WHEN ({v}) >= 0 THEN ({v})::numeric \n" for v in values])
+        return f"CASE \n{cases}ELSE {default} END"
+
+    weights_sql = ",\n".join([f"{first_applicable(list(reversed(weight_overrides[name])), _build_sql_weight(weights, name))} AS {name}_weight"
+                              for name in names])
+    weights_total_sql = " +\n".join([f"coalesce(o.{name}_weight, 0)" for name in names])
+    weights_sum_sql = " +\n".join([f"CASE WHEN v.{name} IS NOT NULL AND o.{name}_weight IS NOT NULL THEN o.{name}_weight ELSE 0 END"
+                                    for name in names])
+
+    # indicator mappings: weighted indicator value per mapped indicator (NULL if the indicator is not used for this edge)
+    terms: List[Tuple[str, str]] = []
+    for i, indicator in enumerate(profile['indicator_mapping']):
+        name = h.get_safe_name(indicator.get('indicator'))
+        value = _build_sql_indicator_mapping_internal_(indicator, column_prefix="v.")
+        terms.append((name, f"""CASE WHEN s.weights_sum > 0 AND v.{name} IS NOT NULL AND o.{name}_weight IS NOT NULL
+    THEN ({value}) * (o.{name}_weight / s.weights_sum) END AS t{i}"""))
+    included = lambda name: f"v.{name} IS NOT NULL AND o.{name}_weight IS NOT NULL"
+    index_sql = "0" + "".join([f" +\n(CASE WHEN {included(name)} THEN t.t{i} ELSE 0 END)" for i, (name, _) in enumerate(terms)])
+    terms_sql = ",\n".join([term for _, term in terms]) or "NULL AS t"
+
+    explanation_sql = "NULL::json"
+    if compute_explanation == EXPLANATION_COMPACT:
+        # fixed-width encoding: contribution per indicator (in the order of INDEX_INDICATOR_COLUMNS) in 1/10000
+        term_index = {name: i for i, (name, _) in enumerate(terms)}
+        contributions = ", ".join([f"CASE WHEN {included(name)} THEN round(t.t{term_index[name]} * 10000)::smallint END"
+                                   if name in term_index else "NULL::smallint" for name in names])
+        explanation_sql = f"""CASE WHEN o.index_override IS NULL AND s.weights_sum > 0 THEN ARRAY[{contributions}] END"""
+    elif compute_explanation and terms:
+        explanation_values = ",\n".join([f"('{name}', t.t{i}, {included(name)})" for i, (name, _) in enumerate(terms)])
+        explanation_sql = f"""CASE WHEN o.index_override IS NULL AND s.weights_sum > 0 THEN (
+    SELECT json_object_agg(e.indicator, round(e.weight, 4) ORDER BY e.weight DESC, e.indicator)
+    FROM (VALUES {explanation_values}) e(indicator, weight, included)
+    WHERE e.included
+) END"""
+
+    values_sql = ",\n".join([f"b.{column} AS {name}" for name, column in columns])
+    return f"""(
+SELECT CASE WHEN o.index_override IS NOT NULL THEN o.index_override
+            WHEN s.weights_sum > 0 THEN round({index_sql}, 4)
+       END AS index,
+       CASE WHEN o.index_override IS NULL THEN round(s.weights_sum / s.weights_total, 4) END AS index_robustness,
+       {explanation_sql} AS index_explanation
+FROM (SELECT {values_sql}) v
+    CROSS JOIN LATERAL (SELECT {first_applicable(index_overrides, "NULL::numeric")} AS index_override,
+{weights_sql}) o
+    CROSS JOIN LATERAL (SELECT {weights_total_sql} AS weights_total,
+{weights_sum_sql} AS weights_sum) s
+    CROSS JOIN LATERAL (SELECT {terms_sql}) t
+)"""
+
+def _get_explanation_function_name(profile_name: str) -> str:
+    return f"explain_index_{h.get_safe_name(profile_name)}"
+
+def explain_index(db: PostgresConnection, profile_name: str, edge_ids: List[int]) -> List[tuple]:
+    """Explains the index of the given edges for a profile (computed on demand from "network_edge_attributes"). Returns
+    rows of (edge_id, direction, index, index_robustness, index_explanation) - the explanation contains the weighted
+    contribution of each indicator. Requires the index step to have been run for the profile."""
+    return db.query_all(f"SELECT * FROM {_get_explanation_function_name(profile_name)}(%s::bigint[])", (list(edge_ids),))
+
+def _compare_index_engines(db: PostgresConnection, profile_name: str, params: dict):
+    h.info(f'comparing index engines for profile "{profile_name}"...')
+    db.execute_template_sql_from_file("index_compare", params)
+    differences = db.query_one("SELECT count(*) FROM network_edge_index_compare")[0]
+    if differences > 0:
+        raise Exception(f'Index engines yield different results for profile "{profile_name}" ({differences} edge directions). '
+                        f'Please see table "network_edge_index_compare" for details.')
+    db.ex("DROP TABLE network_edge_index_compare")
+    db.commit()
+    h.info(f'index engines yield identical results for profile "{profile_name}"')
+
 def generate_index(db_settings: DbSettings, profiles: List[ModeProfile], settings: dict):
     schema = db_settings.entities.network_schema
 
@@ -197,46 +379,122 @@ def generate_index(db_settings: DbSettings, profiles: List[ModeProfile], setting
     # create functions
     ## this now happens in the "calculate index step" (re-defining functions based on mode profile and settings)
 
-    # calculate index
-    h.logBeginTask("compute index columns for given profiles")
-    if db.handle_conflicting_output_tables(['network_edge_index']):
-        for p in profiles:
-            profile_name = p.profile_name
-            indicator_weights = p.profile['weights']
-            # parse profile definition: generate SQL for indicator value assignments
-            h.info(f'parsing indicator value mapping for profile "{profile_name}"...')
-            indicator_mapping_sql = ""
-            for indicator in p.profile['indicator_mapping']:
-                indicator_mapping_sql += _build_sql_indicator_mapping(indicator)
-            h.debugLog(f"compiled indicator mapping SQL: \n\n{indicator_mapping_sql}")
-            # parse profile definition: generate SQL for overrides (indicator weights or index)
-            h.info(f'parsing value overrides for profile "{profile_name}"...')
-            overrides_sql = ""
-            for override in p.profile['overrides']:
-                overrides_sql += _build_sql_overrides(override)
-            h.debugLog(f"compiled overrides SQL: \n\n{overrides_sql}")
-            
-            # profile-specific function registration
-            h.info(f'register index function for profile "{profile_name}"...')
-            f_params = {
-                'compute_explanation': settings and h.has_keys(settings, ['compute_explanation']) and settings['compute_explanation'],
-                'indicator_mappings': indicator_mapping_sql,
-                'overrides': overrides_sql
-            }
-            db.execute_template_sql_from_file("calculate_index", f_params, template_subdir="sql/functions/")
-            # calculate index for currrent profile
-            h.info('calculate index_' + profile_name)
-            params = {
+    # index engine: mode profiles compiled to inline SQL ("sql", default) or evaluated by a PL/pgSQL function per profile
+    engine = settings.get('engine', 'sql') if settings else 'sql'
+    if engine not in INDEX_ENGINES:
+        raise Exception(f"Unknown index engine '{engine}'. Supported values: {', '.join(INDEX_ENGINES)}.")
+    compare_engines = bool(settings and h.has_keys(settings, ['compare_engines']) and settings['compare_engines'])
+    # explanations are available on demand (see "explain_index") - materializing them for all edges is optional
+    compute_explanation = settings.get('compute_explanation', False) if settings else False
+    if compute_explanation not in [True, False, EXPLANATION_COMPACT]:
+        raise Exception(f"Unknown value '{compute_explanation}' for 'compute_explanation'. Supported values: true, false, {EXPLANATION_COMPACT}.")
+    if compute_explanation == EXPLANATION_COMPACT and engine != "sql":
+        raise Exception("Compact explanations are only supported by the index engine 'sql'.")
+    json_explanation = compute_explanation is True
+    memoize = bool(settings and h.has_keys(settings, ['memoize']) and settings['memoize'])
+    h.info(f'using index engine "{engine}"' + (" (evaluated per distinct attribute combination)" if memoize else ""))
+
+    # compile index function and index SQL parameters for all profiles
+    profile_params = []
+    for p in profiles:
+        profile_name = p.profile_name
+        indicator_weights = p.profile['weights']
+        f_params = _build_index_function_params(p, json_explanation)
+        function_name = f_params['function_name']
+        # index expressions per direction for the selected engine
+        # (direction None: expression for a distinct attribute combination, used if "memoize" is enabled)
+        directions = ["ft", "tf", None]
+        index_function = {d: _build_sql_index_function_call(function_name, indicator_weights, d) for d in directions}
+        # inline SQL is compiled at most once per direction and explanation mode
+        inline_sql: Dict[Tuple[str, Union[bool, str]], str] = {}
+
+        def index_inline(direction: str, explanation: Union[bool, str]) -> str:
+            if (direction, explanation) not in inline_sql:
+                inline_sql[(direction, explanation)] = _build_sql_index_inline(p.profile, indicator_weights, direction, explanation)
+            return inline_sql[(direction, explanation)]
+
+        index_sql = {}
+        if engine == "sql" or compare_engines:
+            h.info(f'compiling index SQL for profile "{profile_name}"...')
+            index_sql = {d: index_inline(d, compute_explanation) for d in directions}
+            h.debugLog(f"compiled index SQL (ft): \n\n{index_sql['ft']}")
+        index_expressions = index_sql if engine == "sql" else index_function
+        profile_index_params = {
+            'profile_name': profile_name,
+            'access_car': p.access_car,
+            'access_bike': p.access_bike,
+            'access_walk': p.access_walk,
+            'index_ft': index_expressions['ft'],
+            'index_tf': index_expressions['tf'],
+            'index': index_expressions[None],
+        }
+        compare_params = None
+        if compare_engines:
+            compare_sql = index_sql if compute_explanation != EXPLANATION_COMPACT else \
+                {d: index_inline(d, False) for d in ["ft", "tf"]}
+            compare_params = {
                 'schema_network': schema,
-                'profile_name': profile_name,
-                'compute_explanation': settings and h.has_keys(settings, ['compute_explanation']) and settings['compute_explanation'],
-                'access_car': p.access_car,
-                'access_bike': p.access_bike,
-                'access_walk': p.access_walk,
+                'index_function_ft': index_function['ft'],
+                'index_function_tf': index_function['tf'],
+                'index_sql_ft': compare_sql['ft'],
+                'index_sql_tf': compare_sql['tf'],
             }
-            params.update(indicator_weights)
-            print(params)
-            db.execute_template_sql_from_file("index", params)
+        # on-demand explanation function (always based on the inline SQL of the profile)
+        explain_params = {
+            'schema_network': schema,
+            'function_name': _get_explanation_function_name(profile_name),
+            'access_car': p.access_car,
+            'access_bike': p.access_bike,
+            'access_walk': p.access_walk,
+            'index_ft': index_inline("ft", True),
+            'index_tf': index_inline("tf", True),
+        }
+        profile_params.append((profile_name, f_params, profile_index_params, compare_params, explain_params))
+
+    # all profiles are computed in a single pass over the attributes table
+    params = {
+        'schema_network': schema,
+        'compute_explanation': compute_explanation,
+        'memoize': memoize,
+        'columns': INDEX_INDICATOR_COLUMNS,
+        'profiles': [profile_index_params for _, _, profile_index_params, _, _ in profile_params],
+    }
+
+    # skip index computation if neither the attributes nor the profiles changed since the last run
+    fingerprint = None
+    if GlobalSettings.cache_enabled:
+        tables = TableFingerprints(db, [schema], GlobalSettings.cache_content_hash)
+        fingerprint = hash_values([tables.get(t) for t in ['network_edge', 'network_edge_attributes']],
+                                  [template_fingerprint("calculate_index", f_params, "sql/functions/") for _, f_params, _, _, _ in profile_params],
+                                  template_fingerprint("index", params))
+
+    # calculate index
+    h.logBeginTask("compute index columns for given profiles")
+    if fingerprint and is_unchanged(db, schema, "index", fingerprint, ['network_edge_index']):
+        h.majorInfo("inputs unchanged since the last run - skipping index computation")
+    elif db.handle_conflicting_output_tables(['network_edge_index']):
+        if fingerprint:
+            invalidate_fingerprint(db, schema, "index")
+        for profile_name, f_params, _, compare_params, _ in profile_params:
+            # profile-specific function registration (only needed if the function is evaluated)
+            if engine == "function" or compare_engines:
+                h.info(f'register index function for profile "{profile_name}"...')
+                db.execute_template_sql_from_file("calculate_index", f_params, template_subdir="sql/functions/")
+            # optionally verify that both engines yield identical results for the current profile
+            if compare_engines:
+                _compare_index_engines(db, profile_name, compare_params)
+        # calculate index for all profiles
+        h.info(f"calculate index for profiles: {', '.join(name for name, _, _, _, _ in profile_params)}")
+        db.execute_template_sql_from_file("index", params)
+        if fingerprint:
+            store_fingerprint(db, schema, "index", fingerprint)
+    h.logEndTask()
+
+    # register functions for on-demand explanations
+    h.logBeginTask("register index explanation functions")
+    for profile_name, _, _, _, explain_params in profile_params:
+        h.info(f'register function "{explain_params["function_name"]}" for profile "{profile_name}"...')
+        db.execute_template_sql_from_file("explain_index", explain_params, template_subdir="sql/functions/")
     h.logEndTask()
 
     # create tables "edges" and "nodes"
@@ -0,0 +1,284 @@
+import itertools
+import os
+from dataclasses import dataclass
+from time import perf_counter as clock
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+import toolbox.helper as h
+from core.index_inmemory import AttributeColumn, AttributeMatrix, _round
+from core.index_step import INDEX_INDICATOR_COLUMNS, ModeProfile, load_profiles
+from settings import DbSettings, GlobalSettings
+from toolbox.dbhelper import PostgresConnection
+
+SWEEP_METHODS = ["grid", "random"]
+
+# upper bound for the number of values evaluated at once (attribute combinations x variants) - limits memory usage
+_MAX_BATCH_VALUES = 64 * 1024 * 1024
+
+
+@dataclass
+class LinearIndexModel:
+    """Weight-independent parts of a mode profile evaluated for all rows of an attribute matrix. Since weight overrides
+    replace weights per edge and indicator mappings do not depend on weights, the index of any weight vector is a ratio
+    of two linear functions of the weights - this allows evaluating many weight variants as matrix products."""
+    indicators: List[str]
+    # per row and indicator: value not NULL, mapped indicator value (0 if not mapped), mapping result NULL
+    not_null: np.ndarray
+    mapped: np.ndarray
+    mapped_null: np.ndarray
+    # per row and indicator: weight is overridden (and override value)
+    overridden: np.ndarray
+    override_value: np.ndarray
+    # per row: index override (NaN if not applicable)
+    index_override: np.ndarray
+
+    @staticmethod
+    def prepare(matrix: AttributeMatrix, profile: dict, direction: str) -> 'LinearIndexModel':
+        columns = matrix.indicators(direction)
+        names = [name for name, _, _ in INDEX_INDICATOR_COLUMNS]
+        n = matrix.size
+        overridden = np.zeros((n, len(names)), dtype=bool)
+        override_value = np.zeros((n, len(names)))
+        index_override = np.full(n, np.nan)
+        index_overridden = np.zeros(n, dtype=bool)
+        for override in profile['overrides']:
+            out = override.get('output') or {}
+            values = matrix.evaluate_mapping(override, direction, force_default_value=True, def_value=-1)
+            with np.errstate(invalid="ignore"):
+                applies = (values >= 0) & ~index_overridden
+            if out.get('type') == "index":
+                index_override[applies] = values[applies]
+                index_overridden |= applies
+            elif out.get('type') == "weight":
+                targets = out.get('for', [])
+                for target in [targets] if type(targets) == str else targets:
+                    i = names.index(h.get_safe_name(target))
+                    overridden[applies, i] = True
+                    override_value[applies, i] = values[applies]
+            else:
+                raise Exception(f"Unknown output type '{out.get('type')}' provided in overrides definition for '{override.get('indicator')}'.")
+        not_null = np.stack([~columns[name].is_null() for name in names], axis=1)
+        mapped = np.zeros((n, len(names)))
+        mapped_null = np.zeros((n, len(names)), dtype=bool)
+        for indicator in profile['indicator_mapping']:
+            i = names.index(h.get_safe_name(indicator.get('indicator')))
+            values = matrix.evaluate_mapping(indicator, direction)
+            mapped_null[:, i] = np.isnan(values) & not_null[:, i]
+            mapped[:, i] = np.nan_to_num(values)
+        return LinearIndexModel(names, not_null, mapped, mapped_null, overridden, override_value, index_override)
+
+    def evaluate(self, weights: np.ndarray) -> (np.ndarray, np.ndarray):
+        """Evaluates the given weight variants (shape: variants x indicators, NaN for NULL weights) - returns index and
+        robustness per row and variant (shape: rows x variants)."""
+        free = ~self.overridden
+        w = np.nan_to_num(weights).T
+        w_set = (~np.isnan(weights)).T.astype(float)
+        fixed = np.where(self.overridden, self.override_value, 0)
+        # weights per row: overridden (fixed) weights plus variant weights of all other indicators
+        weights_total = fixed.sum(axis=1)[:, None] + free.astype(float) @ w
+        included_free = self.not_null & free
+        weights_sum = (fixed * self.not_null).sum(axis=1)[:, None] + included_free.astype(float) @ w
+        numerator = (fixed * self.not_null * self.mapped).sum(axis=1)[:, None] + (included_free * self.mapped) @ w
+        # NULL mapping results propagate to the index if the respective indicator is weighted
+        null_count = (self.mapped_null & self.overridden).sum(axis=1)[:, None] + (self.mapped_null & free).astype(float) @ w_set
+        with np.errstate(invalid="ignore", divide="ignore"):
+            index = np.where((weights_sum > 0) & (null_count == 0), _round(numerator / weights_sum), np.nan)
+            robustness = _round(weights_sum / weights_total)
+        overridden = ~np.isnan(self.index_override)
+        index[overridden] = self.index_override[overridden, None]
+        robustness[overridden] = np.nan
+        return index, robustness
+
+
+def generate_variants(base_weights: dict, settings: dict) -> List[Dict[str, float]]:
+    """Weight variants for the given sweep settings: the base weights (first variant), followed by a grid of all
+    combinations of the given weight values or a random sample of weights from the given ranges."""
+    method = settings.get('method', 'grid')
+    if method not in SWEEP_METHODS:
+        raise Exception(f"Unknown sweep method '{method}'. Supported values: {', '.join(SWEEP_METHODS)}.")
+    h.require_keys(settings, ['weights'], "error: sweep section is missing:")
+    spec: dict = settings['weights']
+    names = [name for name, _, _ in INDEX_INDICATOR_COLUMNS]
+    for name, values in spec.items():
+        if name not in names:
+            raise Exception(f"Unknown indicator '{name}' in sweep weights.")
+        if type(values) != list or not all(h.is_numeric(v) for v in values):
+            raise Exception(f"Sweep weights of indicator '{name}' must be given as a list of numeric values.")
+    variants = [dict(base_weights)]
+    if method == "grid":
+        for combination in itertools.product(*spec.values()):
+            variants.append({**base_weights, **dict(zip(spec.keys(), combination))})
+    else:
+        rng = np.random.default_rng(settings.get('seed'))
+        for _ in range(int(settings.get('samples', 100))):
+            sample = {}
+            for name, values in spec.items():
+                if len(values) != 2:
+                    raise Exception(f"For random sampling, sweep weights of indicator '{name}' must be given as range [min, max].")
+                sample[name] = float(rng.uniform(values[0], values[1]))
+            variants.append({**base_weights, **sample})
+    return variants
+
+
+class RankStability:
+    """Accumulates statistics of the index rank (percentile) per attribute combination across variants (Welford's algorithm)."""
+
+    def __init__(self, size: int):
+        self.count = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    def add(self, ranks: np.ndarray):
+        valid = ~np.isnan(ranks)
+        self.count[valid] += 1
+        delta = np.where(valid, ranks - self.mean, 0)
+        self.mean += np.where(valid, delta / np.maximum(self.count, 1), 0)
+        self.m2 += np.where(valid, delta * (ranks - self.mean), 0)
+
+    @property
+    def std(self) -> np.ndarray:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+
+def _unify(ft: AttributeColumn, tf: AttributeColumn) -> AttributeColumn:
+    # concatenates the values of both directions - categorical codes are re-mapped to a common set of categories
+    if not ft.is_categorical:
+        return AttributeColumn(np.concatenate([ft.values, tf.values]))
+    categories = np.union1d(ft.categories, tf.categories)
+    codes = [np.append(np.searchsorted(categories, c.categories), -1)[c.values].astype(np.int32) for c in [ft, tf]]
+    return AttributeColumn(np.concatenate(codes), categories)
+
+
+def distinct_combinations(matrix: AttributeMatrix, access: np.ndarray) -> (AttributeMatrix, np.ndarray, np.ndarray, np.ndarray):
+    """Reduces both directions of all edges to their distinct combinations of indicator values and access. Returns an
+    attribute matrix of the combinations (same values for "ft" and "tf" columns), the combination of each edge and
+    direction (ft: first half, tf: second half), the number of edge directions per combination and its access flag."""
+    columns: Dict[str, AttributeColumn] = {name: _unify(matrix.columns[ft], matrix.columns[tf]) for name, ft, tf in INDEX_INDICATOR_COLUMNS}
+    keys = pd.DataFrame({name: c.values for name, c in columns.items()})
+    keys["_access"] = np.concatenate([access, access])
+    combination = keys.groupby(list(keys.columns), dropna=False, sort=False).ngroup().to_numpy()
+    counts = np.bincount(combination)
+    first = np.full(len(counts), -1)
+    first[combination[::-1]] = np.arange(len(combination))[::-1]
+    reduced: Dict[str, AttributeColumn] = {}
+    for name, ft, tf in INDEX_INDICATOR_COLUMNS:
+        column = AttributeColumn(columns[name].values[first], columns[name].categories)
+        reduced[ft] = reduced[tf] = column
+    return AttributeMatrix(np.arange(len(counts)), reduced), combination, counts, keys["_access"].to_numpy()[first]
+
+
+def _weighted_ranks(values: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # percentile rank of values occurring 'counts' times (ties: average rank, NULL: NaN) - as pandas' rank(pct=True)
+    ranks = np.full(len(values), np.nan)
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return ranks
+    _, inverse = np.unique(values[valid], return_inverse=True)
+    n = np.bincount(inverse, weights=counts[valid])
+    ranks[valid] = ((np.cumsum(n) - n + (n + 1) / 2) / n.sum())[inverse]
+    return ranks
+
+
+def _weighted_statistics(values: np.ndarray, counts: np.ndarray) -> Dict[str, float]:
+    valid = ~np.isnan(values)
+    v, c = values[valid], counts[valid]
+    stats: Dict[str, float] = {"count": int(c.sum())}
+    if len(v) == 0:
+        return stats
+    mean = np.average(v, weights=c)
+    order = np.argsort(v)
+    cumulative = np.cumsum(c[order])
+    quantile = lambda q: v[order][min(np.searchsorted(cumulative, q * cumulative[-1]), len(v) - 1)]
+    stats.update({"mean": mean, "std": np.sqrt(np.average((v - mean) ** 2, weights=c)), "min": v.min(), "p10": quantile(0.1),
+                  "p25": quantile(0.25), "median": quantile(0.5), "p75": quantile(0.75), "p90": quantile(0.9), "max": v.max()})
+    return stats
+
+
+def _weighted_correlation(x: np.ndarray, y: np.ndarray, counts: np.ndarray) -> float:
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x, y, c = x[valid], y[valid], counts[valid]
+    if c.sum() < 2:
+        return np.nan
+    dx, dy = x - np.average(x, weights=c), y - np.average(y, weights=c)
+    denominator = np.sqrt(np.average(dx ** 2, weights=c) * np.average(dy ** 2, weights=c))
+    return np.average(dx * dy, weights=c) / denominator if denominator > 0 else np.nan
+
+
+def sweep_profile(matrix: AttributeMatrix, profile: ModeProfile, settings: dict) -> (pd.DataFrame, pd.DataFrame):
+    """Evaluates weight variants of a mode profile in batches over the shared attribute matrix. Returns summary statistics
+    per variant (first row: base profile) and per-edge rank stability across all variants."""
+    variants = generate_variants(profile.profile['weights'], settings)
+    names = [name for name, _, _ in INDEX_INDICATOR_COLUMNS]
+    weights = np.array([[np.nan if v.get(name) is None else float(v.get(name)) for name in names] for v in variants])
+    h.info(f'evaluating {len(variants)} weight variants of profile "{profile.profile_name}"')
+
+    # index values only depend on the combination of indicator values - evaluate each distinct combination once
+    combinations, combination, counts, access = distinct_combinations(matrix, matrix.access(profile))
+    h.info(f"{2 * matrix.size} edge directions share {combinations.size} distinct combinations of indicator values")
+    model = LinearIndexModel.prepare(combinations, profile.profile, "ft")
+    stability = RankStability(combinations.size)
+    batch = max(1, _MAX_BATCH_VALUES // combinations.size)
+    rows: List[dict] = []
+    base_ranks = None
+    for start in range(0, len(variants), batch):
+        t = clock()
+        index, robustness = model.evaluate(weights[start:start + batch])
+        index[~access] = np.nan
+        robustness[~access] = np.nan
+        for j in range(index.shape[1]):
+            ranks = _weighted_ranks(index[:, j], counts)
+            if base_ranks is None:
+                base_ranks = ranks
+            stability.add(ranks)
+            valid = ~np.isnan(ranks) & ~np.isnan(base_ranks)
+            r = robustness[:, j]
+            rows.append({"variant": start + j, **{f"w_{name}": weights[start + j, i] for i, name in enumerate(names)},
+                         **_weighted_statistics(index[:, j], counts),
+                         "robustness_mean": np.average(r[~np.isnan(r)], weights=counts[~np.isnan(r)]) if (~np.isnan(r)).any() else np.nan,
+                         # rank stability w.r.t. the base profile: Spearman's rank correlation and mean absolute rank change
+                         "rank_correlation": _weighted_correlation(ranks, base_ranks, counts),
+                         "rank_mean_abs_change": np.average(np.abs(ranks - base_ranks)[valid], weights=counts[valid]) if valid.any() else np.nan})
+        h.log(f"evaluated variants {start}-{start + index.shape[1] - 1} in {h.secondsToStr(clock() - t, detailed=True)}")
+
+    edges = pd.DataFrame({
+        "edge_id": np.concatenate([matrix.edge_ids, matrix.edge_ids]),
+        "direction": np.repeat(["ft", "tf"], matrix.size),
+        "rank_mean": stability.mean[combination],
+        "rank_std": stability.std[combination],
+    })
+    edges = edges[stability.count[combination] > 0]
+    return pd.DataFrame(rows), edges
+
+
+def run_sweep(db_settings: DbSettings, base_path: str, profile_definitions: List[dict], settings: dict):
+    """Sensitivity sweep: evaluates weight variants of a base mode profile in memory and writes summary statistics per
+    variant (and optionally per-edge rank stability) to CSV files in the data directory."""
+    h.require_keys(settings, ['profile', 'filename'], "error: sweep section is missing:")
+    profiles = [p for p in load_profiles(base_path, profile_definitions) if p.profile_name == settings['profile']]
+    if not profiles:
+        raise Exception(f"Sweep profile '{settings['profile']}' is not defined in the profiles section.")
+
+    schema = db_settings.entities.network_schema
+    h.info('open database connection')
+    db = PostgresConnection.from_settings_object(db_settings)
+    db.schema = schema
+    matrix = AttributeMatrix.load(db, schema)
+    h.log('close database connection')
+    db.close()
+
+    h.logBeginTask(f'sweep of profile "{settings["profile"]}"')
+    variants, edges = sweep_profile(matrix, profiles[0], settings)
+    h.logEndTask()
+
+    filename = os.path.join(GlobalSettings.data_directory, settings['filename'].replace("<case_id>", GlobalSettings.case_id))
+    variants.to_csv(filename, index=False)
+    h.majorInfo(f"wrote statistics of {len(variants)} variants to '{filename}' - per-edge rank std: mean "
+                f"{np.nanmean(edges['rank_std']):.4f}, p90 {np.nanquantile(edges['rank_std'], 0.9):.4f}")
+    if h.has_keys(settings, ['edge_filename']):
+        edge_filename = os.path.join(GlobalSettings.data_directory, settings['edge_filename'].replace("<case_id>", GlobalSettings.case_id))
+        edges.to_csv(edge_filename, index=False)
+        h.info(f"wrote per-edge rank stability to '{edge_filename}'")
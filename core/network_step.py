@@ -1,7 +1,34 @@
+from typing import List
+
 import toolbox.helper as h
 from core.db_step import DbStep
+from core.import_step import get_osm2pgsql_output
 from settings import DbSettings, GlobalSettings, InputType
-from toolbox.dbhelper import PostgresConnection
+from toolbox.dbhelper import PostgresConnection, transform_sql
+from toolbox.fingerprint import invalidate_fingerprint, is_unchanged, step_fingerprint, store_fingerprint
+
+
+NETWORK_OUTPUT_TABLES = ['network_edge', 'network_node']
+
+
+def run_network_template(db: PostgresConnection, db_settings: DbSettings, template: str, params: dict, inputs: List[str]):
+    """Executes the network template unless its inputs are unchanged since the last run (if the fingerprint cache is
+    enabled) or the output tables should be skipped according to 'on_existing'."""
+    schema = db_settings.entities.network_schema
+    fingerprint = None
+    if GlobalSettings.cache_enabled:
+        fingerprint = step_fingerprint(db, template, params, inputs, [db_settings.entities.data_schema, schema],
+                                       content=GlobalSettings.cache_content_hash)
+        if is_unchanged(db, schema, template, fingerprint, NETWORK_OUTPUT_TABLES):
+            h.majorInfo(f"inputs unchanged since the last run - skipping \"{template}\"")
+            return
+    if db.handle_conflicting_output_tables(NETWORK_OUTPUT_TABLES):
+        if fingerprint:
+            invalidate_fingerprint(db, schema, template)
+        db.execute_template_sql_from_file(template, params)
+        db.commit()
+        if fingerprint:
+            store_fingerprint(db, schema, template, fingerprint)
 
 
 class GipNetworkStep(DbStep):
@@ -22,14 +49,13 @@ class GipNetworkStep(DbStep):
 
         # execute "gip_network"
         h.logBeginTask('execute "gip_network"')
-        if db.handle_conflicting_output_tables(['network_edge', 'network_node']):
-            params = {
-                'schema_network': schema,
-                'schema_data': self.db_settings.entities.data_schema,
-                'target_srid': GlobalSettings.get_target_srid()
-            }
-            db.execute_template_sql_from_file("gip_network", params)
-            db.commit()
+        params = {
+            'schema_network': schema,
+            'schema_data': self.db_settings.entities.data_schema,
+            'target_srid': GlobalSettings.get_target_srid()
+        }
+        run_network_template(db, self.db_settings, "gip_network", params,
+                             ['gip_link', 'gip_linkgeom', 'gip_linkuse', 'gip_node', 'gip_bikehike'])
         h.logEndTask()
 
         # close database connection
@@ -60,16 +86,19 @@ class OsmNetworkStep(DbStep):
 
         # execute "osm_network"
         h.logBeginTask('execute "osm_network"')
-        if db.handle_conflicting_output_tables(['network_edge', 'network_node']):
-            params = {
-                'schema_network': schema,
-                'schema_data': self.db_settings.entities.data_schema,
-                'target_srid': GlobalSettings.get_target_srid(),
-                'include_rail': settings and h.has_keys(settings, ['include_rail']) and settings['include_rail'],
-                'include_aerialway': settings and h.has_keys(settings, ['include_aerialway']) and settings['include_aerialway']
-            }
-            db.execute_template_sql_from_file("osm_network", params)
-            db.commit()
+        params = {
+            'schema_network': schema,
+            'schema_data': self.db_settings.entities.data_schema,
+            'target_srid': GlobalSettings.get_target_srid(),
+            # OSM geometries in the target SRID (only reprojected if osm2pgsql did not project them on import)
+            'osm_geom': transform_sql('way', db.get_srid('osm_line', 'way', self.db_settings.entities.data_schema),
+                                      GlobalSettings.get_target_srid()),
+            # tags are read from typed columns with the flex output, from the hstore column 'tags' otherwise
+            'osm2pgsql_output': get_osm2pgsql_output(db, self.db_settings.entities.data_schema),
+            'include_rail': settings and h.has_keys(settings, ['include_rail']) and settings['include_rail'],
+            'include_aerialway': settings and h.has_keys(settings, ['include_aerialway']) and settings['include_aerialway']
+        }
+        run_network_template(db, self.db_settings, "osm_network", params, ['osm_line'])
         h.logEndTask()
 
         # close database connection
@@ -6,6 +6,20 @@ from core import import_step
 from core.db_step import DbStep
 from settings import DbSettings, GlobalSettings
 from toolbox.dbhelper import PostgresConnection
+from toolbox.scheduler import Task, run_tasks
+
+# tables written by each optional importer - importers writing the same table (e.g. 'osm' and 'building') are run in
+# the order given in the settings file, all others run concurrently
+OPTIONAL_OUTPUTS = {
+    'dem': ['dem'],
+    'noise': ['noise', 'noise_raster'],
+    'osm': list(import_step.OSM_FLEX_DATASETS),
+    'building': ['building'],
+    'crossing': ['crossing'],
+    'facility': ['facility'],
+    'greenness': ['greenness'],
+    'water': ['water']
+}
 
 
 def import_raster(connection_string: str, path: str, schema: str, table: str, input_srid: int = 0) -> None:
@@ -14,6 +28,12 @@ def import_raster(connection_string: str, path: str, schema: str, table: str, in
         shell=True, check=True)
 
 
+class OptionalImporter(DbStep):
+    # maximum number of concurrent layer loads of a GeoPackage import (None: global 'max_workers' setting) - limited if
+    # several importers run concurrently (see "run_optional_importers")
+    workers: int = None
+
+
 class DemImporter(DbStep):
     def run_step(self, settings: dict):
         h.info('importing dem:')
@@ -39,7 +59,7 @@ class DemImporter(DbStep):
         db.close()
 
 
-class NoiseImporter(DbStep):
+class NoiseImporter(OptionalImporter):
     def run_step(self, settings: dict):
         h.log('importing noise:')
         h.log(f"using settings: {str(settings)}")
@@ -52,19 +72,28 @@ class NoiseImporter(DbStep):
         db = PostgresConnection.from_settings_object(self.db_settings)
         db.init_extensions_and_schema(schema)
 
-        # import noise
-        h.logBeginTask('import noise')
-        if db.handle_conflicting_output_tables(['noise'], schema):
-            import_step.import_geopackage(db.connection_string_old, os.path.join(directory, settings['filename']), schema, 
-                table='noise', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POLYGON', 'MULTIPOLYGON'])
-        h.logEndTask()
+        # import noise: raster (GeoTIFF) or polygons (GeoPackage)
+        if settings['filename'].lower().endswith(('.tif', '.tiff')):
+            h.logBeginTask('import noise raster')
+            if db.handle_conflicting_output_tables(['noise_raster'], schema):
+                # raster is imported without reprojection - the sample points along the edges are reprojected to its srid
+                import_raster(db.connection_string, os.path.join(directory, settings['filename']), schema,
+                              table='noise_raster', input_srid=settings.get('srid', 0))
+            h.logEndTask()
+        else:
+            h.logBeginTask('import noise')
+            if db.handle_conflicting_output_tables(['noise'], schema):
+                import_step.import_geopackage(db, os.path.join(directory, settings['filename']), schema, 
+                    table='noise', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POLYGON', 'MULTIPOLYGON'], workers=self.workers)
+            h.logEndTask()
+            import_step.refresh_subdivided_copy(db, schema, 'noise', import_step.get_subdivide_max_vertices(settings))
 
         # close database connection
         h.log('close database connection')
         db.close()
 
 
-class BuildingImporter(DbStep):
+class BuildingImporter(OptionalImporter):
     def run_step(self, settings: dict):
         h.info('importing building')
         h.log(f"using settings: {str(settings)}")
@@ -80,8 +109,8 @@ class BuildingImporter(DbStep):
         # import building
         h.logBeginTask('import building')
         if db.handle_conflicting_output_tables(['building'], schema):
-            import_step.import_geopackage(db.connection_string_old, os.path.join(directory, settings['filename']), schema, 
-                table='building', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POLYGON'])
+            import_step.import_geopackage(db, os.path.join(directory, settings['filename']), schema, 
+                table='building', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POLYGON'], workers=self.workers)
         h.logEndTask()
 
         # close database connection
@@ -89,7 +118,7 @@ class BuildingImporter(DbStep):
         db.close()
 
 
-class CrossingImporter(DbStep):
+class CrossingImporter(OptionalImporter):
     def run_step(self, settings: dict):
         h.log('importing crossing:')
         h.log(f"using settings: {str(settings)}")
@@ -105,8 +134,8 @@ class CrossingImporter(DbStep):
         # import crossing
         h.logBeginTask('import crossing')
         if db.handle_conflicting_output_tables(['crossing'], schema):
-            import_step.import_geopackage(db.connection_string_old, os.path.join(directory, settings['filename']), schema, 
-                table='crossing', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POINT', 'LINESTRING'])
+            import_step.import_geopackage(db, os.path.join(directory, settings['filename']), schema, 
+                table='crossing', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POINT', 'LINESTRING'], workers=self.workers)
         h.logEndTask()
 
         # close database connection
@@ -114,7 +143,7 @@ class CrossingImporter(DbStep):
         db.close()
 
 
-class FacilityImporter(DbStep):
+class FacilityImporter(OptionalImporter):
     def run_step(self, settings: dict):
         h.log('importing facility:')
         h.log(f"using settings: {str(settings)}")
@@ -130,8 +159,8 @@ class FacilityImporter(DbStep):
         # import facility
         h.logBeginTask('import facility')
         if db.handle_conflicting_output_tables(['facility'], schema):
-            import_step.import_geopackage(db.connection_string_old, os.path.join(directory, settings['filename']), schema, 
-                table='facility', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POINT', 'POLYGON'])
+            import_step.import_geopackage(db, os.path.join(directory, settings['filename']), schema, 
+                table='facility', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POINT', 'POLYGON'], workers=self.workers)
         h.logEndTask()
 
         # close database connection
@@ -139,7 +168,7 @@ class FacilityImporter(DbStep):
         db.close()
 
 
-class GreennessImporter(DbStep):
+class GreennessImporter(OptionalImporter):
     def run_step(self, settings: dict):
         h.log('importing greenness:')
         h.log(f"using settings: {str(settings)}")
@@ -155,16 +184,17 @@ class GreennessImporter(DbStep):
         # import greenness
         h.logBeginTask('import greenness')
         if db.handle_conflicting_output_tables(['greenness'], schema):
-            import_step.import_geopackage(db.connection_string_old, os.path.join(directory, settings['filename']), schema, 
-                table='greenness', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POLYGON'])
+            import_step.import_geopackage(db, os.path.join(directory, settings['filename']), schema, 
+                table='greenness', target_srid=GlobalSettings.get_target_srid(), geometry_types=['POLYGON'], workers=self.workers)
         h.logEndTask()
+        import_step.refresh_subdivided_copy(db, schema, 'greenness', import_step.get_subdivide_max_vertices(settings))
 
         # close database connection
         h.log('close database connection')
         db.close()
 
 
-class WaterImporter(DbStep):
+class WaterImporter(OptionalImporter):
     def run_step(self, settings: dict):
         h.log('importing water:')
         h.log(f"using settings: {str(settings)}")
@@ -180,9 +210,10 @@ class WaterImporter(DbStep):
         # import water
         h.logBeginTask('import water')
         if db.handle_conflicting_output_tables(['water'], schema):
-            import_step.import_geopackage(db.connection_string_old, os.path.join(directory, settings['filename']), schema, 
-                table='water', target_srid=GlobalSettings.get_target_srid(), geometry_types=['LINESTRING', 'POLYGON'])
+            import_step.import_geopackage(db, os.path.join(directory, settings['filename']), schema, 
+                table='water', target_srid=GlobalSettings.get_target_srid(), geometry_types=['LINESTRING', 'POLYGON'], workers=self.workers)
         h.logEndTask()
+        import_step.refresh_subdivided_copy(db, schema, 'water', import_step.get_subdivide_max_vertices(settings))
 
         # close database connection
         h.log('close database connection')
@@ -210,6 +241,31 @@ def create_optional_importer(db_settings: DbSettings, import_type: str):
 
 
 def run_optional_importers(db_settings: DbSettings, optional_importer_settings: dict):
-    for import_type, settings in optional_importer_settings.items():
+    """Runs the optional importers concurrently (on at most 'workers' threads, defaults to the global 'max_workers'
+    setting). Errors are collected and reported after all importers not depending on a failed one completed."""
+    optional_importer_settings = dict(optional_importer_settings)
+    workers = max(1, int(optional_importer_settings.pop('workers', GlobalSettings.max_workers)))
+
+    # extensions and schema are created once up front - concurrent 'CREATE EXTENSION' statements may conflict
+    db = PostgresConnection.from_settings_object(db_settings)
+    db.init_extensions_and_schema(db_settings.entities.data_schema)
+    db.close()
+
+    # the worker budget is shared by the concurrent importers - each one loads its layers on its share of the workers
+    layer_workers = max(1, workers // max(1, min(workers, len(optional_importer_settings))))
+
+    def run_importer(import_type: str, settings: dict):
         optional_importer = create_optional_importer(db_settings, import_type)
-        optional_importer.run_step(settings)
+        if isinstance(optional_importer, OptionalImporter):
+            optional_importer.workers = layer_workers
+        return lambda: optional_importer.run_step(settings)
+
+    tasks = []
+    for import_type, settings in optional_importer_settings.items():
+        # wait for previous importers writing the same tables
+        outputs = set(OPTIONAL_OUTPUTS.get(import_type, []))
+        inputs = [task.name for task in tasks if outputs & set(OPTIONAL_OUTPUTS.get(task.name, []))]
+        tasks.append(Task(import_type, run_importer(import_type, settings), inputs, [import_type]))
+
+    # the duration of each importer is logged on completion
+    run_tasks(tasks, workers, stop_on_error=False)
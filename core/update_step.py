@@ -0,0 +1,235 @@
+import bz2
+import gzip
+import os
+import xml.etree.ElementTree as ET
+from typing import List, Set, Tuple
+
+import toolbox.helper as h
+from core.attributes_step import NEIGHBOURHOOD_INDICATORS, create_attributes_step, get_buffer_distances, \
+    get_coverage_mode, get_coverage_resolution
+from core.import_step import OsmImporter, get_osm2pgsql_output
+from core.index_step import ModeProfile, generate_index
+from settings import DbSettings, GlobalSettings, InputType
+from toolbox.dbhelper import PostgresConnection, transform_sql
+
+# suffix of the schema in which attributes and index are re-computed for the edges affected by an update
+UPDATE_SCHEMA_SUFFIX = "_update"
+
+# tables of the network schema which are updated per edge or node: key column and the network table it refers to
+UPDATE_TABLES = {
+    "network_edge_attributes": ("edge_id", "network_edge"),
+    "network_edge_export": ("edge_id", "network_edge"),
+    "network_edge_index": ("edge_id", "network_edge"),
+    "network_node_attributes": ("node_id", "network_node"),
+}
+
+
+def _read_change_ids(path: str) -> Tuple[Set[int], Set[int], Set[int]]:
+    """Reads the ids of all nodes, ways and relations created, modified or deleted by an OSM change file (.osc,
+    optionally compressed as .gz or .bz2)."""
+    opener = gzip.open if path.endswith(".gz") else bz2.open if path.endswith(".bz2") else open
+    ids = {"node": set(), "way": set(), "relation": set()}
+    with opener(path, "rb") as file:
+        for event, elem in ET.iterparse(file, events=("start", "end")):
+            if event == "start" and elem.tag in ids and elem.get("id") is not None:
+                ids[elem.tag].add(int(elem.get("id")))
+            elif event == "end" and elem.tag in ids:
+                elem.clear()
+    return ids["node"], ids["way"], ids["relation"]
+
+
+def _store_change_ids(db: PostgresConnection, data_schema: str, change_file: str):
+    """Creates the table "network_update_candidate" with the osm_id of all objects of the OSM tables which may be
+    changed by the change file: changed nodes (is_node), changed ways and relations (osm2pgsql stores relations with
+    negative osm_id) and the ways referencing changed nodes - looked up in the osm2pgsql middle table of ways before
+    applying the changes. Ways added by the change file are included as changed ways."""
+    nodes, ways, relations = _read_change_ids(os.path.join(GlobalSettings.data_directory, change_file))
+    h.log(f"change file: {len(nodes)} nodes, {len(ways)} ways, {len(relations)} relations")
+    db.drop_table("network_update_candidate")
+    db.ex("CREATE TABLE network_update_candidate (osm_id bigint, is_node boolean);")
+    db.ex("INSERT INTO network_update_candidate SELECT unnest(%s::bigint[]), true;", (sorted(nodes),))
+    db.ex("INSERT INTO network_update_candidate SELECT unnest(%s::bigint[]), false;",
+          (sorted(ways) + sorted(-r for r in relations),))
+    if nodes:
+        # osm2pgsql indexes the way nodes by bucket (function "<prefix>_index_bucket") unless the middle option
+        # --middle-way-node-index-id-shift is 0 - the bucket condition is needed for the index to be used
+        bucket = db.query_one("""SELECT EXISTS(SELECT FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace
+            WHERE n.nspname = %s AND p.proname = 'osm_index_bucket')""", (data_schema,))[0]
+        condition = f"{data_schema}.osm_index_bucket(nodes) && {data_schema}.osm_index_bucket(%(nodes)s::bigint[]) AND " \
+            if bucket else ""
+        db.ex(f"""INSERT INTO network_update_candidate
+            SELECT id, false FROM {data_schema}.osm_ways WHERE {condition}nodes && %(nodes)s::bigint[];""",
+              {'nodes': sorted(nodes)})
+    db.ex("CREATE INDEX network_update_candidate_osm_id_idx ON network_update_candidate (osm_id);")
+    db.commit()
+
+
+def _snapshot_osm(db: PostgresConnection, data_schema: str, table: str):
+    """Stores a hash and the extent per osm_id of the candidates for changes (see "network_update_candidate") in the
+    tables "osm_point", "osm_line" and "osm_polygon" - the datasets derived from OSM data are created from these
+    tables, so their changes are within the extent of the changed objects."""
+    tables = {"point": "true", "line": "false", "polygon": "false"}
+    db.drop_table(f"{table}_object")
+    db.ex(f"CREATE TABLE {table}_object AS (" + " UNION ALL ".join(f"""
+        SELECT '{kind}'::text AS kind, osm_id, md5(string_agg(t::text, ',' ORDER BY t::text)) AS hash,
+               ST_SetSRID(ST_Extent(way)::geometry, min(ST_SRID(way))) AS geom
+        FROM {data_schema}.osm_{kind} t
+        WHERE osm_id IN (SELECT osm_id FROM network_update_candidate WHERE is_node = {is_node})
+        GROUP BY osm_id""" for kind, is_node in tables.items()) + ");")
+    db.commit()
+
+
+def _determine_changes(db: PostgresConnection, target_srid: int):
+    """Creates the tables "network_update_changed" (osm_id of changed lines) and "network_update_area" (old and new
+    extent of all changed objects in the target SRID) from the snapshots before and after applying the changes."""
+    db.drop_table("network_update_changed")
+    db.ex("""CREATE TABLE network_update_changed AS (
+        SELECT osm_id
+        FROM update_before_object a
+            FULL JOIN update_after_object b USING (kind, osm_id)
+        WHERE kind = 'line' AND a.hash IS DISTINCT FROM b.hash
+    );""")
+    db.drop_table("network_update_area")
+    db.ex(f"""CREATE TABLE network_update_area AS (
+        SELECT {transform_sql("a.geom", None, target_srid)} AS geom
+        FROM (
+            SELECT coalesce(a.geom, b.geom) AS geom
+            FROM update_before_object a
+                FULL JOIN update_after_object b USING (kind, osm_id)
+            WHERE a.hash IS DISTINCT FROM b.hash
+
+            UNION ALL
+
+            SELECT b.geom
+            FROM update_before_object a
+                JOIN update_after_object b USING (kind, osm_id)
+            WHERE a.hash <> b.hash
+        ) a
+    );""")
+    db.ex("CREATE INDEX network_update_area_geom_idx ON network_update_area USING gist (geom);")
+    changed = db.query_one("SELECT count(*) FROM network_update_changed")[0]
+    areas = db.query_one("SELECT count(*) FROM network_update_area")[0]
+    db.commit()
+    h.info(f"OSM changes: {changed} changed lines, {areas} changed areas of influence")
+
+
+def get_update_distance(attributes_settings: dict) -> float:
+    """Maximum distance (m) at which OSM objects influence the indicators of an edge: the largest (configured) buffer
+    distance of the buffer-based indicators or neighbourhood of "facilities" and "crossings" - plus the pixel size if
+    coverage indicators are approximated on a raster. Noise and designated routes are evaluated by intersection."""
+    distance = max(list(get_buffer_distances(attributes_settings).values()) + list(NEIGHBOURHOOD_INDICATORS.values()))
+    if get_coverage_mode(attributes_settings) == 'raster':
+        distance += get_coverage_resolution(attributes_settings)
+    return distance
+
+
+def _update_settings(db_settings: DbSettings) -> DbSettings:
+    """Database settings for re-computing the affected edges in a separate schema."""
+    update_settings = DbSettings(db_settings.host, db_settings.port, db_settings.dbname, db_settings.username,
+                                 db_settings.password, "delete")
+    update_settings.entities.data_schema = db_settings.entities.data_schema
+    update_settings.entities.network_schema = db_settings.entities.network_schema + UPDATE_SCHEMA_SUFFIX
+    return update_settings
+
+
+def _merge_tables(db: PostgresConnection, schema: str, update_schema: str):
+    """Replaces the rows of all updated edges and nodes (and removed ones) in the per-edge and per-node tables of the
+    network schema."""
+    for table, (key, network_table) in UPDATE_TABLES.items():
+        if not db.exists(table, schema) or not db.exists(table, update_schema):
+            continue
+        columns = [row[0] for row in db.query_all("""SELECT column_name FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position""", (schema, table))]
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        h.log(f"merging updated rows into '{schema}.{table}'")
+        db.ex(f"""DELETE FROM {schema}.{table} a
+            WHERE a.{key} IN (SELECT {key} FROM {update_schema}.{network_table})
+               OR NOT EXISTS(SELECT FROM {schema}.{network_table} b WHERE b.{key} = a.{key});""")
+        db.ex(f"INSERT INTO {schema}.{table} ({column_list}) SELECT {column_list} FROM {update_schema}.{table};")
+        db.commit()
+
+
+def run_update(db_settings: DbSettings, import_settings: dict, attributes_settings: dict, profiles: List[ModeProfile],
+               index_settings: dict, change_file: str):
+    """Applies an OSM change file and re-computes network, attributes and index for the affected edges only: edges of
+    unchanged ways keep their edge_id, attributes and index values."""
+    if import_settings['type'].lower() != InputType.OSM.value.lower():
+        raise Exception("Updates are only supported for OSM data.")
+    schema = db_settings.entities.network_schema
+    data_schema = db_settings.entities.data_schema
+    target_srid = GlobalSettings.get_target_srid()
+
+    db = PostgresConnection.from_settings_object(db_settings)
+    db.connect()
+    db.schema = schema
+    db.verify_input_tables_exist(["network_edge", "network_node"], schema)
+
+    # apply OSM changes - snapshots of the objects referenced by the change file before and after are compared to
+    # determine changed objects
+    h.logBeginTask("apply OSM changes")
+    _store_change_ids(db, data_schema, change_file)
+    _snapshot_osm(db, data_schema, "update_before")
+    OsmImporter(db_settings).apply_changes(change_file, import_settings)
+    _snapshot_osm(db, data_schema, "update_after")
+    _determine_changes(db, target_srid)
+    h.logEndTask()
+
+    # update network: re-compute edges of affected ways only
+    h.logBeginTask('update network ("osm_network")')
+    params = {
+        'schema_network': schema,
+        'schema_data': data_schema,
+        'target_srid': target_srid,
+        'osm_geom': transform_sql('way', db.get_srid('osm_line', 'way', data_schema), target_srid),
+        'osm2pgsql_output': get_osm2pgsql_output(db, data_schema),
+        'include_rail': h.has_keys(import_settings, ['include_rail']) and import_settings['include_rail'],
+        'include_aerialway': h.has_keys(import_settings, ['include_aerialway']) and import_settings['include_aerialway'],
+        'update': True,
+        'update_distance': get_update_distance(attributes_settings or {})
+    }
+    db.execute_sql_from_file("osm_delete_dangling_edges", "sql/functions")
+    db.execute_template_sql_from_file("osm_network", params)
+    db.commit()
+    edges = db.query_one("SELECT count(*) FROM network_update_edge")[0]
+    h.info(f"{edges} edges to update")
+    h.logEndTask()
+
+    # re-compute attributes and index for the affected edges in a separate schema and merge the results
+    update_settings = _update_settings(db_settings)
+    update_schema = update_settings.entities.network_schema
+    db.drop_schema(update_schema, cascade=True)
+    db.create_schema(update_schema)
+    db.ex(f"""CREATE TABLE {update_schema}.network_edge AS (
+        SELECT a.* FROM {schema}.network_edge a JOIN {schema}.network_update_edge b USING (edge_id)
+    );""")
+    db.ex(f"ALTER TABLE {update_schema}.network_edge ADD PRIMARY KEY (edge_id);")
+    db.ex(f"CREATE INDEX network_edge_geom_idx ON {update_schema}.network_edge USING gist (geom);")
+    db.ex(f"""CREATE TABLE {update_schema}.network_node AS (
+        SELECT a.* FROM {schema}.network_node a
+        WHERE EXISTS(SELECT FROM {update_schema}.network_edge b WHERE a.node_id IN (b.from_node, b.to_node))
+    );""")
+    db.ex(f"ALTER TABLE {update_schema}.network_node ADD PRIMARY KEY (node_id);")
+    db.commit()
+
+    h.logBeginTask("update attributes")
+    create_attributes_step(update_settings, import_settings['type']).run_step(attributes_settings or {})
+    h.logEndTask()
+    h.logBeginTask("update index")
+    generate_index(update_settings, profiles, index_settings)
+    h.logEndTask()
+
+    _merge_tables(db, schema, update_schema)
+
+    # re-create the export tables from the merged tables (the index step created them in the update schema only)
+    h.logBeginTask('create tables "export_edge" and "export_node"')
+    db.execute_template_sql_from_file("export", {'schema_network': schema})
+    db.commit()
+    h.logEndTask()
+
+    # clean up
+    db.drop_schema(update_schema, cascade=True)
+    for table in ["update_before_object", "update_after_object", "network_update_candidate", "network_update_changed",
+                  "network_update_area", "network_update_edge"]:
+        db.drop_table(table, schema=schema)
+    db.commit()
+    db.close()
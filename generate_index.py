@@ -8,10 +8,13 @@ import toolbox.helper as h
 from core.attributes_step import create_attributes_step
 from core.db_step import DbStep
 from core.export_step import create_exporter
-from core.import_step import create_importer
+from core.import_step import create_importer, import_run
+from core.index_inmemory import run_whatif
 from core.index_step import generate_index, load_profiles
+from core.index_sweep import run_sweep
 from core.network_step import create_network_step
 from core.optional_step import run_optional_importers
+from core.update_step import run_update
 from settings import DbSettings, GlobalSettings
 
 parser = argparse.ArgumentParser(description='TODO: add description')
@@ -19,6 +22,21 @@ parser.add_argument('settings_file', type=argparse.FileType('r', encoding='utf-8
                     help='TODO: write detailed description here')
 parser.add_argument('--skip', nargs='+', choices=['import', 'optional', 'network', 'attributes', 'index', 'export'],
                     help='skip one or more of these steps - e.g. "--skip import optional"')
+# alternative modes - at most one of them can be run at a time
+mode_group = parser.add_mutually_exclusive_group()
+mode_group.add_argument('--whatif', action='store_true',
+                    help='evaluate the mode profiles in memory based on the existing attributes table instead of running the '
+                         'processing steps - e.g. for experimenting with profile weights')
+parser.add_argument('--write', action='store_true',
+                    help='what-if mode: write the resulting index values to the database and run the export step (unless skipped)')
+parser.add_argument('--interactive', action='store_true',
+                    help='what-if mode: keep the attributes in memory and re-evaluate the mode profiles (re-read from file) on request')
+mode_group.add_argument('--sweep', action='store_true',
+                    help='evaluate weight variants of a mode profile in memory as specified in the "sweep" section of the '
+                         'settings file instead of running the processing steps')
+mode_group.add_argument('--update', nargs=1, metavar='CHANGE_FILE',
+                    help='apply the given OSM change file (.osc) to an existing import (requires import setting "updatable") '
+                         'and re-compute network, attributes and index for the affected edges only')
 parser.add_argument('--loglevel', nargs=1, choices=["1", "2", "3", "4"],
                     help="Sets the level of debug outputs on the console: 1=MajorInfo, 2=Info, 3=Detailed, 4=Debug")
 
@@ -60,9 +78,45 @@ with settings_stream:
             h.info(f"Set the target SRID to {GlobalSettings.get_target_srid()}")
         if h.has_keys(global_settings, ['case_id']):
             GlobalSettings.case_id = re.sub("[^a-zA-Z0-9_]", "", str(global_settings['case_id']))
+        if h.has_keys(global_settings, ['max_workers']):
+            GlobalSettings.max_workers = max(1, int(global_settings['max_workers']))
+            h.info(f"Set the maximum number of concurrent workers to {GlobalSettings.max_workers}")
+        if h.has_keys(global_settings, ['cache']):
+            GlobalSettings.cache_enabled = bool(global_settings['cache'])
+            h.info(f"Fingerprint cache {'enabled' if GlobalSettings.cache_enabled else 'disabled'}")
+        if h.has_keys(global_settings, ['cache_content_hash']):
+            GlobalSettings.cache_content_hash = bool(global_settings['cache_content_hash'])
     
     db_settings: DbSettings = DbSettings.from_dict(settings.get('database'))
 
+    # what-if mode: evaluate profiles in memory - only the export step may follow (if index values were written)
+    if args.whatif:
+        h.require_keys(settings, ['profiles'], 'error: section missing:')
+        h.majorInfo(' === evaluating mode profiles in memory (what-if mode) ===')
+        written = run_whatif(db_settings, base_path, settings['profiles'], write=args.write, interactive=args.interactive)
+        skip_steps = skip_steps + ['import', 'optional', 'network', 'attributes', 'index']
+        if not written or 'export' not in settings:
+            skip_steps.append('export')
+
+    # sensitivity sweep: evaluate weight variants in memory - no processing steps are executed
+    if args.sweep:
+        h.require_keys(settings, ['profiles', 'sweep'], 'error: section missing:')
+        h.majorInfo(' === running profile sensitivity sweep ===')
+        run_sweep(db_settings, base_path, settings['profiles'], settings['sweep'])
+        skip_steps = skip_steps + ['import', 'optional', 'network', 'attributes', 'index', 'export']
+
+    # update mode: apply OSM changes and re-compute affected edges - only the export step may follow
+    if args.update:
+        h.require_keys(settings, ['import', 'profiles'], 'error: section missing:')
+        h.majorInfo(' === applying OSM changes (update mode) ===')
+        update_import_settings: dict = settings['import']
+        h.require_keys(update_import_settings, ['type'], 'error: import section is missing:')
+        run_update(db_settings, update_import_settings, settings.get('attributes') or {},
+                   load_profiles(base_path, settings['profiles']), settings.get('index'), args.update[0])
+        skip_steps = skip_steps + ['import', 'optional', 'network', 'attributes', 'index']
+        if 'export' not in settings:
+            skip_steps.append('export')
+
     # check if all required sections are present first before taking any actions
     if 'import' not in skip_steps:
         h.require_keys(settings, ['import'], 'error: section missing:')
@@ -78,13 +132,15 @@ with settings_stream:
         h.require_keys(import_settings, ['type'], 'error: import section is missing:')
         require_on_existing_setting(import_settings)
         importer: DbStep = create_importer(db_settings, import_settings['type'])
-        importer.run_step(import_settings)
+        with import_run(db_settings):
+            importer.run_step(import_settings)
     else:
         h.majorInfo(' === skipping import ===')
 
     if 'optional' not in skip_steps and 'optional' in settings:
         h.majorInfo(' === running optional importers ===')
-        run_optional_importers(db_settings, settings.get('optional'))
+        with import_run(db_settings):
+            run_optional_importers(db_settings, settings.get('optional'))
 
     if 'network' not in skip_steps and 'import' in settings:
         # TODO: specify settings key that is needed by the network step
@@ -106,7 +162,7 @@ with settings_stream:
         h.require_keys(import_settings, ['type'], 'error: import section is missing:')
         require_on_existing_setting(import_settings)
         attributes_step: DbStep = create_attributes_step(db_settings, import_settings['type'])
-        attributes_step.run_step(import_settings)
+        attributes_step.run_step(settings.get('attributes') or {})
 
     if 'index' not in skip_steps:
         h.majorInfo(' === generating index ===')
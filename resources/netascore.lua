@@ -0,0 +1,253 @@
+-- ---------------------------------------------------------------------------------------------------------------------
+-- NetAScore style for the osm2pgsql flex output (requires osm2pgsql >= 1.7)
+--
+-- Instead of generic point / line / polygon tables, this style only writes the data used by NetAScore:
+--   <prefix>_line:      network ways (highway, railway, aerialway) and bicycle route relations - same columns as with
+--                       "default.style", but instead of the hstore column "tags", the keys used by the network and
+--                       attribute templates are written to typed columns (':' replaced by '_', e.g. "cycleway_left")
+--   <prefix>_building, <prefix>_crossing, <prefix>_facility, <prefix>_greenness, <prefix>_water:
+--                       context datasets, filtered at import time
+--
+-- Settings are passed as environment variables: NETASCORE_SCHEMA (target schema), NETASCORE_PREFIX (table prefix,
+-- default: "osm") and NETASCORE_SRID (SRID of the geometries, default: 4326).
+-- ---------------------------------------------------------------------------------------------------------------------
+
+local schema = os.getenv('NETASCORE_SCHEMA') or 'public'
+local prefix = os.getenv('NETASCORE_PREFIX') or 'osm'
+local srid = tonumber(os.getenv('NETASCORE_SRID')) or 4326
+
+local function set(values)
+    local result = {}
+    for _, v in ipairs(values) do
+        result[v] = true
+    end
+    return result
+end
+
+-- typed columns of the line table (keys of "default.style" used by the network template)
+local line_keys = {
+    'access', 'addr:housename', 'addr:housenumber', 'addr:interpolation', 'admin_level', 'aerialway', 'amenity', 'area',
+    'barrier', 'bicycle', 'boundary', 'brand', 'bridge', 'building', 'construction', 'covered', 'culvert', 'cutting',
+    'denomination', 'disused', 'embankment', 'foot', 'generator:source', 'harbour', 'highway', 'historic', 'horse',
+    'intermittent', 'junction', 'landuse', 'layer', 'leisure', 'lock', 'man_made', 'military', 'motorcar', 'name',
+    'natural', 'office', 'oneway', 'operator', 'place', 'population', 'power', 'power_source', 'public_transport',
+    'railway', 'ref', 'religion', 'route', 'service', 'shop', 'sport', 'surface', 'toll', 'tourism', 'tower:type',
+    'tracktype', 'tunnel', 'water', 'waterway', 'wetland', 'width', 'wood'
+}
+
+-- keys read by the network and attribute templates which are not part of "default.style" (stored in the "tags" column
+-- with the pgsql output) - written to typed columns, see "tag_column" and the macro "tag" in sql/templates/macros/osm.sql.j2
+local tag_keys = {
+    'bicycle:backward', 'bicycle:forward', 'bicycle_road', 'bridge:movable', 'bridge:structure', 'conveying',
+    'cyclestreet', 'cycleway', 'cycleway:both', 'cycleway:both:lane', 'cycleway:both:segregated', 'cycleway:left',
+    'cycleway:left:lane', 'cycleway:left:segregated', 'cycleway:right', 'cycleway:right:lane',
+    'cycleway:right:segregated', 'cycleway:segregated', 'footway', 'indoor', 'lanes', 'lanes:backward', 'lanes:forward',
+    'level', 'maxspeed', 'motor_vehicle', 'motor_vehicle:backward', 'motor_vehicle:forward', 'network',
+    'oneway:bicycle', 'oneway:motor_vehicle', 'oneway:vehicle', 'seamark:type', 'sidewalk', 'sidewalk:both',
+    'sidewalk:left', 'sidewalk:right', 'vehicle', 'vehicle:backward', 'vehicle:forward'
+}
+
+-- closed ways with any of these keys are areas (as in "default.style"), unless tagged with area=no
+local polygon_keys = {
+    'abandoned:aeroway', 'abandoned:amenity', 'abandoned:building', 'abandoned:landuse', 'abandoned:power',
+    'aeroway', 'amenity', 'area:highway', 'building', 'harbour', 'historic', 'landuse', 'leisure', 'man_made',
+    'military', 'natural', 'office', 'place', 'power', 'public_transport', 'shop', 'sport', 'tourism', 'water',
+    'waterway', 'wetland'
+}
+
+local facility_amenity = set({
+    -- entertainment
+    'arts_centre', 'artwork', 'attraction', 'bar', 'biergarten', 'cafe', 'castle', 'cinema', 'community_centre',
+    'library', 'museum', 'music_venue', 'park', 'pub', 'public_bookcase', 'restaurant', 'swimming_pool', 'theatre',
+    'toy_library', 'viewpoint', 'public_bath',
+    -- retail
+    'atm', 'bureau_de_change', 'bakery', 'beverages', 'butcher', 'clothes', 'department_store', 'fast_food',
+    'marketplace', 'florist', 'food_court', 'furniture_shop', 'ice_cream', 'kiosk', 'mall', 'outdoor_shop', 'pharmacy',
+    'shoe_shop', 'sports_shop', 'internet_cafe', 'supermarket', 'commercial', 'retail', 'shop', 'bicycle_rental',
+    'boat_rental', 'car_rental', 'bank',
+    -- institutional
+    'university', 'school', 'college', 'gymnasium', 'kindergarten', 'childcare', 'boarding_school', 'music_school',
+    'riding_school', 'driving_school', 'language_school', 'research_institute', 'school;dormitory', 'training',
+    'place_of_worship', 'conference_centre', 'events_venue', 'exhibition_centre', 'social_centre', 'courthouse',
+    'post_office', 'ranger_station', 'townhall',
+    -- infrastructure
+    'post_box', 'bbq', 'bench', 'drinking_water', 'give_box', 'shelter', 'toilets', 'water_point', 'watering_place',
+    'waste_basket', 'clock', 'kneipp_water_cure', 'lounger', 'vending_machine'
+})
+local facility_tourism = set({ 'museum', 'attraction', 'gallery', 'viewpoint', 'zoo' })
+
+local greenness_landuse = set({ 'forest', 'grass', 'meadow', 'village_green', 'recreation_ground', 'vineyard',
+                                'flowerbed', 'farmland', 'heath', 'nature_reseve', 'park', 'greenfield' })
+local greenness_leisure = set({ 'garden', 'golf_course', 'park' })
+local greenness_natural = set({ 'tree', 'wood', 'grassland', 'heath', 'scrub' })
+
+-- z_order: layer and road class (simplified version of the osm2pgsql "default.style" ordering)
+local road_z_order = {
+    motorway = 9, trunk = 8, primary = 7, secondary = 6, tertiary = 5, residential = 3, unclassified = 3,
+    living_street = 3, road = 3, service = 2, motorway_link = 9, trunk_link = 8, primary_link = 7,
+    secondary_link = 6, tertiary_link = 5
+}
+
+-- ---------------------------------------------------------------------------------------------------------------------
+-- tables
+-- ---------------------------------------------------------------------------------------------------------------------
+
+-- column of a key in "tag_keys"
+local function tag_column(key)
+    return (key:gsub(':', '_'))
+end
+
+local line_columns = { { column = 'osm_id', type = 'int8' } }
+for _, key in ipairs(line_keys) do
+    table.insert(line_columns, { column = key, type = 'text' })
+end
+for _, key in ipairs(tag_keys) do
+    table.insert(line_columns, { column = tag_column(key), type = 'text' })
+end
+table.insert(line_columns, { column = 'z_order', type = 'int4' })
+table.insert(line_columns, { column = 'way_area', type = 'real' })
+table.insert(line_columns, { column = 'way', type = 'linestring', projection = srid, not_null = true })
+
+local tables = {}
+
+-- osm_id: way id or negative relation id (as with the pgsql output); osm_ref / osm_type: object for updates
+tables.line = osm2pgsql.define_table({
+    name = prefix .. '_line', schema = schema,
+    ids = { type = 'any', id_column = 'osm_ref', type_column = 'osm_type' },
+    columns = line_columns
+})
+
+local function define_context_table(name, geometry_type)
+    return osm2pgsql.define_table({
+        name = prefix .. '_' .. name, schema = schema,
+        ids = { type = 'any', id_column = 'osm_ref', type_column = 'osm_type' },
+        columns = { { column = 'geom', type = geometry_type, projection = srid, not_null = true } }
+    })
+end
+
+tables.building = define_context_table('building', 'polygon')
+tables.crossing = define_context_table('crossing', 'geometry')
+tables.facility = define_context_table('facility', 'geometry')
+tables.greenness = define_context_table('greenness', 'polygon')
+tables.water = define_context_table('water', 'geometry')
+
+-- ---------------------------------------------------------------------------------------------------------------------
+-- helpers
+-- ---------------------------------------------------------------------------------------------------------------------
+
+local function is_area(object)
+    local tags = object.tags
+    if tags.area == 'no' then
+        return false
+    end
+    if tags.area == 'yes' or tags.area == '1' or tags.area == 'true' then
+        return true
+    end
+    for _, key in ipairs(polygon_keys) do
+        if tags[key] then
+            return true
+        end
+    end
+    return false
+end
+
+local function is_network(tags)
+    return tags.highway or tags.railway or tags.aerialway
+end
+
+local function is_facility(tags)
+    return facility_amenity[tags.amenity] or facility_tourism[tags.tourism]
+end
+
+local function is_greenness(tags)
+    return greenness_landuse[tags.landuse] or greenness_leisure[tags.leisure] or greenness_natural[tags.natural]
+end
+
+local function is_water(tags)
+    return (tags.waterway or tags.natural == 'water') and not tags.tunnel
+end
+
+local function line_row(osm_id, tags)
+    local row = { osm_id = osm_id }
+    for _, key in ipairs(line_keys) do
+        row[key] = tags[key]
+    end
+    for _, key in ipairs(tag_keys) do
+        row[tag_column(key)] = tags[key]
+    end
+    row.z_order = (tonumber(tags.layer) or 0) * 10 + (road_z_order[tags.highway] or 0)
+    return row
+end
+
+-- inserts each part of a (multi-)polygon as separate row (as with the pgsql output)
+local function insert_polygons(tbl, geom)
+    for part in geom:geometries() do
+        tbl:insert({ geom = part })
+    end
+end
+
+local function insert_area(object, geom)
+    local tags = object.tags
+    if tags.building then
+        insert_polygons(tables.building, geom)
+    end
+    if tags.highway == 'crossing' then
+        insert_polygons(tables.crossing, geom)
+    end
+    if is_facility(tags) then
+        insert_polygons(tables.facility, geom)
+    end
+    if is_greenness(tags) then
+        insert_polygons(tables.greenness, geom)
+    end
+    if is_water(tags) then
+        insert_polygons(tables.water, geom)
+    end
+end
+
+-- ---------------------------------------------------------------------------------------------------------------------
+-- processing callbacks
+-- ---------------------------------------------------------------------------------------------------------------------
+
+function osm2pgsql.process_node(object)
+    local tags = object.tags
+    if tags.highway == 'crossing' then
+        tables.crossing:insert({ geom = object:as_point() })
+    end
+    if is_facility(tags) then
+        tables.facility:insert({ geom = object:as_point() })
+    end
+end
+
+function osm2pgsql.process_way(object)
+    local tags = object.tags
+    if object.is_closed and is_area(object) then
+        insert_area(object, object:as_polygon())
+        return
+    end
+    if is_network(tags) then
+        local row = line_row(object.id, tags)
+        row.way = object:as_linestring()
+        tables.line:insert(row)
+    end
+    if tags.highway == 'crossing' then
+        tables.crossing:insert({ geom = object:as_linestring() })
+    end
+    if is_water(tags) then
+        tables.water:insert({ geom = object:as_linestring() })
+    end
+end
+
+function osm2pgsql.process_relation(object)
+    local tags = object.tags
+    if tags.type == 'multipolygon' then
+        insert_area(object, object:as_multipolygon())
+    elseif tags.type == 'route' and tags.route == 'bicycle' then
+        -- bicycle routes (indicator "designated_route"): one row per merged line
+        for line in object:as_multilinestring():line_merge():geometries() do
+            local row = line_row(-object.id, tags)
+            row.way = line
+            tables.line:insert(row)
+        end
+    end
+end
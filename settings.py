@@ -25,6 +25,14 @@ class GlobalSettings:
 
     case_id = "default_net"
 
+    # default number of concurrent workers (database connections / threads) for steps that support parallel execution
+    max_workers: int = 4
+
+    # if enabled, fingerprints of inputs are stored per step / attribute indicator - unchanged parts are skipped on re-run
+    cache_enabled: bool = False
+    # if enabled, input tables are fingerprinted by a checksum of their content instead of their metadata
+    cache_content_hash: bool = False
+
 
 @dataclass
 class DbSettings:
@@ -15,7 +15,7 @@ BEGIN
         indoor_links AS (
             SELECT id AS link_id, geom
             FROM network_corrected
-            WHERE tags -> 'indoor' = 'yes'
+            WHERE id IN (SELECT id FROM indoor_link)
         ),
         intersections_links AS (
             SELECT a.link_id
@@ -50,7 +50,7 @@ BEGIN
             indoor_links AS (
                 SELECT id AS link_id, geom
                 FROM network_corrected
-                WHERE tags -> 'indoor' = 'yes'
+                WHERE id IN (SELECT id FROM indoor_link)
             ),
             intersections_links AS (
                 SELECT a.link_id
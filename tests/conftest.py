@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# schema for all tables and functions created by database tests (dropped afterwards)
+TEST_SCHEMA = "netascore_test"
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # SQL templates and example profiles are referenced relative to the repository root
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture(scope="module")
+def db():
+    """Connection to the PostgreSQL database given by the environment variables NETASCORE_TEST_DB (database name),
+    NETASCORE_TEST_DB_HOST, NETASCORE_TEST_DB_PORT, NETASCORE_TEST_DB_USER and NETASCORE_TEST_DB_PASSWORD. Tests
+    using it are skipped if NETASCORE_TEST_DB is not set."""
+    dbname = os.environ.get("NETASCORE_TEST_DB")
+    if not dbname:
+        pytest.skip("no test database configured (NETASCORE_TEST_DB)")
+    from toolbox.dbhelper import PostgresConnection
+    connection = PostgresConnection(dbname, os.environ.get("NETASCORE_TEST_DB_USER", "postgres"),
+                                    os.environ.get("NETASCORE_TEST_DB_PASSWORD", "postgres"),
+                                    os.environ.get("NETASCORE_TEST_DB_HOST", "localhost"),
+                                    int(os.environ.get("NETASCORE_TEST_DB_PORT", 5432)), on_existing="delete")
+    connection.connect()
+    connection.drop_schema(TEST_SCHEMA, cascade=True)
+    connection.create_schema(TEST_SCHEMA)
+    connection.schema = TEST_SCHEMA
+    connection.commit()
+    yield connection
+    connection.rollback()
+    connection.drop_schema(TEST_SCHEMA, cascade=True)
+    connection.close(commit_before_close=True)
@@ -0,0 +1,144 @@
+import copy
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+
+from core.index_inmemory import AttributeColumn, AttributeMatrix, evaluate_direction
+from core.index_step import INDEX_INDICATOR_COLUMNS, _build_index_function_params, _build_sql_index_function_call, \
+    _build_sql_index_inline, _compare_index_engines, load_profiles
+from tests.conftest import TEST_SCHEMA
+
+PROFILES = [
+    {'profile_name': 'bike', 'filename': 'profile_bike.yml', 'filter_access_bike': True},
+    {'profile_name': 'walk', 'filename': 'profile_walk.yml', 'filter_access_walk': True},
+]
+
+# column types of "network_edge_attributes" (as in the arguments of the "calculate_index" function)
+CATEGORICAL_INDICATORS = ['bicycle_infrastructure', 'pedestrian_infrastructure', 'designated_route', 'road_category',
+                          'parking', 'pavement']
+BOOLEAN_INDICATORS = ['water']
+
+GRID_SIZE = 2000
+
+
+def _load_profile(name: str):
+    return [p for p in load_profiles("examples", PROFILES) if p.profile_name == name][0]
+
+
+def _candidate_values(profiles) -> dict:
+    """Attribute values per indicator which hit every key of the profiles' mappings and classes (including the class
+    boundaries), as well as unmapped values and NULL."""
+    values = {name: {None} for name, _, _ in INDEX_INDICATOR_COLUMNS}
+    values.update({name: {None, 'unmapped'} for name in CATEGORICAL_INDICATORS})
+    values.update({name: {None, True, False} for name in BOOLEAN_INDICATORS})
+
+    def collect(mapping: dict):
+        name = mapping['indicator']
+        kind = 'mapping' if 'mapping' in mapping else 'classes'
+        for key, value in mapping[kind].items():
+            if isinstance(value, dict):
+                collect(value)
+            if key is None or str(key) == '_default_' or name in BOOLEAN_INDICATORS:
+                continue
+            keys = [k.strip() for k in str(key)[1:-1].split(',')] if str(key).startswith('{') else [key]
+            for k in keys:
+                if name in CATEGORICAL_INDICATORS:
+                    values[name].add(str(k).lower() if isinstance(k, bool) else str(k))
+                elif kind == 'classes':
+                    bound = float(re.sub('[a-zA-Z]', '', str(k)))
+                    values[name].update([bound - 1, bound - 0.5, bound, bound + 0.5, bound + 1])
+                else:
+                    values[name].add(float(k))
+
+    for p in profiles:
+        for mapping in p.profile['indicator_mapping'] + p.profile['overrides']:
+            collect(copy.deepcopy(mapping))
+    return {name: sorted(v, key=lambda x: (x is None, str(type(x)), x if x is not None else 0)) for name, v in values.items()}
+
+
+@pytest.fixture(scope="module")
+def grid() -> pd.DataFrame:
+    """Fixed attribute grid: random (seeded) combinations of the candidate values per column and direction."""
+    profiles = load_profiles("examples", PROFILES)
+    candidates = _candidate_values(profiles)
+    rng = np.random.default_rng(42)
+    data = {'edge_id': np.arange(1, GRID_SIZE + 1)}
+    for name, ft, tf in INDEX_INDICATOR_COLUMNS:
+        for column in dict.fromkeys([ft, tf]):
+            data[column] = [candidates[name][i] for i in rng.integers(0, len(candidates[name]), GRID_SIZE)]
+    return pd.DataFrame(data)
+
+
+def _matrix(grid: pd.DataFrame) -> AttributeMatrix:
+    columns = {}
+    for name, ft, tf in INDEX_INDICATOR_COLUMNS:
+        for column in [ft, tf]:
+            if name in CATEGORICAL_INDICATORS:
+                cat = pd.Categorical(grid[column])
+                columns[column] = AttributeColumn(cat.codes.astype(np.int32), cat.categories.to_numpy(dtype=str))
+            else:
+                columns[column] = AttributeColumn(np.array([np.nan if v is None else float(v) for v in grid[column]]))
+    return AttributeMatrix(grid['edge_id'].to_numpy(), columns)
+
+
+def _create_attributes_table(db, grid: pd.DataFrame):
+    types = {name: 'varchar' if name in CATEGORICAL_INDICATORS else 'boolean' if name in BOOLEAN_INDICATORS else 'numeric'
+             for name, _, _ in INDEX_INDICATOR_COLUMNS}
+    columns = {column: types[name] for name, ft, tf in INDEX_INDICATOR_COLUMNS for column in [ft, tf]}
+    db.drop_table("network_edge_attributes", schema=TEST_SCHEMA)
+    db.ex(f"CREATE TABLE {TEST_SCHEMA}.network_edge_attributes (edge_id integer PRIMARY KEY, "
+          + ", ".join(f"{column} {column_type}" for column, column_type in columns.items()) + ");")
+    rows = [tuple(None if pd.isna(v) else v.item() if hasattr(v, 'item') else v for v in row)
+            for row in grid[['edge_id'] + list(columns)].itertuples(index=False)]
+    db.cur.executemany(f"INSERT INTO {TEST_SCHEMA}.network_edge_attributes VALUES ({', '.join(['%s'] * (len(columns) + 1))})", rows)
+    db.commit()
+
+
+def test_compiling_does_not_modify_profiles():
+    for p in load_profiles("examples", PROFILES):
+        with open(f"examples/{[d['filename'] for d in PROFILES if d['profile_name'] == p.profile_name][0]}") as file:
+            original = yaml.safe_load(file)
+        _build_index_function_params(p, True)
+        for direction in ["ft", "tf", None]:
+            _build_sql_index_inline(p.profile, p.profile['weights'], direction, True)
+        assert p.profile == original
+
+
+def test_candidate_values_cover_profiles(grid):
+    # every mapped category of the shipped profiles occurs in the grid
+    assert 'bicycle_way' in set(grid['bicycle_infrastructure_ft'])
+    assert 'cobble' in set(grid['pavement'])
+    assert grid['max_speed_ft'].isna().any()
+
+
+@pytest.mark.parametrize("profile_name", ["bike", "walk"])
+def test_index_engines_identical(db, grid, profile_name):
+    p = _load_profile(profile_name)
+    weights = p.profile['weights']
+    _create_attributes_table(db, grid)
+
+    # function engine ("calculate_index") and inline SQL engine: identical results incl. robustness and explanation
+    f_params = _build_index_function_params(p, True)
+    db.execute_template_sql_from_file("calculate_index", f_params, template_subdir="sql/functions/")
+    db.schema = TEST_SCHEMA
+    compare_params = {'schema_network': TEST_SCHEMA}
+    for d in ["ft", "tf"]:
+        compare_params[f'index_function_{d}'] = _build_sql_index_function_call(f_params['function_name'], weights, d)
+        compare_params[f'index_sql_{d}'] = _build_sql_index_inline(p.profile, weights, d, True)
+    _compare_index_engines(db, profile_name, compare_params)
+
+    # in-memory evaluation: same index and robustness (within rounding to 4 digits)
+    matrix = _matrix(grid)
+    for d in ["ft", "tf"]:
+        rows = db.query_all(f"""SELECT s.index, s.index_robustness
+            FROM {TEST_SCHEMA}.network_edge_attributes b, LATERAL {_build_sql_index_inline(p.profile, weights, d, False)} s
+            ORDER BY b.edge_id""")
+        index_sql = np.array([np.nan if r[0] is None else float(r[0]) for r in rows])
+        robustness_sql = np.array([np.nan if r[1] is None else float(r[1]) for r in rows])
+        index, robustness = evaluate_direction(matrix, p.profile, d)
+        assert np.isnan(index_sql).sum() < len(rows)
+        np.testing.assert_allclose(index, index_sql, rtol=0, atol=1e-4 + 1e-9, equal_nan=True)
+        np.testing.assert_allclose(robustness, robustness_sql, rtol=0, atol=1e-4 + 1e-9, equal_nan=True)
@@ -0,0 +1,176 @@
+import glob
+import inspect
+import re
+
+import pytest
+
+from core.import_step import OsmImporter, get_prefilter_expressions
+
+# osm2pgsql output tables and the OSM object types (as in osmium tags-filter expressions) their rows are created from
+TABLE_OBJECT_TYPES = {'osm_point': 'n', 'osm_line': 'wr', 'osm_polygon': 'wr'}
+
+# callbacks / functions of "netascore.lua" which select objects by their tags and the object types they are applied to
+LUA_SELECTORS = {
+    'osm2pgsql.process_node': 'n',
+    'osm2pgsql.process_way': 'w',
+    'osm2pgsql.process_relation': 'r',
+    'insert_area': 'wr',
+    'is_network': 'wr',
+    'is_facility': 'nwr',
+    'is_greenness': 'wr',
+    'is_water': 'wr',
+}
+
+# keys that do not select objects by themselves (structure of relations, osm2pgsql columns)
+NON_SELECTING_KEYS = {'osm_id', 'type'}
+
+SQL_SELECTOR = re.compile(r"""^"?(\w+)"?\s*(?:IN\s*\((?P<list>[^()]*)\)|=\s*(?P<value>'[^']*')|IS\s+NOT\s+NULL)$""",
+                          re.IGNORECASE)
+
+
+def _coverage(expressions) -> dict:
+    """Keys covered by the given tag filter expressions per object type - None: any value, otherwise the set of values."""
+    coverage = {t: {} for t in 'nwr'}
+    for expression in expressions:
+        types, _, tag = expression.partition('/')
+        key, _, value = tag.partition('=')
+        for t in types:
+            if not value:
+                coverage[t][key] = None
+            elif coverage[t].get(key, set()) is not None:
+                coverage[t].setdefault(key, set()).add(value)
+    return coverage
+
+
+def _is_covered(coverage: dict, types: str, key: str, values: set = None) -> bool:
+    for t in types:
+        if key in coverage[t] and (coverage[t][key] is None or (values and values <= coverage[t][key])):
+            return True
+    return False
+
+
+def _split(expression: str, operator: str):
+    """Splits an SQL / Lua expression at the given operator outside of parentheses and string literals."""
+    parts, depth, start, i = [], 0, 0, 0
+    pattern = re.compile(rf"\s{operator}\s", re.IGNORECASE)
+    while i < len(expression):
+        c = expression[i]
+        if c == "'":
+            i = expression.index("'", i + 1)
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and (m := pattern.match(expression, i)):
+            parts.append(expression[start:i])
+            start = i = m.end()
+            continue
+        i += 1
+    return [p.strip() for p in parts + [expression[start:]]]
+
+
+def _unwrap(expression: str) -> str:
+    """Removes enclosing parentheses."""
+    expression = expression.strip()
+    while expression.startswith('(') and expression.endswith(')'):
+        depth = 0
+        for i, c in enumerate(expression):
+            depth += {'(': 1, ')': -1}.get(c, 0)
+            if depth == 0 and i < len(expression) - 1:
+                return expression
+        expression = expression[1:-1].strip()
+    return expression
+
+
+def _where_clauses(sql: str):
+    """Yields the table and the WHERE condition of all queries reading one of the osm2pgsql output tables."""
+    for m in re.finditer(r"\bFROM\s+(osm_point|osm_line|osm_polygon)\b(?:\s+(?!WHERE\b)\w+)?\s+WHERE\b", sql, re.IGNORECASE):
+        depth, i = 0, m.end()
+        while i < len(sql):
+            c = sql[i]
+            if c == "'":
+                i = sql.index("'", i + 1)
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                if depth == 0:
+                    break
+                depth -= 1
+            elif depth == 0 and (c == ';' or re.match(r"\s(UNION|GROUP\s+BY|ORDER\s+BY|LIMIT)\b", sql[i:], re.IGNORECASE)):
+                break
+            i += 1
+        yield m.group(1), sql[m.end():i]
+
+
+def _sql_selector(expression: str):
+    """Key and values (None: any value) of a condition selecting objects by a tag, otherwise None."""
+    m = SQL_SELECTOR.match(_unwrap(expression))
+    if not m or m.group(1).lower() in NON_SELECTING_KEYS:
+        return None
+    values = m.group('list') or m.group('value')
+    return m.group(1), set(re.findall(r"'([^']*)'", values)) if values else None
+
+
+def _sql_sources():
+    """SQL reading the osm2pgsql output tables: templates (all optional blocks included) and the derived datasets."""
+    sources = {}
+    for path in glob.glob("sql/**/*.sql.j2", recursive=True) + glob.glob("sql/**/*.sql", recursive=True):
+        with open(path) as file:
+            sources[path] = file.read()
+    sources['OsmImporter._create_osm_datasets'] = inspect.getsource(OsmImporter._create_osm_datasets)
+    for name, sql in sources.items():
+        sql = re.sub(r"\{#.*?#\}|\{%.*?%\}", "", sql, flags=re.DOTALL)
+        sql = re.sub(r"\{\{.*?\}\}", "0", sql, flags=re.DOTALL)
+        sources[name] = re.sub(r"--[^\n]*", "", sql)
+    return sources
+
+
+def _lua_function(source: str, name: str) -> str:
+    m = re.search(rf"^(?:local )?function {re.escape(name)}\(.*?^end$", source, re.MULTILINE | re.DOTALL)
+    assert m, f"function '{name}' not found in netascore.lua"
+    return m.group(0)
+
+
+@pytest.fixture(scope="module")
+def coverage() -> dict:
+    return _coverage(get_prefilter_expressions({'include_rail': True, 'include_aerialway': True}))
+
+
+def test_sql_selects_covered_keys(coverage):
+    checked = 0
+    for name, sql in _sql_sources().items():
+        for table, condition in _where_clauses(sql):
+            conjuncts = [[_sql_selector(d) for d in _split(_unwrap(c), 'OR')] for c in _split(condition, 'AND')]
+            if not any(s for selectors in conjuncts for s in selectors):
+                # rows selected by id only (e.g. update mode)
+                continue
+            checked += 1
+            # objects are only kept if they match one of the filter expressions: one of the conjuncts must only consist
+            # of conditions on covered keys (and values)
+            assert any(all(s and _is_covered(coverage, TABLE_OBJECT_TYPES[table], *s) for s in selectors)
+                       for selectors in conjuncts), \
+                f"{name}: '{table}' rows selected by keys not covered by OSM_PREFILTER_EXPRESSIONS: {condition.strip()}"
+    assert checked >= 10
+
+
+def test_flex_style_selects_covered_keys(coverage):
+    with open("resources/netascore.lua") as file:
+        source = file.read()
+    for function, types in LUA_SELECTORS.items():
+        body = _lua_function(source, function)
+        for m in re.finditer(r"(not\s+)?tags\.(\w+)(?:\s*==\s*'([^']*)')?|\w+\[tags\.(\w+)\]", body):
+            key = m.group(2) or m.group(4)
+            if m.group(1) or key in NON_SELECTING_KEYS:
+                continue
+            values = {m.group(3)} if m.group(3) else None
+            assert _is_covered(coverage, types, key, values), \
+                f"netascore.lua ({function}): objects selected by key '{key}' not covered by OSM_PREFILTER_EXPRESSIONS"
+
+
+def test_uncovered_key_detected(coverage):
+    # the check itself: a selection by a key missing in the filter expressions is reported
+    sql = "SELECT geom FROM osm_point WHERE amenity IN ('bench') OR shop IS NOT NULL;"
+    (table, condition), = _where_clauses(sql)
+    selectors = [_sql_selector(d) for d in _split(condition, 'OR')]
+    assert [s[0] for s in selectors] == ['amenity', 'shop']
+    assert not all(_is_covered(coverage, TABLE_OBJECT_TYPES[table], *s) for s in selectors)
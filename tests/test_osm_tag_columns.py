@@ -0,0 +1,67 @@
+import glob
+import re
+
+import pytest
+
+from toolbox.dbhelper import prepare_template_sql
+
+MACRO_FILE = "sql/templates/macros/osm.sql.j2"
+
+# templates reading the osm2pgsql output (directly or via "network_edge")
+OSM_TEMPLATES = ["sql/templates/osm_network.sql.j2"] + sorted(glob.glob("sql/templates/osm_attributes/*.sql.j2"))
+
+PARAMS = {
+    'schema_network': 'network', 'schema_data': 'data', 'target_srid': 32633, 'osm_geom': 'way', 'include_rail': True,
+    'include_aerialway': True, 'update': False, 'update_distance': 100, 'table_dem': None, 'table_noise': None,
+    'table_route_member': 'osm_route_member', 'tile_ids': [1, 2], 'tile_batch': 1, 'tile_insert': True
+}
+
+
+def _strings(source: str) -> list:
+    return re.findall(r"'([^']*)'", source)
+
+
+def _lua_list(name: str) -> list:
+    with open("resources/netascore.lua") as file:
+        m = re.search(rf"^local {name} = \{{(.*?)^\}}", file.read(), re.MULTILINE | re.DOTALL)
+    assert m, f"list '{name}' not found in netascore.lua"
+    return _strings(m.group(1))
+
+
+def _flex_tag_keys() -> list:
+    with open(MACRO_FILE) as file:
+        m = re.search(r"\{% set flex_tag_keys = \[(.*?)\] %\}", file.read(), re.DOTALL)
+    return _strings(m.group(1))
+
+
+def _code(sql: str) -> str:
+    return re.sub(r"--[^\n]*", "", sql)
+
+
+def test_flex_tag_keys_match_style():
+    assert _flex_tag_keys() == _lua_list("tag_keys")
+    # keys with a "default.style" column are not written twice
+    assert not set(_flex_tag_keys()) & set(_lua_list("line_keys"))
+
+
+def test_templates_read_tags_via_macro():
+    columns = set(_flex_tag_keys()) | set(_lua_list("line_keys"))
+    for path in OSM_TEMPLATES:
+        with open(path) as file:
+            sql = _code(file.read())
+        assert not re.search(r"\btags\b", sql), f"{path}: tags read from hstore column instead of macro 'tag'"
+        for key in re.findall(r"\btag\('([^']*)'", sql):
+            assert key in columns, f"{path}: key '{key}' is not written to a column by netascore.lua"
+
+
+@pytest.mark.parametrize("path", OSM_TEMPLATES)
+def test_rendered_columns(path):
+    with open(path) as file:
+        template = file.read()
+    flex, _ = prepare_template_sql(template, dict(PARAMS, osm2pgsql_output='flex'))
+    pgsql, _ = prepare_template_sql(template, dict(PARAMS, osm2pgsql_output='pgsql'))
+    assert not re.search(r"\btags\b", _code(flex))
+    if "tag(" in template:
+        assert re.search(r"\(\w*\.?tags -> '[^']+'\)", _code(pgsql))
+    if "tag_columns()" in template:
+        assert "cycleway_left" in flex and "cycleway_left" not in pgsql
@@ -0,0 +1,179 @@
+import glob
+import os
+import re
+import threading
+import urllib.parse
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from toolbox.overpass import OSM_ELEMENT_TYPES, download_bbox, merge_osm_files, split_bbox
+
+BBOX = "0,0,1,1"
+
+# canned OSM elements (type, id, lat, lon): ways and relations are located at a single point - elements on tile borders
+# are part of the result of all adjacent tiles
+ELEMENTS = [
+    ("node", 1, 0.2, 0.2),
+    ("node", 2, 0.5, 0.5),
+    ("node", 3, 0.5, 0.8),
+    ("node", 4, 0.9, 0.1),
+    ("node", 5, 1.0, 1.0),
+    ("node", 6, 1.5, 1.5),
+    ("way", 10, 0.5, 0.3),
+    ("way", 11, 0.7, 0.7),
+    ("relation", 20, 0.5, 0.5),
+]
+
+
+def _element_xml(element_type: str, element_id: int, lat: float, lon: float) -> str:
+    if element_type == "node":
+        return f'<node id="{element_id}" lat="{lat}" lon="{lon}"><tag k="name" v="n{element_id}"/></node>'
+    if element_type == "way":
+        return f'<way id="{element_id}"><nd ref="1"/><nd ref="2"/></way>'
+    return f'<relation id="{element_id}"><member type="node" ref="2" role=""/></relation>'
+
+
+def _osm_xml(tile) -> str:
+    """Overpass API result for the given tile: all elements within the tile, ordered by type and id."""
+    south, west, north, east = tile
+    elements = sorted((element for element in ELEMENTS if south <= element[2] <= north and west <= element[3] <= east),
+                      key=lambda element: (OSM_ELEMENT_TYPES.index(element[0]), element[1]))
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="Overpass API">\n' + \
+        "".join(f"  {_element_xml(*element)}\n" for element in elements) + "</osm>\n"
+
+
+class OverpassHandler(BaseHTTPRequestHandler):
+    """Answers Overpass queries with the canned elements - or with an error for failing servers / tiles."""
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)["data"][0]
+        tile = tuple(float(v) for v in re.search(r"nwr\(([^)]*)\)", query).group(1).split(","))
+        self.server.requests.append(tile)
+        if self.server.failing or tile in self.server.failing_tiles:
+            self.send_error(500)
+            return
+        body = _osm_xml(tile).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/osm3s+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def overpass():
+    """Starts local Overpass API servers - returns a function (failing: bool) -> (server, endpoint url)."""
+    servers = []
+
+    def start(failing: bool = False):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), OverpassHandler)
+        server.failing = failing
+        server.failing_tiles = set()
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, f"http://127.0.0.1:{server.server_port}/api/interpreter"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _download(cache_dir: str, endpoints):
+    return download_bbox(BBOX, cache_dir, endpoints, tile_size=0.5, slots=2, interval=0, timeout=10)
+
+
+def _merged_elements(path: str):
+    return [(e.tag, int(e.get("id"))) for e in ET.parse(path).getroot()]
+
+
+def _expected_elements():
+    return sorted({(t, i) for t, i, lat, lon in ELEMENTS if 0 <= lat <= 1 and 0 <= lon <= 1},
+                  key=lambda e: (OSM_ELEMENT_TYPES.index(e[0]), e[1]))
+
+
+def test_split_bbox():
+    assert split_bbox((0, 0, 1, 1), 0.5) == [(0, 0, 0.5, 0.5), (0, 0.5, 0.5, 1), (0.5, 0, 1, 0.5), (0.5, 0.5, 1, 1)]
+    # a single tile if the bbox is smaller than the tile size
+    assert split_bbox((47.1, 13.2, 47.15, 13.3), 0.5) == [(47.1, 13.2, 47.15, 13.3)]
+    # no additional (sliver) tiles due to floating point errors, last tiles end exactly at the bbox
+    tiles = split_bbox((47.0, 13.0, 47.3, 13.3), 0.1)
+    assert len(tiles) == 9
+    assert max(t[2] for t in tiles) == 47.3 and max(t[3] for t in tiles) == 13.3
+    tiles = split_bbox((0, 0, 0.25, 1), 0.1)
+    assert len(tiles) == 3 * 10
+    assert all(t[2] - t[0] <= 0.1 + 1e-7 and t[3] - t[1] <= 0.1 + 1e-7 for t in tiles)
+    # adjacent tiles share their borders
+    assert {(t[0], t[2]) for t in tiles} == {(0, 0.0833333), (0.0833333, 0.1666667), (0.1666667, 0.25)}
+
+
+def test_merge_osm_files(tmp_path):
+    files = {
+        "a.osm": '<node id="1" lat="0" lon="0"/><node id="3" lat="0" lon="0"><tag k="name" v="a"/></node>'
+                 '<node id="5" lat="0" lon="0"/><way id="3"><nd ref="1"/></way>',
+        "b.osm": '<node id="2" lat="0" lon="0"/><node id="3" lat="0" lon="0"><tag k="name" v="a"/></node>'
+                 '<node id="6" lat="0" lon="0"/><way id="3"><nd ref="1"/></way><relation id="1"/>',
+        "c.osm": '<note>empty result</note><meta osm_base="2024-01-01T00:00:00Z"/>',
+    }
+    paths = []
+    for name, content in files.items():
+        path = tmp_path / name
+        path.write_text(f'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">{content}</osm>\n', encoding="utf-8")
+        paths.append(str(path))
+    target = str(tmp_path / "merged.osm")
+    merge_osm_files(paths, target)
+    assert _merged_elements(target) == [("node", 1), ("node", 2), ("node", 3), ("node", 5), ("node", 6), ("way", 3),
+                                        ("relation", 1)]
+    assert ET.parse(target).getroot().find("node[@id='3']/tag").get("v") == "a"
+    assert not os.path.exists(f"{target}.part")
+
+
+def test_endpoint_fallback(tmp_path, overpass):
+    failing, failing_url = overpass(failing=True)
+    server, url = overpass()
+    files = _download(str(tmp_path), [failing_url, url])
+    # tiles start at different endpoints: tiles tried on the failing endpoint first are downloaded from the other one
+    assert failing.requests
+    assert sorted(server.requests) == sorted(split_bbox((0, 0, 1, 1), 0.5))
+    assert all(os.path.isfile(f) for f in files)
+
+
+def test_download_fails_on_all_endpoints(tmp_path, overpass):
+    _, url_1 = overpass(failing=True)
+    _, url_2 = overpass(failing=True)
+    with pytest.raises(Exception, match="failed for 4 of 4 tiles"):
+        _download(str(tmp_path), [url_1, url_2])
+    assert not os.listdir(tmp_path)
+
+
+def test_resume_partial_download(tmp_path, overpass):
+    server, url = overpass()
+    tiles = split_bbox((0, 0, 1, 1), 0.5)
+    server.failing_tiles = {tiles[3]}
+    with pytest.raises(Exception, match="failed for 1 of 4 tiles"):
+        _download(str(tmp_path), [url])
+    # complete tiles are cached, no partial files are left behind
+    assert len(glob.glob(str(tmp_path / "*.osm"))) == 3
+    assert not glob.glob(str(tmp_path / "*.part"))
+
+    # re-run: only the missing tile is downloaded
+    server.failing_tiles = set()
+    server.requests = []
+    files = _download(str(tmp_path), [url])
+    assert server.requests == [tiles[3]]
+
+    # cache hit: nothing is downloaded
+    server.requests = []
+    assert _download(str(tmp_path), [url]) == files
+    assert server.requests == []
+
+    # elements on tile borders are contained in multiple tiles, but only once in the merged file
+    target = str(tmp_path / "merged.osm")
+    merge_osm_files(files, target)
+    assert _merged_elements(target) == _expected_elements()
@@ -1,8 +1,15 @@
 import psycopg2 as psy
 import toolbox.helper as h
+from contextlib import contextmanager
+from jinja2 import Environment, FileSystemLoader
 from jinjasql import JinjaSql
 from typing import List
+import queue
 import re
+import threading
+
+# directory of shared template files (e.g. macros) imported by SQL templates
+TEMPLATE_ROOT = "sql/templates"
 
 
 class PostgresConnection:
@@ -193,6 +200,14 @@ class PostgresConnection:
             WHERE table_schema=%s AND table_name=%s AND column_name=%s)""",
                               (schema, table, column_name))[0]
 
+    def get_srid(self, table: str, column: str = "geom", schema: str = None) -> int:
+        """Returns the SRID registered for the given geometry column (or None if the column is not registered)."""
+        if schema == None:
+            schema = self.schema
+        result = self.query_one("""SELECT srid FROM geometry_columns
+            WHERE f_table_schema=%s AND f_table_name=%s AND f_geometry_column=%s""", (schema, table, column))
+        return result[0] if result else None
+
     def set_autocommit(self, autocommit: bool, pre_commit: bool = True):
         if autocommit:
             if pre_commit:
@@ -308,8 +323,7 @@ class PostgresConnection:
         # if override_parameters are given, check whether given keys exist in params and replace them accordingly
         template_params = h.overrideParams(parameters, override_parameters)
 
-        j = JinjaSql(param_style='pyformat')
-        query, bind_params = j.prepare_query(template, template_params)
+        query, bind_params = prepare_template_sql(template, template_params)
         h.log("query: " + str(query), h.LOG_LEVEL_4_DEBUG)
         #dbg_file = open("debug_sql.sql", "w")
         #n = dbg_file.write(query)
@@ -332,4 +346,67 @@ class PostgresConnection:
             self.set_autocommit(True, pre_commit=True) # set autocommit TRUE, so VACUUM can take place in SQL
         self.execute_sql_template_string(sql, parameters, override_parameters)
         if autocommit:
-            self.set_autocommit(False) # reset to manual commit mode
\ No newline at end of file
+            self.set_autocommit(False) # reset to manual commit mode
+
+
+def prepare_template_sql(template: str, parameters: dict):
+    """Renders a JinjaSql template (string) - returns the SQL and its bind parameters. Templates may import shared
+    macros from TEMPLATE_ROOT, e.g. {% from "macros/osm.sql.j2" import tag with context %}."""
+    j = JinjaSql(env=Environment(loader=FileSystemLoader(TEMPLATE_ROOT)), param_style='pyformat')
+    return j.prepare_query(template, parameters)
+
+
+def transform_sql(column: str, srid: int, target_srid: int) -> str:
+    """SQL expression for the given geometry column in the target SRID - only transformed if the SRIDs differ."""
+    if srid == target_srid:
+        return column
+    return f"ST_Transform({column}, {int(target_srid)})"
+
+
+class PostgresConnectionPool:
+    """Bounded pool of database connections, e.g. for executing SQL from several worker threads concurrently."""
+
+    def __init__(self, settings_object, size: int, schema: str = None):
+        self._settings_object = settings_object
+        self._schema = schema
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, size))
+        self._lock = threading.Lock()
+        self._connections: List[PostgresConnection] = []
+
+    def _open(self) -> PostgresConnection:
+        db = PostgresConnection.from_settings_object(self._settings_object)
+        db.connect()
+        if self._schema is not None:
+            db.schema = self._schema
+        with self._lock:
+            self._connections.append(db)
+        return db
+
+    def _discard(self, db: PostgresConnection):
+        with self._lock:
+            self._connections.remove(db)
+        db.close()
+
+    @contextmanager
+    def connection(self):
+        # blocks until one of the pool's slots is available - at most 'size' connections are in use at the same time
+        with self._slots:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                db = self._open()
+            try:
+                yield db
+            except BaseException:
+                # connection may be left in an undefined transaction state -> do not re-use it
+                self._discard(db)
+                raise
+            self._idle.put(db)
+
+    def close(self):
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for db in connections:
+            db.close()
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import uuid
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import toolbox.helper as h
+from toolbox.dbhelper import PostgresConnection
+
+FINGERPRINT_TABLE = "netascore_fingerprint"
+
+# prefix of the keys under which the run id of the import step is stored per table (see "record_import_run")
+IMPORT_RUN_KEY_PREFIX = "import_run:"
+
+
+def hash_values(*values) -> str:
+    """Returns a stable hash of the given (JSON-serializable) values, e.g. template text and parameters."""
+    m = hashlib.sha256()
+    for value in values:
+        m.update(json.dumps(value, sort_keys=True, default=str).encode("utf-8"))
+        m.update(b"\0")
+    return m.hexdigest()
+
+
+def template_fingerprint(template_file_name: str, parameters: dict, template_subdir: str = "sql/templates/") -> str:
+    """Fingerprint of the SQL rendered from the given template and parameters."""
+    with open(f"{template_subdir}{template_file_name}.sql.j2", "r") as sqlfile:
+        sql = sqlfile.read()
+    return hash_values(sql, parameters)
+
+
+def table_versions(db: PostgresConnection, schema: str) -> Dict[str, Tuple[int, int]]:
+    """oid and relfilenode per table of the given schema - both change if a table is re-created or re-written."""
+    rows = db.query_all("""SELECT c.relname, c.oid::bigint, c.relfilenode::bigint
+        FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relkind IN ('r', 'p')""", (schema,))
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def record_import_run(db: PostgresConnection, schema: str, before: Dict[str, Tuple[int, int]]):
+    """Stores a new import run id for all tables of the schema which were created or re-written since the given table
+    versions (see "table_versions") - the run id is part of the tables' fingerprints."""
+    run_id = f"{datetime.now().isoformat()}:{uuid.uuid4().hex}"
+    tables = [table for table, version in table_versions(db, schema).items()
+              if version != before.get(table) and table != FINGERPRINT_TABLE]
+    for table in tables:
+        store_fingerprint(db, schema, f"{IMPORT_RUN_KEY_PREFIX}{table}", run_id)
+    h.log(f"recorded import run '{run_id}' for {len(tables)} tables in schema '{schema}'")
+
+
+def table_fingerprint(db: PostgresConnection, table: str, schemas: List[str], content: bool = False) -> str:
+    """Fingerprint of a table, looked up in the given schemas (first match) - None if the table does not exist. By
+    default, only metadata is used: oid and relfilenode (changed if the table is re-created or re-written), its size,
+    the number of inserted, updated and deleted rows (statistics of PostgreSQL, updated with a short delay) and the run
+    id recorded by the import step. With 'content', row count and an order-independent checksum over all rows are used
+    instead - this reads the whole table."""
+    for schema in schemas:
+        if schema and db.exists(table, schema):
+            if content:
+                h.log(f"computing fingerprint of table '{schema}.{table}'")
+                row = db.query_one(f"SELECT count(*), coalesce(sum(hashtextextended(t::text, 0)::numeric), 0) FROM {schema}.{table} t")
+                return f"{row[0]}:{row[1]}"
+            row = db.query_one("""SELECT c.oid::bigint, c.relfilenode::bigint, pg_relation_size(c.oid),
+                    coalesce(s.n_tup_ins, 0), coalesce(s.n_tup_upd, 0), coalesce(s.n_tup_del, 0)
+                FROM pg_class c
+                    JOIN pg_namespace n ON n.oid = c.relnamespace
+                    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE n.nspname = %s AND c.relname = %s""", (schema, table))
+            run = None
+            if db.exists(FINGERPRINT_TABLE, schema):
+                run = db.query_one(f"SELECT fingerprint FROM {schema}.{FINGERPRINT_TABLE} WHERE key = %s",
+                                   (f"{IMPORT_RUN_KEY_PREFIX}{table}",))
+            return ":".join(str(value) for value in list(row) + [run[0] if run else ""])
+    return None
+
+
+class TableFingerprints:
+    """Computes fingerprints of (external) input tables at most once per run (see "table_fingerprint")."""
+
+    def __init__(self, db: PostgresConnection, schemas: List[str], content: bool = False):
+        self._db = db
+        self._schemas = schemas
+        self._content = content
+        self._cache: Dict[str, str] = {}
+
+    def get(self, table: str) -> str:
+        if table not in self._cache:
+            self._cache[table] = table_fingerprint(self._db, table, self._schemas, self._content)
+        return self._cache[table]
+
+
+def step_fingerprint(db: PostgresConnection, template_file_name: str, parameters: dict, inputs: List[str], schemas: List[str],
+                     template_subdir: str = "sql/templates/", content: bool = False) -> str:
+    """Fingerprint of a processing step which executes a single template on the given input tables."""
+    tables = TableFingerprints(db, schemas, content)
+    return hash_values(template_fingerprint(template_file_name, parameters, template_subdir), [tables.get(t) for t in inputs])
+
+
+def _ensure_fingerprint_table(db: PostgresConnection, schema: str):
+    db.ex(f"""CREATE TABLE IF NOT EXISTS {schema}.{FINGERPRINT_TABLE} (
+        key varchar PRIMARY KEY,
+        fingerprint varchar NOT NULL,
+        updated timestamp NOT NULL DEFAULT now()
+    );""")
+
+
+def is_unchanged(db: PostgresConnection, schema: str, key: str, fingerprint: str, outputs: List[str]) -> bool:
+    """Returns True if the stored fingerprint for 'key' matches and all output tables still exist."""
+    _ensure_fingerprint_table(db, schema)
+    row = db.query_one(f"SELECT fingerprint FROM {schema}.{FINGERPRINT_TABLE} WHERE key = %s", (key,))
+    db.commit()
+    if row is None or row[0] != fingerprint:
+        return False
+    return all(db.exists(output, schema) for output in outputs)
+
+
+def store_fingerprint(db: PostgresConnection, schema: str, key: str, fingerprint: str):
+    _ensure_fingerprint_table(db, schema)
+    db.ex(f"""INSERT INTO {schema}.{FINGERPRINT_TABLE} (key, fingerprint) VALUES (%s, %s)
+        ON CONFLICT (key) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, updated = now();""", (key, fingerprint))
+    db.commit()
+
+
+def invalidate_fingerprint(db: PostgresConnection, schema: str, key: str):
+    _ensure_fingerprint_table(db, schema)
+    db.ex(f"DELETE FROM {schema}.{FINGERPRINT_TABLE} WHERE key = %s", (key,))
+    db.commit()
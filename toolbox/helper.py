@@ -2,6 +2,7 @@ from functools import reduce
 import atexit
 from time import perf_counter as clock
 import sys
+import threading
 from typing import List
 from datetime import datetime as dt
 import re
@@ -57,26 +58,27 @@ def debugLog(msg: str):
 
 # task logging with time tracking
 
+# task name and start time are tracked per thread (tasks may run concurrently, e.g. optional importers)
+_task = threading.local()
+
 def logBeginTask(s, level = LOG_LEVEL_2_INFO):
-    global startT, taskS
     if(verbose_level < level):
         return
-    taskS = s
+    _task.name = s
     print()
     print(line)
     print(">>> at", dt.now().strftime('%H:%M:%S'), ">>> ", s, "")
-    startT = clock()
+    _task.start = clock()
 
 def logEndTask():
-    global taskS, startT
-    if taskS is None:
+    if getattr(_task, "name", None) is None:
         return
-    print(">>> ", taskS, "completed.")
+    print(">>> ", _task.name, "completed.")
     print(lineT)
-    print(lineTime, "took", secondsToStr(clock()-startT, detailed=True), lineTime)
+    print(lineTime, "took", secondsToStr(clock()-_task.start, detailed=True), lineTime)
     print(line)
     print()
-    taskS = None
+    _task.name = None
 
 def endlog():
     end = clock()
@@ -91,8 +93,6 @@ def get_current_log_level():
     return verbose_level
 
 start = clock()
-startT = clock()
-taskS = None
 atexit.register(endlog)
 log("Program started.")
 
@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import heapq
+import json
+import math
+import os
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Iterator, List, Optional, Tuple
+
+import toolbox.helper as h
+
+# Overpass query per tile: '__bbox__' is replaced by the tile bbox (south,west,north,east), '__date__' by an optional
+# date setting (e.g. '[date:"2023-01-01T00:00:00Z"]') for querying the state of OSM data at the given point in time
+QUERY_TEMPLATE = """
+    [timeout:900][maxsize:1073741824]__date__;
+    nwr(__bbox__);
+    out;"""
+
+OSM_ELEMENT_TYPES = ["node", "way", "relation"]
+
+Tile = Tuple[float, float, float, float]
+
+
+def parse_bbox(bbox: str) -> Tile:
+    """Parses a bbox string 'south,west,north,east' (WGS 84, as used by Overpass API)."""
+    values = [float(v) for v in str(bbox).strip("()[] ").split(",")]
+    if len(values) != 4 or values[0] >= values[2] or values[1] >= values[3]:
+        raise Exception(f"Invalid bounding box '{bbox}': expected 'south,west,north,east' (lat/lon in WGS 84).")
+    return values[0], values[1], values[2], values[3]
+
+
+def split_bbox(bbox: Tile, tile_size: float) -> List[Tile]:
+    """Splits the given bbox into a regular grid of tiles of at most 'tile_size' degrees (per axis)."""
+    s, w, n, e = bbox
+    rows = max(1, math.ceil(round((n - s) / tile_size, 9)))
+    cols = max(1, math.ceil(round((e - w) / tile_size, 9)))
+    dy, dx = (n - s) / rows, (e - w) / cols
+    return [(round(s + r * dy, 7), round(w + c * dx, 7), round(s + (r + 1) * dy, 7) if r < rows - 1 else n,
+             round(w + (c + 1) * dx, 7) if c < cols - 1 else e)
+            for r in range(rows) for c in range(cols)]
+
+
+def build_query(tile: Tile, date: str = None) -> str:
+    return QUERY_TEMPLATE.replace("__bbox__", ",".join(str(v) for v in tile)).replace(
+        "__date__", f'[date:"{date}"]' if date else "")
+
+
+def tile_cache_file(cache_dir: str, tile: Tile, query: str, date: str) -> str:
+    """Cache file of a tile - keyed by tile bbox, query and date (the current day if no date is set)."""
+    key = hashlib.sha256(json.dumps([list(tile), query, date]).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{key}.osm")
+
+
+class EndpointLimiter:
+    """Limits requests per Overpass API endpoint: at most 'slots' concurrent requests with at least 'interval' seconds
+    between the start of two requests."""
+
+    def __init__(self, url: str, slots: int, interval: float):
+        self.url = url
+        self.interval = interval
+        self._slots = asyncio.Semaphore(max(1, slots))
+        self._lock = asyncio.Lock()
+        self._last_start = None
+
+    async def __aenter__(self):
+        await self._slots.acquire()
+        async with self._lock:
+            if self._last_start is not None:
+                wait = self._last_start + self.interval - monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self._last_start = monotonic()
+        return self
+
+    async def __aexit__(self, *args):
+        self._slots.release()
+
+
+def _check_response(path: str) -> None:
+    """Overpass API reports runtime errors (e.g. timeout, maxsize exceeded) as remark within a successful response."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if "<remark>" in line and "runtime error" in line:
+                raise Exception(f"Overpass API runtime error: {line.strip()}")
+
+
+def download_file(url: str, query: str, path: str, timeout: float) -> None:
+    """Downloads the result of the given query to 'path' - written to a temporary file first, so that the target file
+    only exists after a complete download."""
+    part = f"{path}.part"
+    try:
+        with urllib.request.urlopen(f"{url}?data={urllib.parse.quote_plus(query)}", timeout=timeout) as response, \
+                open(part, "wb") as f:
+            while chunk := response.read(1024 * 1024):
+                f.write(chunk)
+        _check_response(part)
+        os.replace(part, path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+
+
+async def _download_tile(loop, executor, limiters: List[EndpointLimiter], first: int, tile: Tile, query: str,
+                         path: str, timeout: float) -> None:
+    # try all endpoints, starting with a different one per tile to distribute the load
+    for i in range(len(limiters)):
+        limiter = limiters[(first + i) % len(limiters)]
+        try:
+            async with limiter:
+                await loop.run_in_executor(executor, download_file, limiter.url, query, path, timeout)
+        except Exception as e:
+            h.log(f"download of tile {tile} from '{limiter.url}' failed: {e} --> trying again with next available API endpoint...")
+        else:
+            h.log(f"downloaded tile {tile} from '{limiter.url}'")
+            return
+    raise Exception(f"download of tile {tile} failed on all API endpoints")
+
+
+async def _download_tiles(downloads: List[Tuple[Tile, str, str]], endpoints: List[str], slots: int, interval: float,
+                          timeout: float) -> List[BaseException]:
+    loop = asyncio.get_running_loop()
+    limiters = [EndpointLimiter(url, slots, interval) for url in endpoints]
+    with ThreadPoolExecutor(max_workers=max(1, len(endpoints) * max(1, slots))) as executor:
+        results = await asyncio.gather(*[_download_tile(loop, executor, limiters, i, tile, query, path, timeout)
+                                         for i, (tile, query, path) in enumerate(downloads)], return_exceptions=True)
+    return [r for r in results if isinstance(r, BaseException)]
+
+
+def download_bbox(bbox: str, cache_dir: str, endpoints: List[str], tile_size: float = 0.1, date: str = None,
+                  slots: int = 2, interval: float = 1.0, timeout: float = 1000) -> List[str]:
+    """Downloads OSM data for the given bbox ('south,west,north,east') via Overpass API: the bbox is split into tiles
+    which are downloaded concurrently across all endpoints (per-endpoint rate limits apply). Tiles are cached in
+    'cache_dir' - only missing tiles are downloaded. Returns the tile files (in tile order)."""
+    if not endpoints:
+        raise Exception("No Overpass API endpoints configured.")
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_date = date or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    tiles = split_bbox(parse_bbox(bbox), tile_size)
+    files, downloads = [], []
+    for tile in tiles:
+        query = build_query(tile, date)
+        path = tile_cache_file(cache_dir, tile, query, cache_date)
+        files.append(path)
+        if not os.path.isfile(path):
+            downloads.append((tile, query, path))
+    h.log(f"OSM download: {len(tiles)} tiles, {len(tiles) - len(downloads)} found in cache, {len(downloads)} to download")
+    if downloads:
+        errors = asyncio.run(_download_tiles(downloads, endpoints, slots, interval, timeout))
+        if errors:
+            raise Exception(f"OSM download failed for {len(errors)} of {len(downloads)} tiles (successfully downloaded "
+                            f"tiles are cached and re-used on the next run): {errors[0]}")
+    return files
+
+
+def _elements(path: str, element_type: str) -> Iterator[Tuple[int, str]]:
+    """Yields id and XML string of all top-level elements of the given type from an OSM XML file."""
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if root is None:
+                root = elem
+            continue
+        depth -= 1
+        if depth == 1:
+            if elem.tag == element_type:
+                elem.tail = None
+                yield int(elem.get("id")), ET.tostring(elem, encoding="unicode")
+            root.clear()
+
+
+def merge_osm_files(paths: List[str], target: str) -> None:
+    """Merges the given OSM XML files (e.g. Overpass API results of adjacent tiles) into a single file: elements are
+    de-duplicated and written ordered by type (nodes, ways, relations) and id, as expected by osm2pgsql. Input files
+    need to be sorted by id per type (default order of Overpass API output)."""
+    part = f"{target}.part"
+    with open(part, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="NetAScore">\n')
+        for element_type in OSM_ELEMENT_TYPES:
+            last_id: Optional[int] = None
+            for element_id, xml in heapq.merge(*[_elements(path, element_type) for path in paths], key=lambda e: e[0]):
+                if element_id != last_id:
+                    f.write(f"  {xml}\n")
+                    last_id = element_id
+        f.write("</osm>\n")
+    os.replace(part, target)
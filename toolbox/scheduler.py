@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from time import perf_counter as clock
+from typing import Callable, Dict, List
+
+import toolbox.helper as h
+
+
+@dataclass
+class Task:
+    """A unit of work with declared inputs and outputs (e.g. table names).
+
+    A task is started as soon as all of its inputs that are produced by other tasks are available.
+    Inputs that are not produced by any task (e.g. pre-existing tables) are treated as available from the start."""
+    name: str
+    run: Callable[[], None]
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+
+
+def _resolve_producers(tasks: List[Task]) -> Dict[str, str]:
+    producers: Dict[str, str] = {}
+    for task in tasks:
+        for output in task.outputs:
+            if output in producers:
+                raise Exception(f"Output '{output}' is produced by both '{producers[output]}' and '{task.name}'.")
+            producers[output] = task.name
+    return producers
+
+
+def run_tasks(tasks: List[Task], workers: int = 1, stop_on_error: bool = True) -> None:
+    """Executes the given tasks in dependency order, running independent tasks concurrently on at most 'workers' threads.
+
+    By default, no further tasks are started after the first error. With 'stop_on_error' disabled, all tasks that do
+    not depend on a failed task are executed. All errors are reported at the end."""
+    workers = max(1, int(workers))
+    producers = _resolve_producers(tasks)
+    dependencies: Dict[str, set] = {
+        task.name: set(producers[i] for i in task.inputs if i in producers and producers[i] != task.name) for task in tasks
+    }
+    pending: Dict[str, Task] = {task.name: task for task in tasks}
+    completed: set = set()
+    errors: List[str] = []
+
+    def execute(task: Task) -> float:
+        start = clock()
+        task.run()
+        return clock() - start
+
+    h.log(f"running {len(tasks)} tasks using up to {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            # submit all tasks whose dependencies are satisfied (stop submitting after the first error if requested)
+            if not errors or not stop_on_error:
+                for name in [n for n in pending if dependencies[n] <= completed]:
+                    h.log(f"starting task '{name}'")
+                    running[executor.submit(execute, pending.pop(name))] = name
+            if not running:
+                if pending and not errors:
+                    raise Exception(f"Unable to resolve task dependencies (cyclic?): {', '.join(pending)}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    elapsed = future.result()
+                except Exception as e:
+                    h.majorInfo(f"ERROR in task '{name}': {e}")
+                    errors.append(f"{name}: {e}")
+                else:
+                    completed.add(name)
+                    h.info(f"task '{name}' completed after {h.secondsToStr(elapsed, detailed=True)}")
+    if errors:
+        skipped = f" - skipped: {', '.join(pending)}" if pending else ""
+        raise Exception(f"{len(errors)} task(s) failed: {'; '.join(errors)}{skipped}")